@@ -1,18 +1,46 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, jsonify, request, send_file, Response
-from flask_cors import CORS
 import os
+# geventワーカーではgRPC(Gemini・TTS)の待ちも協調的にする。
+# gRPCを使うモジュールの読み込みやクライアント生成より前に実行する必要がある。
+if os.getenv("SERVING_MODE", "threads") == "async":
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
+from flask import Flask, render_template, jsonify, request, send_file, Response, has_request_context
+from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.wsgi import ClosingIterator
 import json
+import re
 from datetime import datetime
 import uuid
 import traceback
 import requests
 import io
+import tempfile
+import time
+from urllib.parse import urlparse
 import google.generativeai as genai
 from google.cloud import storage
-from docx import Document
-from bs4 import BeautifulSoup
 from prompt_manager import PromptManager
+from build_scheduler import BuildScheduler
+from content_store import ContentStore
+from version_store import VersionStore
+from site_importer import SiteImporter
+from element_index import ElementIndexCache
+from word_exporter import WordExporter
+from metrics import metrics
+from http_cache import cached_response, make_etag, IMMUTABLE, NO_CACHE
+from static_index import StaticIndex
+from preview_publisher import PreviewPublisher, is_namespace
+from asset_types import mimetype_for, is_preview_asset
+from conversation_context import ConversationStore, estimate_tokens
+from fix_instructions import FixInstructionGenerator
+from summarizer import EmptySummaryError, Summarizer, default_max_chars, single_prompt
+from selection_prewarm import SelectionPrewarmer
+import session_feed
+from upload_store import UploadStore, UploadError
+from llm_scheduler import LLMScheduler, LLMBusy, INTERACTIVE, BATCH, BACKGROUND
 import logging
 # ★★★ 追加部分 1: 必要なライブラリをインポート ★★★
 from google.cloud import texttospeech
@@ -28,12 +56,69 @@ ASTRO_BUILD_SERVICE_URL = os.getenv("ASTRO_BUILD_SERVICE_URL", "https://astro-bu
 GCS_OUTPUT_BUCKET = os.getenv("GCS_OUTPUT_BUCKET", "gen-lang-client-0691275473-preview")
 GCS_OUTPUT_PATH = os.getenv("GCS_OUTPUT_PATH", "current")
 DEFAULT_PREVIEW_URL = os.getenv("DEFAULT_PREVIEW_URL", "https://gen-lang-client-0691275473.web.app")
+GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "ai-meeting-cloud.appspot.com")
+VERSION_MAX_PER_SESSION = int(os.getenv("VERSION_MAX_PER_SESSION", "50"))
+VERSION_SNAPSHOT_INTERVAL = int(os.getenv("VERSION_SNAPSHOT_INTERVAL", "10"))
+IMPORT_MAX_HTML_BYTES = int(os.getenv("IMPORT_MAX_HTML_BYTES", str(5 * 1024 * 1024)))
+IMPORT_MAX_ASSET_BYTES = int(os.getenv("IMPORT_MAX_ASSET_BYTES", str(10 * 1024 * 1024)))
+IMPORT_MAX_ASSETS = int(os.getenv("IMPORT_MAX_ASSETS", "200"))
+IMPORT_ASSET_WORKERS = int(os.getenv("IMPORT_ASSET_WORKERS", "8"))
+IMPORT_WAIT_TIMEOUT = int(os.getenv("IMPORT_WAIT_TIMEOUT", "120"))
+WORD_TEMPLATE_PATH = os.getenv("WORD_TEMPLATE_PATH")
+WORD_EXPORT_WORKERS = int(os.getenv("WORD_EXPORT_WORKERS", "2"))
+BUILD_COALESCE_SECONDS = float(os.getenv("BUILD_COALESCE_SECONDS", "2.0"))
+BUILD_MAX_PER_SESSION = int(os.getenv("BUILD_MAX_PER_SESSION", "1"))
+BUILD_MAX_GLOBAL = int(os.getenv("BUILD_MAX_GLOBAL", "4"))
+BUILD_RUN_TIMEOUT = int(os.getenv("BUILD_RUN_TIMEOUT", "600"))
+BUILD_POLL_INTERVAL = float(os.getenv("BUILD_POLL_INTERVAL", "5.0"))
+# ビルドごとの出力先（ビルダーが outputPath に応じた場合はそこから名前空間を公開する）
+BUILD_OUTPUT_PREFIX = os.getenv("BUILD_OUTPUT_PREFIX", "builds")
+# ビルダーが常にビルドごとの出力先に書き込む場合は true（false なら共有の出力先を守るためビルドを1件ずつ実行する）
+BUILD_OUTPUT_ISOLATED = os.getenv("BUILD_OUTPUT_ISOLATED", "false").lower() == "true"
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-2.0-flash-exp")
+LLM_INTERACTIVE_CONCURRENCY = int(os.getenv("LLM_INTERACTIVE_CONCURRENCY", "8"))
+LLM_INTERACTIVE_QUEUE = int(os.getenv("LLM_INTERACTIVE_QUEUE", "32"))
+LLM_BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", "2"))
+LLM_BATCH_QUEUE = int(os.getenv("LLM_BATCH_QUEUE", "8"))
+LLM_BACKGROUND_CONCURRENCY = int(os.getenv("LLM_BACKGROUND_CONCURRENCY", "1"))
+LLM_BACKGROUND_QUEUE = int(os.getenv("LLM_BACKGROUND_QUEUE", "4"))
+LLM_SESSION_LIMIT = int(os.getenv("LLM_SESSION_LIMIT", "2"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+PREVIEW_MANIFEST_TTL = float(os.getenv("PREVIEW_MANIFEST_TTL", "5"))
+PREVIEW_CACHE_BYTES = int(os.getenv("PREVIEW_CACHE_BYTES", str(64 * 1024 * 1024)))
+PREVIEW_NAMESPACE_PREFIX = os.getenv("PREVIEW_NAMESPACE_PREFIX", "previews")
+PREVIEW_KEEP_PER_SESSION = int(os.getenv("PREVIEW_KEEP_PER_SESSION", "2"))
+PREVIEW_NAMESPACE_TTL = int(os.getenv("PREVIEW_NAMESPACE_TTL", str(7 * 24 * 3600)))
+PREVIEW_NAMESPACE_MISS_TTL = float(os.getenv("PREVIEW_NAMESPACE_MISS_TTL", "2.0"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "2000"))
+SUMMARIZE_BATCH_WINDOW = float(os.getenv("SUMMARIZE_BATCH_WINDOW", "0.05"))
+SUMMARIZE_MAX_BATCH = int(os.getenv("SUMMARIZE_MAX_BATCH", "8"))
+SUMMARIZE_CACHE_SIZE = int(os.getenv("SUMMARIZE_CACHE_SIZE", "2000"))
+SUMMARIZE_MAX_INPUT_CHARS = int(os.getenv("SUMMARIZE_MAX_INPUT_CHARS", "8000"))
+SELECTION_PREWARM = os.getenv("SELECTION_PREWARM", "true").lower() == "true"
+SELECTION_PREWARM_INTENTS = os.getenv("SELECTION_PREWARM_INTENTS", "false").lower() == "true"
+SELECTION_PREWARM_TTL = float(os.getenv("SELECTION_PREWARM_TTL", "300"))
+SESSION_PAGE_SIZE = int(os.getenv("SESSION_PAGE_SIZE", "50"))
+SESSION_PAGE_MAX = int(os.getenv("SESSION_PAGE_MAX", "500"))
+UPLOAD_STAGING_DIR = os.getenv("UPLOAD_STAGING_DIR", os.path.join(tempfile.gettempdir(), "hp-support-uploads"))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_GCS_CHUNK_BYTES = int(os.getenv("UPLOAD_GCS_CHUNK_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+STATIC_WATCH = os.getenv("STATIC_WATCH", "false").lower() == "true"
+STATIC_MMAP_THRESHOLD = int(os.getenv("STATIC_MMAP_THRESHOLD", str(256 * 1024)))
+# 前段で X-Forwarded-For を付け足す信頼できるプロキシの段数（Cloud Run はフロントエンド1段。直接公開なら0）
+TRUSTED_PROXY_COUNT = int(os.getenv("TRUSTED_PROXY_COUNT", "1"))
 
 if GEMINI_API_KEY:
     genai.configure(api_key=GEMINI_API_KEY)
 
-app = Flask(__name__)
+# /static は serve_static で配信する（Flask組み込みの静的ファイル配信は使わない）
+app = Flask(__name__, static_folder=None)
+if TRUSTED_PROXY_COUNT > 0:
+    # 信頼できる段数ぶんだけ X-Forwarded-For を遡って remote_addr を決める（クライアントが付けた値は使わない）
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
 CORS(app)
+metrics.init_app(app)
 
 class AppState:
     def __init__(self):
@@ -45,6 +130,118 @@ state = AppState()
 # プロンプトマネージャーを初期化
 prompt_manager = PromptManager()
 
+# 修正HTML・修正ログの保存先（内容ハッシュで重複排除）
+html_store = ContentStore(lambda: storage.Client().bucket(GCS_BUCKET_NAME))
+
+# アップロードファイルの保存先（分割受信・内容ハッシュで重複排除・転送と後処理はバックグラウンド）
+upload_store = UploadStore(
+    lambda: storage.Client().bucket(GCS_BUCKET_NAME),
+    UPLOAD_STAGING_DIR,
+    max_size=UPLOAD_MAX_BYTES,
+    gcs_chunk_size=UPLOAD_GCS_CHUNK_BYTES,
+    max_workers=UPLOAD_WORKERS
+)
+
+# セッションごとのページバージョン履歴（サーバー側Undo/Redo）
+version_store = VersionStore(
+    max_versions=VERSION_MAX_PER_SESSION,
+    snapshot_interval=VERSION_SNAPSHOT_INTERVAL
+)
+
+# Gemini呼び出しの実行枠（対話・バッチ・バックグラウンドで枠を分け、セッション間で公平に割り当てる）
+llm_scheduler = LLMScheduler(
+    {
+        INTERACTIVE: (LLM_INTERACTIVE_CONCURRENCY, LLM_INTERACTIVE_QUEUE),
+        BATCH: (LLM_BATCH_CONCURRENCY, LLM_BATCH_QUEUE),
+        BACKGROUND: (LLM_BACKGROUND_CONCURRENCY, LLM_BACKGROUND_QUEUE),
+    },
+    session_limit=LLM_SESSION_LIMIT,
+    queue_timeout=LLM_QUEUE_TIMEOUT
+)
+
+def llm_fairness_key(session_id):
+    """
+    実行枠の割り当て単位（セッションID。なければリクエスト元のクライアント）
+
+    クライアントは ProxyFix が信頼できるプロキシの段数から決めた remote_addr で識別する
+    （X-Forwarded-For の先頭はクライアントが自由に書けるので使わない）。
+
+    セッションのない呼び出しを1つの枠にまとめると、無関係な利用者同士で上限を奪い合うことになる。
+    リクエスト外（バックグラウンド処理）でセッションもない場合は None（セッション単位の上限なし）。
+    """
+    if session_id:
+        return session_id
+    if has_request_context():
+        return f"client:{request.remote_addr}"
+    return None
+
+def generate_content(prompt, priority=INTERACTIVE, session_id=None, operation="generate_content"):
+    """Gemini呼び出しの共通経路（実行枠の確保 → 計測付きで生成）"""
+    if not state.gemini_model:
+        state.gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    with llm_scheduler.slot(priority, llm_fairness_key(session_id)):
+        with metrics.span("gemini", operation):
+            return state.gemini_model.generate_content(prompt)
+
+def stream_content(prompt, priority=INTERACTIVE, session_id=None, operation="stream_generate_content"):
+    """generate_content のストリーミング版（テキストのチャンクを返す。実行枠は読み終えるまで保持）"""
+    if not state.gemini_model:
+        state.gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    model = state.gemini_model
+
+    def produce():
+        with metrics.span("gemini", operation):
+            for chunk in model.generate_content(prompt, stream=True):
+                text = getattr(chunk, 'text', '')
+                if text:
+                    yield text
+
+    return llm_scheduler.stream(priority, llm_fairness_key(session_id), produce)
+
+def summarize_conversation(session_id, previous_summary, turns_text):
+    """古い発言を既存の要約に畳み込む（バックグラウンド枠で実行）"""
+    prompt = f"""以下はHTML修正アシスタントとユーザーの会話です。
+既存の要約に新しい会話の内容を加え、修正対象の要素・決定した修正内容・未解決の質問が分かるように
+日本語で300字以内に要約してください。要約文のみを返してください。
+
+既存の要約:
+{previous_summary or "なし"}
+
+新しい会話:
+{turns_text}
+"""
+    response = generate_content(prompt, BACKGROUND, session_id)
+    return response.text if hasattr(response, 'text') else None
+
+# セッションごとの会話コンテキスト（トークン予算内で直近の発言 + 古い発言の要約）
+conversation_store = ConversationStore(summarize_conversation, token_budget=CHAT_CONTEXT_TOKEN_BUDGET)
+
+def generate_fix_text(prompt, session_id):
+    response = generate_content(prompt, BATCH, session_id)
+    return response.text if hasattr(response, 'text') else "生成に失敗しました"
+
+# 修正指示書（前回の指示書に新しい会話ログの分だけ追記する）
+fix_instruction_generator = FixInstructionGenerator(generate_fix_text, prompt_manager)
+
+def generate_summary_text(prompt, session_id):
+    response = generate_content(prompt, INTERACTIVE, session_id, operation="summarize")
+    return response.text if hasattr(response, 'text') else ""
+
+# 要素テキストの要約（同じ本文はキャッシュ、短時間に集まった同じセッションの要求は1回の呼び出しにまとめる）
+summarizer = Summarizer(
+    generate_summary_text,
+    window=SUMMARIZE_BATCH_WINDOW,
+    max_batch=SUMMARIZE_MAX_BATCH,
+    cache_size=SUMMARIZE_CACHE_SIZE
+)
+
+@app.errorhandler(LLMBusy)
+def llm_busy(e):
+    """混雑時は待たせずに429とRetry-Afterを返す"""
+    response = jsonify({"success": False, "error": str(e), "retry_after": e.retry_after})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 429
+
 # ★★★ 追加部分 2: TTSクライアントのグローバル変数と初期化関数 ★★★
 tts_client = None
 
@@ -69,9 +266,37 @@ def initialize_services():
         app.services_initialized = True
         logger.info("All services initialized")
 
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# staticディレクトリは起動時にメモリへ読み込む（STATIC_WATCH=true で更新を監視）
+static_index = StaticIndex(
+    STATIC_DIR,
+    mmap_threshold=STATIC_MMAP_THRESHOLD,
+    watch=STATIC_WATCH
+)
+
+@app.context_processor
+def static_url_processor():
+    def static_url(filename):
+        """内容ハッシュ付きのURL（?v=）を返す。内容が変わればURLも変わるため immutable で配信できる"""
+        asset = static_index.get(filename)
+        return f"/static/{filename}?v={asset.etag[:12]}" if asset else f"/static/{filename}"
+    return {"static_url": static_url}
+
+# レンダリング済みのトップページ（テンプレート自動再読み込みが有効な開発時は毎回レンダリング）
+_index_page = None
+
 @app.route("/")
 def index():
-    return render_template("index.html")
+    global _index_page
+    if _index_page is None or app.jinja_env.auto_reload or STATIC_WATCH:
+        _index_page = render_template("index.html").encode("utf-8")
+    return cached_response(_index_page, "text/html", reuse=True)
+
+# レイテンシ計測値（Prometheusテキスト形式）
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 # ★★★ 修正部分 2: ヘルスチェックにTTSの状態を追加 ★★★
 @app.route("/health")
@@ -81,6 +306,10 @@ def health():
         "service": "hp-support",
         "gemini_configured": bool(GEMINI_API_KEY),
         "tts_configured": tts_client is not None,  # TTSが初期化されているかを確認
+        "serving_mode": os.getenv("SERVING_MODE", "threads"),
+        "llm_scheduler": llm_scheduler.stats(),
+        "summarizer": summarizer.stats(),
+        "selection_prewarm": selection_prewarmer.stats(),
         "prompts_bucket": bool(os.getenv("PROMPTS_BUCKET_NAME")),
         "preview_bucket": f"{GCS_OUTPUT_BUCKET}/{GCS_OUTPUT_PATH}",
         "default_preview_url": DEFAULT_PREVIEW_URL
@@ -94,29 +323,25 @@ def serve_preview(filename="index.html"):
     """GCSからビルド済みファイルを取得して配信(全アセット対応フォールバック付き)"""
 
     # Content-Type判定(早期に実行)
-    content_type = 'text/html'
-    if filename.endswith('.css'):
-        content_type = 'text/css'
-    elif filename.endswith('.js'):
-        content_type = 'application/javascript'
-    elif filename.endswith('.json'):
-        content_type = 'application/json'
-    elif filename.endswith('.png'):
-        content_type = 'image/png'
-    elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
-        content_type = 'image/jpeg'
-    elif filename.endswith('.svg'):
-        content_type = 'image/svg+xml'
-    elif filename.endswith('.woff') or filename.endswith('.woff2'):
-        content_type = 'font/woff2'
-    elif filename.endswith('.ttf'):
-        content_type = 'font/ttf'
-    elif filename.endswith('.ico'):
-        content_type = 'image/x-icon'
-    elif filename.endswith('.webp'):
-        content_type = 'image/webp'
-    elif filename.endswith('.gif'):
-        content_type = 'image/gif'
+    content_type = mimetype_for(filename, default='text/html')
+
+    # ビルドごとの名前空間（/preview/<build_id>/...）はビルド専用の出力先から公開したものだけ長期キャッシュ
+    namespace, _, namespaced_file = filename.partition('/')
+    if is_namespace(namespace):
+        try:
+            response = serve_published_preview(namespaced_file or "index.html", namespace, IMMUTABLE)
+        except Exception as publish_error:
+            logger.error(f"Failed to serve preview namespace {filename}: {publish_error}")
+            return f"Error serving preview file: {filename}", 500
+        return response or (f"Preview file not found: {filename}", 404)
+
+    # 公開済みのプレビューがあれば注入・変換なしでそのまま返す
+    try:
+        response = serve_published_preview(filename)
+        if response:
+            return response
+    except Exception as publish_error:
+        logger.warning(f"Failed to serve published preview {filename}: {publish_error}, falling back")
 
     # GCS接続を試みる（失敗した場合は即座にフォールバック）
     gcs_available = False
@@ -132,16 +357,19 @@ def serve_preview(filename="index.html"):
         gcs_available = True
 
         # GCSにファイルがある場合は取得して返す
-        if blob.exists():
+        with metrics.span("gcs", "exists"):
+            blob_exists = blob.exists()
+        if blob_exists:
             try:
-                content = blob.download_as_bytes()
+                with metrics.span("gcs", "download"):
+                    content = blob.download_as_bytes()
                 logger.info(f"✓ Served from GCS: {blob_path} ({len(content)} bytes)")
 
                 # index.htmlの場合、ベースURLと選択検知スクリプトを注入
                 if filename == "index.html" and content_type == 'text/html':
                     content = inject_scripts_to_html(content)
 
-                return Response(content, mimetype=content_type)
+                return cached_response(content, content_type)
             except Exception as download_error:
                 logger.warning(f"Failed to download from GCS: {download_error}, falling back")
                 gcs_available = False
@@ -163,7 +391,8 @@ def serve_preview(filename="index.html"):
             fallback_url = f"{DEFAULT_PREVIEW_URL}/{filename}"
 
         logger.info(f"Fetching from fallback URL: {fallback_url}")
-        fallback_response = requests.get(fallback_url, timeout=10, allow_redirects=True)
+        with metrics.span("origin", "fetch"):
+            fallback_response = requests.get(fallback_url, timeout=10, allow_redirects=True)
 
         if fallback_response.status_code == 200:
             content = fallback_response.content
@@ -182,12 +411,13 @@ def serve_preview(filename="index.html"):
             # GCSにキャッシュ保存を試みる（失敗しても続行）
             if gcs_available and blob is not None:
                 try:
-                    blob.upload_from_string(content, content_type=response_content_type)
+                    with metrics.span("gcs", "upload"):
+                        blob.upload_from_string(content, content_type=response_content_type)
                     logger.info(f"✓ Cached to GCS: {blob_path}")
                 except Exception as cache_error:
                     logger.warning(f"Failed to cache to GCS (non-critical): {cache_error}")
 
-            return Response(content, mimetype=response_content_type)
+            return cached_response(content, response_content_type)
         else:
             logger.warning(f"Fallback URL returned {fallback_response.status_code} for {fallback_url}")
             return f"Preview file not found: {filename}", 404
@@ -198,21 +428,8 @@ def serve_preview(filename="index.html"):
         return f"Error serving preview file: {filename}", 500
 
 
-def inject_scripts_to_html(content):
-    """HTMLコンテンツにベースURLと選択検知スクリプトを注入する"""
-    try:
-        html_content = content.decode('utf-8')
-
-        # <head>タグの直後に<base>タグを挿入(既にない場合のみ)
-        if '<head>' in html_content and '<base' not in html_content:
-            html_content = html_content.replace(
-                '<head>',
-                '<head>\n    <base href="/preview/">'
-            )
-            logger.info("✓ Injected <base href='/preview/'> tag")
-
-        # 選択検知スクリプトを注入(既にない場合のみ)
-        selection_script = """
+# プレビュー・インポートしたページに埋め込む選択検知スクリプト
+SELECTION_SCRIPT = """
 <script>
 // ノードのXPathを取得するヘルパー関数
 function getNodePath(node) {
@@ -295,6 +512,7 @@ document.addEventListener('mouseup', function() {
                 className: element.className,
                 id: element.id,
                 selector: selector,
+                nodePath: getNodePath(element),
                 rangeInfo: rangeInfo
             }, '*');
 
@@ -305,12 +523,142 @@ document.addEventListener('mouseup', function() {
 </script>
 """
 
+# 修正指示書のWord出力（テンプレートは起動時に読み込む）
+word_exporter = WordExporter(template_path=WORD_TEMPLATE_PATH, max_workers=WORD_EXPORT_WORKERS)
+
+# ページ版ごとの要素インデックス（選択箇所の解決用）
+element_index_cache = ElementIndexCache()
+
+def resolve_selection(session_id, selection):
+    """セッションの最新ページ版から選択箇所を一意なセレクタ・ノードパスに解決する"""
+    if not session_id or not selection:
+        return None
+    html, _ = version_store.get(session_id)
+    if not html:
+        return None
+    try:
+        return element_index_cache.get(html).resolve(selection)
+    except Exception as e:
+        logger.warning(f"Selection resolve failed: {e}")
+        return None
+
+# /api/chat のプロンプトの固定部分
+CHAT_PROMPT_HEADER = """あなたはHTML修正アシスタントです。ユーザーの修正指示を分析し、以下のJSON形式で返答してください。
+
+**必ず以下のJSON形式で返答してください（マークダウンなし、JSONのみ）:**
+
+{
+  "action": "immediate" | "question" | "batch",
+  "response": "ユーザーへの返答メッセージ",
+  "modification": {
+    "selector": "CSSセレクタまたは特殊セレクタ",
+    "type": "fontSize" | "text" | "color" | "background" | "delete",
+    "newValue": "新しい値",
+    "description": "修正内容の説明"
+  }
+}
+
+判定基準:
+- immediate: 簡単な修正（サイズ変更、色変更、削除など）
+- question: 不明確な指示、追加情報が必要
+- batch: 複雑な修正、複数箇所の変更
+
+修正タイプ:
+- fontSize: フォントサイズ変更（newValue例: "12.8px"）
+- text: テキスト内容変更
+- color: 文字色変更
+- background: 背景色変更
+- delete: 要素削除（newValueは空文字列""）
+
+フォントサイズ計算（デフォルト16px基準）:
+- 20%小さく → 16px × 0.8 = 12.8px
+- 50%大きく → 16px × 1.5 = 24px
+
+**重要**: 選択情報にclassNameやidがない場合、selectorには以下の形式を使用してください:
+"__TEXT_CONTENT__選択されたテキスト__"
+
+例: {"selector": "__TEXT_CONTENT__Instagram → (仮称)__", "type": "delete", ...}
+"""
+
+def prepare_selection(session_id, selection):
+    """プロンプトのうち選択箇所で決まる部分（セレクタ解決・周辺DOMの要約・選択情報）を組み立てる"""
+    version = version_store.current_version(session_id) if session_id else None
+    resolved_target = resolve_selection(session_id, selection)
+    selector_override = None
+    resolved_hint = ""
+    if resolved_target:
+        selector_override = resolved_target["selector"]
+        resolved_hint = f'\n**対象要素のセレクタは解決済みです**: selectorには "{selector_override}" をそのまま使用してください。\n'
+        if resolved_target.get("domSummary"):
+            resolved_hint += f"対象要素の位置と周辺: {resolved_target['domSummary']}\n"
+    elif selection and selection.get('textContent'):
+        # クラスやIDがない場合、textContentを使った検索用の特殊セレクタを生成
+        if not selection.get('className') and not selection.get('id'):
+            selector_override = f"__TEXT_CONTENT__{selection['textContent'][:50]}__"
+    selection_block = json.dumps(selection, ensure_ascii=False, indent=2) if selection else "なし"
+    return {
+        "version": version,
+        "resolved_target": resolved_target,
+        "selector_override": selector_override,
+        "resolved_hint": resolved_hint,
+        "selection_block": selection_block,
+        # 会話とメッセージを除いたプロンプトのトークン数（概算）
+        "prefix_tokens": estimate_tokens(CHAT_PROMPT_HEADER + resolved_hint + selection_block),
+    }
+
+def suggest_intents(session_id, selection, prepared):
+    """選択された要素に対して想定される修正を先に求める（バックグラウンド枠の軽い呼び出し）"""
+    target = prepared["resolved_target"] or {}
+    text = target.get("text") or (selection or {}).get("textContent") or ""
+    prompt = f"""Webページの次の要素を選択したユーザーが依頼しそうな修正を3つまで、1行に1つずつ短い日本語で挙げてください。説明や番号は不要です。
+
+要素: {target.get("tagName") or (selection or {}).get("tagName", "")}「{text[:100]}」
+{target.get("domSummary", "")}
+"""
+    response = generate_content(prompt, BACKGROUND, session_id, operation="suggest_intents")
+    lines = (response.text if hasattr(response, 'text') else "").splitlines()
+    return [line.strip(" -・*") for line in lines if line.strip(" -・*")][:3]
+
+# 選択箇所ごとのプロンプト部品の先行準備（選択 → chat の間に済ませておく）
+selection_prewarmer = SelectionPrewarmer(
+    prepare_selection,
+    warm=suggest_intents if SELECTION_PREWARM_INTENTS else None,
+    ttl=SELECTION_PREWARM_TTL
+)
+
+# サイトインポート（SELECTION_SCRIPTを埋め込んで保存）
+site_importer = SiteImporter(
+    lambda: storage.Client().bucket(GCS_BUCKET_NAME),
+    SELECTION_SCRIPT,
+    max_html_bytes=IMPORT_MAX_HTML_BYTES,
+    max_asset_bytes=IMPORT_MAX_ASSET_BYTES,
+    max_assets=IMPORT_MAX_ASSETS,
+    asset_workers=IMPORT_ASSET_WORKERS
+)
+
+def inject_scripts_to_html(content, base_href="/preview/"):
+    """HTMLコンテンツにベースURLと選択検知スクリプトを注入する"""
+    try:
+        html_content = content.decode('utf-8')
+
+        # <head>タグの直後に<base>タグを挿入(既にない場合のみ)
+        if '<head>' in html_content and '<base' not in html_content:
+            html_content = html_content.replace(
+                '<head>',
+                f'<head>\n    <base href="{base_href}">'
+            )
+            logger.info(f"✓ Injected <base href='{base_href}'> tag")
+        elif base_href != "/preview/" and '<base href="/preview/">' in html_content:
+            # 注入済みのHTMLを名前空間用に書き換える
+            html_content = html_content.replace('<base href="/preview/">', f'<base href="{base_href}">', 1)
+
+        # 選択検知スクリプトを注入(既にない場合のみ)
         if '</body>' in html_content and 'text-selected' not in html_content:
-            html_content = html_content.replace('</body>', selection_script + '</body>')
+            html_content = html_content.replace('</body>', SELECTION_SCRIPT + '</body>')
             logger.info("✓ Injected selection detection script")
         elif '</html>' in html_content and 'text-selected' not in html_content:
             # </body>がない場合は</html>の前に挿入
-            html_content = html_content.replace('</html>', selection_script + '</html>')
+            html_content = html_content.replace('</html>', SELECTION_SCRIPT + '</html>')
             logger.info("✓ Injected selection detection script (before </html>)")
 
         return html_content.encode('utf-8')
@@ -319,6 +667,40 @@ document.addEventListener('mouseup', function() {
         logger.warning(f"Failed to inject scripts: {e}")
         return content
 
+# ビルド完了時に注入済みプレビューを公開する（ビルドごとの名前空間も作る）
+preview_publisher = PreviewPublisher(
+    lambda: storage.Client().bucket(GCS_OUTPUT_BUCKET),
+    GCS_OUTPUT_PATH,
+    inject_scripts_to_html,
+    manifest_ttl=PREVIEW_MANIFEST_TTL,
+    cache_bytes=PREVIEW_CACHE_BYTES,
+    namespace_prefix=PREVIEW_NAMESPACE_PREFIX,
+    keep_per_session=PREVIEW_KEEP_PER_SESSION,
+    namespace_ttl=PREVIEW_NAMESPACE_TTL,
+    miss_ttl=PREVIEW_NAMESPACE_MISS_TTL
+)
+
+def serve_published_preview(filename, namespace=None, cache_control=NO_CACHE):
+    """公開済みプレビューから返す（公開されていないファイルはNone）"""
+    published = preview_publisher.lookup(filename, namespace)
+    if not published:
+        return None
+    # ビルド専用の出力先から公開したものでなければ、長期キャッシュさせずに再検証させる
+    if cache_control == IMMUTABLE and not published["immutable"]:
+        cache_control = NO_CACHE
+    return cached_response(lambda: preview_publisher.read(filename, published),
+                           published["content_type"], etag=published["etag"], cache_control=cache_control,
+                           reuse=True)
+
+def preview_namespace_from_referer():
+    """/preview/<build_id>/ のページから参照されたリクエストなら名前空間を返す"""
+    if not request.referrer:
+        return None
+    parts = urlparse(request.referrer).path.split('/')
+    if len(parts) > 2 and parts[1] == 'preview' and is_namespace(parts[2]):
+        return parts[2]
+    return None
+
 @app.route("/api/sessions", methods=["POST"])
 def create_session():
     data = request.json
@@ -330,14 +712,96 @@ def create_session():
         "client_info": data.get("clientInfo", {}),
         "conversation_log": [],
         "build_jobs": [],
-        "fix_instructions": []
+        "fix_instructions": [],
+        "seq": 0
     }
     return jsonify({"success": True, "sessionId": session_id}), 201
 
 @app.route("/api/sessions/<session_id>", methods=["GET"])
 def get_session(session_id):
+    """
+    セッションの取得
+
+    クエリを指定しなければ従来どおり {"success", "session": セッション全体} を返す。
+    ページング・差分取得はクエリを指定したときだけ行う:
+    - ?cursor=<seq>&limit=N: 会話ログを新しい順に、cursor より古いエントリのページ
+    - ?since=<seq>: since より後に追加された会話ログ・ビルド・最新の修正指示書だけ
+    ETag はセッションの変更番号から作るため、変更がなければ304を返す。
+    """
     session = state.sessions.get(session_id)
-    return jsonify({"success": True, "session": session}) if session else (jsonify({"error": "Session not found"}), 404)
+    if not session:
+        return jsonify({"error": "Session not found"}), 404
+    
+    try:
+        since = request.args.get("since", type=int)
+        cursor = request.args.get("cursor", type=int)
+        limit = request.args.get("limit")
+        paged = since is not None or cursor is not None or limit is not None
+        limit = min(max(int(limit or SESSION_PAGE_SIZE), 1), SESSION_PAGE_MAX)
+    except ValueError:
+        return jsonify({"success": False, "error": "limit は整数で指定してください"}), 400
+    
+    context = conversation_store.stats(session_id)
+    etag = make_etag(json.dumps(
+        [session_id, session.get("seq", 0), request.query_string.decode(), context], sort_keys=True
+    ).encode("utf-8"))
+    
+    def body():
+        if since is not None:
+            result = session_feed.delta(session, since, limit)
+        elif paged:
+            result = session_feed.page(session, cursor, limit)
+        else:
+            result = {"session": session_feed.snapshot(session)}
+        return json.dumps({"success": True, **result, "context": context}, ensure_ascii=False).encode("utf-8")
+    
+    return cached_response(body, "application/json", etag=etag)
+
+@app.route("/api/sessions/<session_id>/versions", methods=["GET", "POST"])
+def session_versions(session_id):
+    """ページのバージョン一覧取得（GET）/ 新しいバージョンの記録（POST）"""
+    if session_id not in state.sessions:
+        return jsonify({"error": "Session not found"}), 404
+    
+    if request.method == "GET":
+        return jsonify({"success": True, "history": version_store.summary(session_id)})
+    
+    data = request.json
+    html = data.get("html", "")
+    if not html:
+        return jsonify({"success": False, "error": "HTMLが空です"}), 400
+    
+    meta, changed = version_store.commit(session_id, html, data.get("description", ""))
+    return jsonify({"success": True, "version": meta, "changed": changed})
+
+@app.route("/api/sessions/<session_id>/versions/current", methods=["GET"])
+@app.route("/api/sessions/<session_id>/versions/<int:version>", methods=["GET"])
+def get_session_version(session_id, version=None):
+    """指定バージョン（省略時は最新）のHTMLを返す"""
+    if session_id not in state.sessions:
+        return jsonify({"error": "Session not found"}), 404
+    html, meta = version_store.get(session_id, version)
+    if html is None:
+        return jsonify({"success": False, "error": "バージョンがありません"}), 404
+    return jsonify({"success": True, "html": html, "version": meta})
+
+@app.route("/api/sessions/<session_id>/undo", methods=["POST"])
+def undo_version(session_id):
+    if session_id not in state.sessions:
+        return jsonify({"error": "Session not found"}), 404
+    html, meta = version_store.undo(session_id)
+    if html is None:
+        return jsonify({"success": False, "error": "元に戻す操作がありません"}), 400
+    return jsonify({"success": True, "html": html, "version": meta})
+
+@app.route("/api/sessions/<session_id>/redo", methods=["POST"])
+def redo_version(session_id):
+    if session_id not in state.sessions:
+        return jsonify({"error": "Session not found"}), 404
+    html, meta = version_store.redo(session_id)
+    if html is None:
+        return jsonify({"success": False, "error": "やり直す操作がありません"}), 400
+    return jsonify({"success": True, "html": html, "version": meta})
 
 @app.route("/chat-message", methods=["POST"])
 def chat_message():
@@ -352,20 +816,21 @@ def chat_message():
         return jsonify({"ai_response": "Gemini APIキーが設定されていません"})
     
     try:
-        if not state.gemini_model:
-            state.gemini_model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        
         # システムプロンプトを取得
         system_prompt = prompt_manager.get("chat_system")
         
-        # システムプロンプト + ユーザーメッセージ
-        full_prompt = f"{system_prompt}\n\nユーザー: {user_text}"
+        # システムプロンプト + これまでの会話 + ユーザーメッセージ
+        context_text = conversation_store.prompt_context(session_id) if session_id else ""
+        full_prompt = f"{system_prompt}\n\n{context_text}\nユーザー: {user_text}" if context_text \
+            else f"{system_prompt}\n\nユーザー: {user_text}"
         
-        response = state.gemini_model.generate_content(full_prompt)
+        response = generate_content(full_prompt, INTERACTIVE, session_id)
         ai_response = response.text if hasattr(response, 'text') else "応答を生成できませんでした"
+        if session_id:
+            conversation_store.add_exchange(session_id, user_text, ai_response)
         
         if session_id and session_id in state.sessions:
-            state.sessions[session_id]["conversation_log"].append({
+            session_feed.append(state.sessions[session_id], "conversation_log", {
                 "timestamp": datetime.now().isoformat(),
                 "type": "chat",
                 "user": user_text,
@@ -373,11 +838,68 @@ def chat_message():
             })
         
         return jsonify({"ai_response": ai_response})
+    except LLMBusy:
+        raise
     except Exception as e:
         logger.error(f"Chat error: {e}")
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+def build_output_path(ticket_id):
+    return f"{BUILD_OUTPUT_PREFIX}/{ticket_id}"
+
+def dispatch_build(session_id, diff_data, ticket_id):
+    """ビルダーにビルドを依頼する（BuildSchedulerから呼ばれる。出力先はビルドごとに分けるよう依頼する）"""
+    with metrics.span("builder", "build"):
+        build_response = requests.post(
+            f"{ASTRO_BUILD_SERVICE_URL}/build",
+            json={"session_id": session_id, "diffData": diff_data, "outputPath": build_output_path(ticket_id)},
+            timeout=30
+        )
+    if not build_response.ok:
+        return {"success": False, "error": f"HTTP {build_response.status_code}"}
+
+    build_data = build_response.json()
+    session = state.sessions.get(session_id)
+    if session is not None and build_data.get("success") and "jobId" in build_data:
+        session_feed.append(session, "build_jobs", {
+            "job_id": build_data["jobId"],
+            "triggered_at": datetime.now().isoformat(),
+            "status": build_data.get("status", "pending")
+        })
+    return build_data
+
+def isolated_output(ticket):
+    """ビルダーがこのビルド専用の出力先に書き込んだと応答していればその出力先（それ以外はNone）"""
+    expected = build_output_path(ticket["ticket_id"])
+    return expected if (ticket["build_data"] or {}).get("outputPath") == expected else None
+
+def poll_build(job_id):
+    """ビルダーからビルドの状態を取得する（クライアントが取得しなくても実行枠を解放するため）"""
+    with metrics.span("builder", "status"):
+        status_response = requests.get(f"{ASTRO_BUILD_SERVICE_URL}/build/{job_id}", timeout=10)
+    if not status_response.ok:
+        return None, None
+    status_data = status_response.json()
+    return status_data.get("status"), status_data.get("error")
+
+# ビルドスケジューラを初期化
+build_scheduler = BuildScheduler(
+    dispatch_build,
+    coalesce_seconds=BUILD_COALESCE_SECONDS,
+    max_per_session=BUILD_MAX_PER_SESSION,
+    max_global=BUILD_MAX_GLOBAL if BUILD_OUTPUT_ISOLATED else 1,
+    run_timeout=BUILD_RUN_TIMEOUT,
+    poll=poll_build,
+    poll_interval=BUILD_POLL_INTERVAL,
+    on_complete=lambda ticket: preview_publisher.publish_async(
+        ticket["job_id"] or ticket["ticket_id"],
+        namespace=ticket["ticket_id"],
+        session_id=ticket["session_id"],
+        source_prefix=isolated_output(ticket)
+    )
+)
+
 @app.route("/api/trigger-build", methods=["POST"])
 def trigger_build():
     data = request.json
@@ -387,31 +909,64 @@ def trigger_build():
         return jsonify({"success": False, "error": "有効なセッションIDが必要です"}), 400
     
     try:
-        build_response = requests.post(
-            f"{ASTRO_BUILD_SERVICE_URL}/build",
-            json={"session_id": session_id, "diffData": data.get("diffData", {})},
-            timeout=30
-        )
-        
-        if build_response.ok:
-            build_data = build_response.json()
-            if build_data.get("success") and "jobId" in build_data:
-                state.sessions[session_id]["build_jobs"].append({
-                    "job_id": build_data["jobId"],
-                    "triggered_at": datetime.now().isoformat(),
-                    "status": build_data.get("status", "pending")
-                })
-            return jsonify(build_data)
-        else:
-            return jsonify({"success": False, "error": f"HTTP {build_response.status_code}"}), build_response.status_code
+        # 連続クリックは合流させ、実際の送信はスケジューラが行う
+        ticket, coalesced = build_scheduler.trigger(session_id, data.get("diffData", {}))
+        return jsonify({
+            "success": True,
+            "jobId": ticket["ticket_id"],
+            "status": ticket["status"],
+            "coalesced": coalesced,
+            "triggerCount": ticket["trigger_count"]
+        }), 202
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/api/build-status", methods=["GET"])
 @app.route("/api/build-status/<job_id>", methods=["GET"])
-def get_build_status(job_id):
+def get_build_status(job_id=None):
+    # jobId省略時はセッションのスケジューラ状態を返す
+    if job_id is None:
+        session_id = request.args.get("session_id")
+        if not session_id or session_id not in state.sessions:
+            return jsonify({"success": False, "error": "有効なセッションIDが必要です"}), 400
+        return jsonify({"success": True, **build_scheduler.session_snapshot(session_id)})
+
+    ticket = build_scheduler.get(job_id)
+    if ticket and not ticket["job_id"]:
+        # まだビルダーに送信されていない（待機中・置き換え済み・送信失敗）
+        return jsonify({
+            "success": True,
+            "jobId": ticket["ticket_id"],
+            "status": ticket["status"],
+            "supersededBy": ticket["superseded_by"],
+            "triggerCount": ticket["trigger_count"],
+            "error": ticket["error"]
+        })
+
+    builder_job_id = ticket["job_id"] if ticket else job_id
     try:
-        status_response = requests.get(f"{ASTRO_BUILD_SERVICE_URL}/build/{job_id}", timeout=10)
-        return jsonify(status_response.json()) if status_response.ok else (jsonify({"success": False, "error": f"HTTP {status_response.status_code}"}), status_response.status_code)
+        with metrics.span("builder", "status"):
+            status_response = requests.get(f"{ASTRO_BUILD_SERVICE_URL}/build/{builder_job_id}", timeout=10)
+        if not status_response.ok:
+            return jsonify({"success": False, "error": f"HTTP {status_response.status_code}"}), status_response.status_code
+
+        status_data = status_response.json()
+        build_scheduler.update_status(builder_job_id, status_data.get("status"), status_data.get("error"))
+        if ticket:
+            status_data["ticketId"] = ticket["ticket_id"]
+            status_data.setdefault("logUrl", (ticket["build_data"] or {}).get("logUrl"))
+            # 完了したビルドは名前空間の公開が終わるまで publishing として返す
+            if status_data.get("status") == "completed":
+                namespace_status = preview_publisher.namespace_status(ticket["ticket_id"])
+                if namespace_status == "publishing":
+                    status_data["status"] = "publishing"
+                elif namespace_status == "published":
+                    status_data["previewUrl"] = f"/preview/{ticket['ticket_id']}/"
+                    session = state.sessions.get(ticket["session_id"])
+                    if session is not None and session.get("preview_url") != status_data["previewUrl"]:
+                        session["preview_url"] = status_data["previewUrl"]
+                        session_feed.touch(session)
+        return jsonify(status_data)
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -428,13 +983,18 @@ def add_selection():
     if not session:
         return jsonify({"error": "Session not found"}), 404
     
-    session["conversation_log"].append({
+    session_feed.append(session, "conversation_log", {
         "timestamp": datetime.now().isoformat(),
         "type": "selection",
         "data": selection,
         "user_comment": ""
     })
     
+    # 続く /api/chat のためにセレクタ解決・プロンプト部品をバックグラウンドで準備する
+    prewarm = SELECTION_PREWARM and data.get("prewarm", True) is not False
+    if prewarm:
+        selection_prewarmer.schedule(session_id, selection, version_store.current_version(session_id))
+    
     # プロンプトマネージャーから質問文を生成
     auto_question = prompt_manager.get(
         "selection_analysis",
@@ -446,9 +1006,55 @@ def add_selection():
     return jsonify({
         "success": True,
         "selection_id": len(session["conversation_log"]) - 1,
-        "auto_question": auto_question
+        "auto_question": auto_question,
+        "prewarm": prewarm
     })
 
+@app.route("/api/selection/prewarm", methods=["POST"])
+def prewarm_selection():
+    """
+    選択中の要素について /api/chat 用のコンテキストを先に準備する
+
+    会話ログへの記録や変更番号の更新は行わない（選択は /api/chat の送信時に記録される）。
+    """
+    data = request.json or {}
+    session_id = data.get("session_id")
+    selection = data.get("selection")
+
+    if not session_id or not isinstance(selection, dict):
+        return jsonify({"success": False, "error": "session_idとselectionが必要です"}), 400
+    if session_id not in state.sessions:
+        return jsonify({"success": False, "error": "Session not found"}), 404
+
+    scheduled = False
+    if SELECTION_PREWARM:
+        scheduled = selection_prewarmer.schedule(session_id, selection, version_store.current_version(session_id))
+    return jsonify({"success": True, "prewarm": SELECTION_PREWARM, "scheduled": scheduled})
+
+def log_upload(upload):
+    """受信が完了したアップロードを会話ログに記録する"""
+    session = state.sessions.get(upload["session_id"])
+    if not session:
+        return
+    session_feed.append(session, "conversation_log", {
+        "timestamp": datetime.now().isoformat(),
+        "type": "file_upload",
+        "data": {
+            "filename": upload["filename"],
+            "purpose": upload["purpose"],
+            "url": upload["url"],
+            "upload_id": upload["upload_id"],
+            "sha256": upload["sha256"],
+            "size": upload["size"]
+        }
+    })
+
+def upload_response(upload, code=None):
+    """GCSへの転送中（storing）は202、それ以外は200"""
+    if code is None:
+        code = 202 if upload["status"] == "storing" else 200
+    return jsonify({"success": True, "file_url": upload["url"], "upload": upload}), code
+
 @app.route("/api/upload-file", methods=["POST"])
 def upload_file():
     if 'file' not in request.files:
@@ -460,19 +1066,71 @@ def upload_file():
     if not session_id or session_id not in state.sessions:
         return jsonify({"success": False, "error": "有効なセッションIDが必要です"}), 400
     
-    file_url = f"https://storage.googleapis.com/your-bucket/{session_id}/{file.filename}"
+    try:
+        # 受信済みの一時ファイルからチャンク単位で読み、GCSへの転送はバックグラウンドで行う
+        upload = upload_store.put_stream(
+            session_id, file.filename, file.stream,
+            content_type=file.mimetype, purpose=request.form.get('purpose', '')
+        )
+    except UploadError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status
     
-    state.sessions[session_id]["conversation_log"].append({
-        "timestamp": datetime.now().isoformat(),
-        "type": "file_upload",
-        "data": {
-            "filename": file.filename,
-            "purpose": request.form.get('purpose', ''),
-            "url": file_url
-        }
-    })
+    log_upload(upload)
+    return upload_response(upload)
+
+# 再開可能アップロード
+#   POST /api/uploads                 {session_id, filename, size, content_type, purpose, sha256?} で開始
+#   PUT  /api/uploads/<upload_id>     本文を Content-Range: bytes <開始>-<終了>/<全体> 付きで分割送信
+#   GET  /api/uploads/<upload_id>     受信済みの位置（offset）と保存状態を確認して再開する
+@app.route("/api/uploads", methods=["POST"])
+def create_upload():
+    data = request.json or {}
+    session_id = data.get("session_id")
     
-    return jsonify({"success": True, "file_url": file_url})
+    if not session_id or session_id not in state.sessions:
+        return jsonify({"success": False, "error": "有効なセッションIDが必要です"}), 400
+    
+    try:
+        size = int(data["size"]) if data.get("size") is not None else None
+        upload = upload_store.create(
+            session_id, data.get("filename"), size=size,
+            content_type=data.get("content_type"), purpose=data.get("purpose", ""),
+            sha256=data.get("sha256")
+        )
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "size は整数で指定してください"}), 400
+    except UploadError as e:
+        return jsonify({"success": False, "error": str(e)}), e.status
+    
+    if upload["status"] == "stored":
+        log_upload(upload)
+    return upload_response(upload, 201)
+
+@app.route("/api/uploads/<upload_id>", methods=["PUT"])
+def append_upload(upload_id):
+    content_range = request.headers.get("Content-Range", "")
+    match = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range.strip())
+    if content_range and not match:
+        return jsonify({"success": False, "error": "Content-Range の形式が不正です"}), 400
+    offset = int(match.group(1)) if match else 0
+    total = int(match.group(3)) if match and match.group(3) != "*" else None
+    
+    before = upload_store.get(upload_id)
+    try:
+        upload = upload_store.append(upload_id, offset, request.stream, total=total)
+    except UploadError as e:
+        return jsonify({"success": False, "error": str(e), "upload": e.upload}), e.status
+    
+    if before and before["status"] == "uploading" and upload["status"] != "uploading":
+        log_upload(upload)
+    return upload_response(upload)
+
+@app.route("/api/uploads/<upload_id>", methods=["GET"])
+def get_upload(upload_id):
+    upload = upload_store.get(upload_id)
+    if not upload:
+        return jsonify({"success": False, "error": "アップロードが見つかりません"}), 404
+    return upload_response(upload)
 
 @app.route("/api/generate-fix-instructions", methods=["POST"])
 def generate_fix_instructions():
@@ -487,40 +1145,101 @@ def generate_fix_instructions():
         return jsonify({"success": False, "error": "Gemini APIキーが設定されていません"}), 500
     
     try:
-        if not state.gemini_model:
-            state.gemini_model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        
-        # 会話ログを整形
-        conversation_text = "\n".join([
-            f"[{log.get('timestamp', '')}] ユーザー: {log.get('user', '')} / AI: {log.get('ai', '')}"
-            for log in session["conversation_log"]
-            if log.get("type") == "chat"
-        ])
-        
-        # プロンプトマネージャーからプロンプトを取得
-        prompt = prompt_manager.get(
-            "fix_instructions",
-            timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            session_id=session_id,
-            conversation_text=conversation_text
+        # 2回目以降は前回以降の会話ログだけを送って追記する（full=true で全体を作り直す）
+        fix_instructions, generation = fix_instruction_generator.generate(
+            session_id, session, full=bool(data.get("full"))
         )
-        
-        logger.info(f"Generating fix instructions with {len(conversation_text)} chars of conversation")
-        
-        response = state.gemini_model.generate_content(prompt)
-        fix_instructions = response.text if hasattr(response, 'text') else "生成に失敗しました"
-        
-        session.setdefault("fix_instructions", []).append({
-            "instructions": fix_instructions,
-            "generated_at": datetime.now().isoformat()
-        })
-        
-        return jsonify({"success": True, "fix_instructions": fix_instructions})
+        return jsonify({"success": True, "fix_instructions": fix_instructions, "generation": generation})
+    except LLMBusy:
+        raise
     except Exception as e:
         logger.error(f"Fix instructions generation error: {e}")
         traceback.print_exc()
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route("/api/summarize", methods=["POST"])
+def summarize_text():
+    data = request.json or {}
+    text = (data.get("text") or "").strip()
+    session_id = data.get("session_id")
+
+    if not text:
+        return jsonify({"success": False, "error": "要約するテキストがありません"}), 400
+    if len(text) > SUMMARIZE_MAX_INPUT_CHARS:
+        return jsonify({"success": False, "error": f"テキストが長すぎます（{SUMMARIZE_MAX_INPUT_CHARS}文字まで）"}), 400
+    try:
+        max_chars = int(data["max_length"]) if data.get("max_length") is not None else default_max_chars(text)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "max_length は整数で指定してください"}), 400
+    if max_chars <= 0:
+        return jsonify({"success": False, "error": "max_length は1以上で指定してください"}), 400
+
+    # 目標より短いテキストはそのまま返す
+    if len(text) <= max_chars:
+        return jsonify({"success": True, "summary": text, "cached": False, "max_length": max_chars, "latency_ms": 0})
+
+    if not GEMINI_API_KEY:
+        return jsonify({"success": False, "error": "Gemini APIキーが設定されていません"}), 500
+
+    try:
+        if data.get("stream") or "text/event-stream" in request.headers.get("Accept", ""):
+            return stream_summary(text, max_chars, session_id)
+
+        start = time.perf_counter()
+        summary, cached = summarizer.summarize(text, max_chars, session_id)
+        return jsonify({
+            "success": True,
+            "summary": summary,
+            "cached": cached,
+            "max_length": max_chars,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1)
+        })
+    except LLMBusy:
+        raise
+    except EmptySummaryError as e:
+        logger.warning(f"Summarize returned an empty summary for {len(text)} chars")
+        return jsonify({"success": False, "error": str(e)}), 502
+    except Exception as e:
+        logger.error(f"Summarize error: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+def stream_summary(text, max_chars, session_id):
+    """要約をServer-Sent Eventsで逐次返す（キャッシュにあれば1回で返す）"""
+    cached = summarizer.cached(text, max_chars)
+    # 実行枠はここで確保する（混雑時はストリーム開始前に429になる）
+    chunks = [cached] if cached is not None else stream_content(
+        single_prompt(text, max_chars), INTERACTIVE, session_id, operation="summarize")
+    start = time.perf_counter()
+
+    def events():
+        parts = []
+        try:
+            for delta in chunks:
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            logger.error(f"Summarize stream error: {e}")
+            yield f"data: {json.dumps({'success': False, 'error': str(e)}, ensure_ascii=False)}\n\n"
+            return
+        summary = "".join(parts).strip()
+        if not summary:
+            # 空の要約はキャッシュせずエラーとして返す
+            yield f"data: {json.dumps({'success': False, 'error': '要約を生成できませんでした'}, ensure_ascii=False)}\n\n"
+            return
+        if cached is None:
+            summarizer.store(text, max_chars, summary)
+        yield "data: " + json.dumps({
+            "success": True,
+            "done": True,
+            "summary": summary,
+            "cached": cached is not None,
+            "max_length": max_chars,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1)
+        }, ensure_ascii=False) + "\n\n"
+
+    body = events() if cached is not None else ClosingIterator(events(), [chunks.close])
+    return Response(body, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.route("/api/download-word", methods=["POST"])
 def download_word():
     data = request.json
@@ -532,25 +1251,20 @@ def download_word():
     
     fix_instructions = session["fix_instructions"][-1]["instructions"]
     
-    doc = Document()
-    doc.add_heading('修正指示書', 0)
-    
-    soup = BeautifulSoup(fix_instructions, 'html.parser')
-    for element in soup.find_all(['h1', 'h2', 'h3', 'p']):
-        if element.name.startswith('h'):
-            doc.add_heading(element.get_text(), level=int(element.name[1]))
-        else:
-            doc.add_paragraph(element.get_text())
-    
-    file_stream = io.BytesIO()
-    doc.save(file_stream)
-    file_stream.seek(0)
+    try:
+        # 同じ指示書の再ダウンロードはキャッシュから返す
+        docx_bytes, cache_key = word_exporter.export(fix_instructions)
+    except Exception as e:
+        logger.error(f"Word export error: {e}")
+        traceback.print_exc()
+        return jsonify({"success": False, "error": str(e)}), 500
     
     return send_file(
-        file_stream,
+        io.BytesIO(docx_bytes),
         mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
         as_attachment=True,
-        download_name=f'fix_instructions_{datetime.now().strftime("%Y%m%d_%H%M%S")}.docx'
+        download_name=f'fix_instructions_{datetime.now().strftime("%Y%m%d_%H%M%S")}.docx',
+        etag=cache_key
     )
 
 # 管理API:プロンプト再読み込み(テスト用)
@@ -629,11 +1343,12 @@ def synthesize_speech():
         )
         
         # 音声合成実行
-        response = tts_client.synthesize_speech(
-            input=synthesis_input,
-            voice=voice,
-            audio_config=audio_config
-        )
+        with metrics.span("tts", "synthesize"):
+            response = tts_client.synthesize_speech(
+                input=synthesis_input,
+                voice=voice,
+                audio_config=audio_config
+            )
         
         # Base64エンコードして返す
         audio_base64 = base64.b64encode(response.audio_content).decode('utf-8')
@@ -663,7 +1378,8 @@ def list_voices():
         language_code = request.args.get("language_code", "ja-JP")
         
         # 音声一覧を取得
-        response = tts_client.list_voices(language_code=language_code)
+        with metrics.span("tts", "list_voices"):
+            response = tts_client.list_voices(language_code=language_code)
         
         voices = []
         for voice in response.voices:
@@ -706,6 +1422,10 @@ def chat():
 
         if not message:
             return jsonify({"success": False, "error": "メッセージが空です"}), 400
+        if history is None:
+            history = []
+        if not isinstance(history, list) or not all(isinstance(item, dict) for item in history):
+            return jsonify({"success": False, "error": "historyは {role, content} の配列で指定してください"}), 400
 
         # Undoコマンドのチェック（Gemini API呼び出し前）
         undo_patterns = [
@@ -725,73 +1445,45 @@ def chat():
                 "modification": None
             })
 
-        # Gemini API呼び出し
-        try:
-            model = genai.GenerativeModel("gemini-2.0-flash-exp")
-            logger.info("[/api/chat] Gemini model initialized")
-        except Exception as model_error:
-            logger.error(f"[/api/chat] Gemini model initialization error: {model_error}")
-            return jsonify({"success": False, "error": f"Model initialization error: {str(model_error)}"}), 500
-
-        # 選択情報からセレクタを生成
-        selector_override = None
-        if selection and selection.get('textContent'):
-            # クラスやIDがない場合、textContentを使った検索用の特殊セレクタを生成
-            if not selection.get('className') and not selection.get('id'):
-                selector_override = f"__TEXT_CONTENT__{selection['textContent'][:50]}__"
+        # 選択箇所で決まる部分（/api/selection/prewarm などで先に準備されていればそれを使う）
+        prepared = None
+        if SELECTION_PREWARM and session_id and selection:
+            prepared = selection_prewarmer.take(session_id, selection, version_store.current_version(session_id))
+        if prepared is None:
+            prepared = prepare_selection(session_id, selection)
+        resolved_target = prepared["resolved_target"]
+        if resolved_target:
+            logger.info(f"[/api/chat] Selection resolved by {resolved_target['matchedBy']}: {prepared['selector_override']}")
+
+        # サーバー側で保持している会話（クライアントの history はサーバーに会話がないときだけ使う）
+        if session_id and history:
+            conversation_store.seed(session_id, history)
+        context_text = conversation_store.prompt_context(session_id) if session_id else ""
+        context_section = ""
+        if context_text:
+            context_section = f"\nこれまでの会話（この内容から分かることは質問せずに判断してください）:\n{context_text}\n"
 
         # プロンプト構築
-        full_prompt = f"""あなたはHTML修正アシスタントです。ユーザーの修正指示を分析し、以下のJSON形式で返答してください。
-
-**必ず以下のJSON形式で返答してください（マークダウンなし、JSONのみ）:**
-
-{{
-  "action": "immediate" | "question" | "batch",
-  "response": "ユーザーへの返答メッセージ",
-  "modification": {{
-    "selector": "CSSセレクタまたは特殊セレクタ",
-    "type": "fontSize" | "text" | "color" | "background" | "delete",
-    "newValue": "新しい値",
-    "description": "修正内容の説明"
-  }}
-}}
-
-判定基準:
-- immediate: 簡単な修正（サイズ変更、色変更、削除など）
-- question: 不明確な指示、追加情報が必要
-- batch: 複雑な修正、複数箇所の変更
-
-修正タイプ:
-- fontSize: フォントサイズ変更（newValue例: "12.8px"）
-- text: テキスト内容変更
-- color: 文字色変更
-- background: 背景色変更
-- delete: 要素削除（newValueは空文字列""）
-
-フォントサイズ計算（デフォルト16px基準）:
-- 20%小さく → 16px × 0.8 = 12.8px
-- 50%大きく → 16px × 1.5 = 24px
-
-**重要**: 選択情報にclassNameやidがない場合、selectorには以下の形式を使用してください:
-"__TEXT_CONTENT__選択されたテキスト__"
-
-例: {{"selector": "__TEXT_CONTENT__Instagram → (仮称)__", "type": "delete", ...}}
-
+        full_prompt = f"""{CHAT_PROMPT_HEADER}{prepared["resolved_hint"]}{context_section}
 ---
 
 選択情報:
-{json.dumps(selection, ensure_ascii=False, indent=2) if selection else "なし"}
+{prepared["selection_block"]}
 
 ユーザーメッセージ:
 {message}
 
 上記を分析し、JSON形式のみで返答してください（```json``` などのマークダウンは使わないでください）。
 """
+        logger.info(f"[/api/chat] Prompt tokens (estimated): "
+                    f"{prepared['prefix_tokens'] + estimate_tokens(context_section + message)}")
 
         try:
             logger.info("[/api/chat] Calling Gemini API...")
-            response = model.generate_content(full_prompt)
+            response = generate_content(full_prompt, INTERACTIVE, session_id)
             logger.info(f"[/api/chat] Gemini response received: {response.text[:200]}...")
+        except LLMBusy:
+            raise
         except Exception as api_error:
             logger.error(f"[/api/chat] Gemini API call error: {api_error}")
             traceback.print_exc()
@@ -809,15 +1501,28 @@ def chat():
 
             result = json.loads(response_text)
             logger.info(f"[/api/chat] Parsed JSON: {result}")
+
+            # 解決済みの要素があればセレクタとノードパスを確定させる
+            if resolved_target and isinstance(result.get("modification"), dict):
+                result["modification"]["selector"] = resolved_target["selector"]
+                result["modification"]["nodePath"] = resolved_target["nodePath"]
         except json.JSONDecodeError as parse_error:
             logger.error(f"[/api/chat] JSON parse error: {parse_error}")
             logger.error(f"[/api/chat] Response text: {response.text}")
             return jsonify({"success": False, "error": f"Invalid JSON response: {str(parse_error)}"}), 500
         
+        # 会話コンテキストに1往復を追加（要約は必要に応じてバックグラウンドで行う）
+        if session_id:
+            modification = result.get("modification")
+            assistant_text = result.get("response", "")
+            if isinstance(modification, dict) and modification.get("description"):
+                assistant_text += f"（{modification.get('type', '')}: {modification['description']}）"
+            conversation_store.add_exchange(session_id, message, assistant_text)
+
         # セッションに会話ログを記録
         if session_id and session_id in state.sessions:
             session = state.sessions[session_id]
-            session["conversation_log"].append({
+            session_feed.append(session, "conversation_log", {
                 "timestamp": datetime.now().isoformat(),
                 "type": "modification_chat",
                 "user": message,
@@ -827,13 +1532,19 @@ def chat():
                 "selection": selection
             })
         
-        return jsonify({
+        response_data = {
             "success": True,
             "action": result.get("action", "question"),
             "response": result.get("response", ""),
             "modification": result.get("modification")
-        })
+        }
+        # 質問で返す場合は先に求めておいた修正候補を選択肢として添える
+        if response_data["action"] == "question" and prepared.get("intents"):
+            response_data["suggestions"] = prepared["intents"]
+        return jsonify(response_data)
     
+    except LLMBusy:
+        raise
     except Exception as e:
         logger.error(f"チャットエラー: {e}")
         traceback.print_exc()
@@ -850,42 +1561,27 @@ def save_html():
         data = request.json
         html = data.get("html", "")
         modifications = data.get("modifications", [])
+        session_id = data.get("session_id")
         
         if not html:
             return jsonify({"success": False, "error": "HTMLが空です"}), 400
+        if not session_id:
+            return jsonify({"success": False, "error": "session_idが必要です"}), 400
         
-        # GCS設定
-        gcs_bucket = os.getenv("GCS_BUCKET_NAME", "ai-meeting-cloud.appspot.com")
-        
-        # GCSに保存
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(gcs_bucket)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        blob_name = f"modified_html/index_{timestamp}.html"
-        
-        blob = bucket.blob(blob_name)
-        blob.upload_from_string(html, content_type="text/html")
+        # 内容ハッシュで保存（変更がなければ書き込みをスキップ）
+        entry, changed = html_store.save_version(session_id, html, modifications)
         
-        logger.info(f"Modified HTML saved: {blob_name}")
-        
-        # 修正ログも保存
-        log_blob_name = f"modification_logs/log_{timestamp}.json"
-        log_blob = bucket.blob(log_blob_name)
-        log_blob.upload_from_string(
-            json.dumps({
-                "timestamp": timestamp,
-                "modifications": modifications
-            }, ensure_ascii=False, indent=2),
-            content_type="application/json"
-        )
-        
-        logger.info(f"Modification log saved: {log_blob_name}")
+        if changed:
+            logger.info(f"Modified HTML saved: {entry['html_path']} (version {entry['version']})")
         
         return jsonify({
             "success": True,
-            "saved_path": blob_name,
-            "log_path": log_blob_name
+            "saved_path": entry["html_path"],
+            "log_path": entry["log_path"],
+            "manifest_path": html_store.manifest_path(session_id),
+            "version": entry["version"],
+            "html_hash": entry["html_hash"],
+            "unchanged": not changed
         })
     
     except Exception as e:
@@ -896,152 +1592,34 @@ def save_html():
 # ★★★ 新規追加 3: /api/import-site エンドポイント ★★★
 @app.route("/api/import-site", methods=["POST"])
 def import_site():
-    """外部サイトのHTMLをインポート"""
+    """外部サイトのHTMLとアセットをインポート（ジョブとして非同期実行）"""
     try:
         data = request.json
         url = data.get("url", "https://eentry.co.jp")
         
         logger.info(f"Importing site: {url}")
+        job = site_importer.start(url)
         
-        # URLからHTMLを取得
-        response = requests.get(url, timeout=10, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        # wait指定時は従来どおり完了まで待って結果を返す
+        if not data.get("wait"):
+            return jsonify({"success": True, "job_id": job["job_id"], "status": job["status"]}), 202
         
-        if response.status_code == 200:
-            html_content = response.text
-            
-            # 選択検知スクリプトを埋め込む
-            selection_script = """
-<script>
-// ノードのXPathを取得するヘルパー関数
-function getNodePath(node) {
-    const path = [];
-    while (node && node !== document.body) {
-        let index = 0;
-        let sibling = node.previousSibling;
-        while (sibling) {
-            if (sibling.nodeType === node.nodeType) {
-                index++;
-            }
-            sibling = sibling.previousSibling;
-        }
-        path.unshift({
-            nodeType: node.nodeType,
-            nodeName: node.nodeName,
-            index: index
-        });
-        node = node.parentNode;
-    }
-    return path;
-}
-
-// 親ウィンドウに選択情報を送信
-document.addEventListener('mouseup', function() {
-    setTimeout(function() {
-        const selection = window.getSelection();
-        const text = selection.toString().trim();
-        if (text && text.length > 0) {
-            const range = selection.getRangeAt(0);
-
-            // 選択範囲の最も具体的な要素を特定
-            let element;
-            const startContainer = range.startContainer;
-            const endContainer = range.endContainer;
-
-            // 選択範囲が単一のコンテナ内にある場合
-            if (startContainer === endContainer) {
-                if (startContainer.nodeType === 3) {
-                    // テキストノードの場合、親要素を取得
-                    element = startContainer.parentElement;
-                } else {
-                    element = startContainer;
-                }
-            } else {
-                // 複数のコンテナにまたがる場合、共通祖先を使用
-                const container = range.commonAncestorContainer;
-                element = container.nodeType === 3 ? container.parentElement : container;
-            }
-
-            // より具体的なリーフ要素を探す
-            // 要素内のテキストが選択テキストと完全一致する子要素があればそれを使う
-            if (element.children.length > 0) {
-                for (const child of element.children) {
-                    if (child.textContent.trim() === text) {
-                        element = child;
-                        break;
-                    }
-                }
-            }
-
-            // セレクタを生成
-            let selector = element.tagName.toLowerCase();
-            if (element.id) selector += '#' + element.id;
-            if (element.className) selector += '.' + element.className.split(' ').join('.');
-
-            // Range情報を保存（テキスト部分削除用）
-            const rangeInfo = {
-                startOffset: range.startOffset,
-                endOffset: range.endOffset,
-                startContainerPath: getNodePath(range.startContainer),
-                endContainerPath: getNodePath(range.endContainer),
-                spansMultipleElements: startContainer !== endContainer
-            };
-
-            window.parent.postMessage({
-                type: 'text-selected',
-                text: text,
-                tagName: element.tagName,
-                className: element.className,
-                id: element.id,
-                selector: selector,
-                rangeInfo: rangeInfo
-            }, '*');
-
-            console.log('[IFRAME] Selection sent to parent:', text);
-        }
-    }, 10);
-});
-</script>
-"""
-            # </body>の直前にスクリプトを挿入
-            if '</body>' in html_content:
-                html_content = html_content.replace('</body>', selection_script + '</body>')
-            else:
-                # </body>がない場合は末尾に追加
-                html_content += selection_script
-            
-            # GCS設定
-            gcs_bucket = os.getenv("GCS_BUCKET_NAME", "ai-meeting-cloud.appspot.com")
-            
-            # GCSに保存
-            storage_client = storage.Client()
-            bucket = storage_client.bucket(gcs_bucket)
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            blob_name = f"imported_sites/site_{timestamp}.html"
-            
-            blob = bucket.blob(blob_name)
-            blob.upload_from_string(html_content, content_type="text/html")
-            
-            # 公開URL生成
-            blob.make_public()
-            public_url = blob.public_url
-            
-            logger.info(f"Site imported and saved: {blob_name}")
-            
-            return jsonify({
-                "success": True,
-                "preview_url": public_url,
-                "original_url": url,
-                "saved_path": blob_name,
-                "message": "サイトを読み込みました"
-            })
-        else:
+        job = site_importer.wait(job["job_id"], timeout=IMPORT_WAIT_TIMEOUT)
+        if job["status"] != "completed":
             return jsonify({
                 "success": False,
-                "error": f"サイトの取得に失敗: HTTP {response.status_code}"
+                "error": f"サイトの取得に失敗: {job['error']}",
+                "job": job
             }), 400
+        
+        return jsonify({
+            "success": True,
+            "preview_url": job["preview_url"],
+            "original_url": url,
+            "saved_path": job["saved_path"],
+            "job": job,
+            "message": "サイトを読み込みました"
+        })
     
     except Exception as e:
         logger.error(f"サイトインポートエラー: {e}")
@@ -1051,40 +1629,36 @@ document.addEventListener('mouseup', function() {
             "error": str(e)
         }), 500
 
+@app.route("/api/import-site/<job_id>", methods=["GET"])
+def import_site_status(job_id):
+    """インポートジョブの進捗を返す"""
+    job = site_importer.get(job_id)
+    if not job:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, **job})
+
 # ★★★ 新規追加: /static/ 配下のファイル配信エンドポイント ★★★
 @app.route("/static/<path:filename>")
 def serve_static(filename):
-    """staticディレクトリ配下のファイルを配信"""
-    try:
-        static_dir = os.path.join(os.path.dirname(__file__), 'static')
-        file_path = os.path.join(static_dir, filename)
-
-        if not os.path.exists(file_path):
-            logger.error(f"Static file not found: {file_path}")
-            return f"File not found: {filename}", 404
-
-        # Content-Type判定
-        content_type = 'application/octet-stream'
-        if filename.endswith('.js'):
-            content_type = 'application/javascript'
-        elif filename.endswith('.css'):
-            content_type = 'text/css'
-        elif filename.endswith('.html'):
-            content_type = 'text/html'
-        elif filename.endswith('.json'):
-            content_type = 'application/json'
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-
-        logger.info(f"Served static file: /static/{filename}")
-        return Response(content, mimetype=content_type)
-
-    except Exception as e:
-        logger.error(f"Error serving static file {filename}: {e}")
-        return f"Error: {e}", 500
+    """staticディレクトリ配下のファイルを配信（起動時に読み込んだ内容から返す）"""
+    asset = static_index.get(filename)
+    if asset is None:
+        logger.error(f"Static file not found: {filename}")
+        return f"File not found: {filename}", 404
+
+    # 内容ハッシュ付きURL（?v=）で参照された場合は長期キャッシュ、それ以外はETagで再検証
+    version = request.args.get('v')
+    cache_control = IMMUTABLE if version and len(version) >= 12 and asset.etag.startswith(version) else NO_CACHE
+
+    response = cached_response(asset.body(), asset.mimetype, etag=asset.etag,
+                               cache_control=cache_control, variants=asset.variants)
+    if asset.mapped and response.status_code == 200:
+        response.headers["Content-Length"] = str(asset.size)
+    return response
 
 # ルート直下のアセットもプレビューとして処理(CSS未適用問題の対策)
+CATCH_ALL_EXCLUDED = frozenset(['api', 'health', 'metrics', 'chat-message', 'favicon.ico', 'static'])
+
 @app.route("/<path:filename>")
 def catch_all_assets(filename):
     """
@@ -1092,18 +1666,22 @@ def catch_all_assets(filename):
     プレビューエンドポイントに転送
     """
     # 既存のAPIルートと競合しないようにチェック
-    excluded_paths = ['api', 'health', 'chat-message', 'favicon.ico', 'static']
-
-    # パスの最初の部分をチェック
-    first_segment = filename.split('/')[0]
-    if first_segment in excluded_paths:
+    first_segment = filename.partition('/')[0]
+    if first_segment in CATCH_ALL_EXCLUDED:
         return jsonify({"error": "Not found"}), 404
 
     # 静的アセットの拡張子チェック
-    asset_extensions = ['.css', '.js', '.png', '.jpg', '.jpeg', '.svg', '.ico',
-                       '.woff', '.woff2', '.ttf', '.json', '.webp', '.gif']
+    if is_preview_asset(filename):
+        # 名前空間のページから参照された場合はそのビルドのアセットを返す
+        namespace = preview_namespace_from_referer()
+        if namespace:
+            try:
+                response = serve_published_preview(filename, namespace)
+                if response:
+                    return response
+            except Exception as publish_error:
+                logger.warning(f"Failed to serve /{filename} from namespace {namespace}: {publish_error}")
 
-    if any(filename.endswith(ext) for ext in asset_extensions):
         logger.info(f"Asset request redirected: /{filename} -> /preview/{filename}")
         # プレビューエンドポイントに内部転送
         return serve_preview(filename)
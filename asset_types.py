@@ -0,0 +1,58 @@
+"""
+拡張子 → MIMEタイプの対応表（/preview・/static・ルート直下アセットで共通）
+"""
+
+MIME_TYPES = {
+    # ドキュメント
+    "html": "text/html",
+    "htm": "text/html",
+    "txt": "text/plain",
+    "xml": "application/xml",
+    "pdf": "application/pdf",
+    # スクリプト・スタイル・データ
+    "css": "text/css",
+    "js": "application/javascript",
+    "mjs": "application/javascript",
+    "json": "application/json",
+    "map": "application/json",
+    "webmanifest": "application/manifest+json",
+    "wasm": "application/wasm",
+    # 画像
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "svg": "image/svg+xml",
+    "ico": "image/x-icon",
+    # フォント
+    "woff": "font/woff",
+    "woff2": "font/woff2",
+    "ttf": "font/ttf",
+    "otf": "font/otf",
+    "eot": "application/vnd.ms-fontobject",
+    # 音声・動画
+    "mp4": "video/mp4",
+    "webm": "video/webm",
+    "mp3": "audio/mpeg",
+}
+
+# ルート直下へのリクエストのうち、プレビューに転送するアセットの拡張子
+PREVIEW_ASSET_EXTENSIONS = frozenset(MIME_TYPES) - {"html", "htm", "txt", "xml", "pdf"}
+
+
+def extension_of(path):
+    """最後の「.」以降を小文字で返す（ディレクトリ名の「.」は無視）"""
+    _, dot, ext = path.rpartition(".")
+    if not dot or "/" in ext:
+        return ""
+    return ext.lower()
+
+
+def mimetype_for(path, default="application/octet-stream"):
+    return MIME_TYPES.get(extension_of(path), default)
+
+
+def is_preview_asset(path):
+    return extension_of(path) in PREVIEW_ASSET_EXTENSIONS
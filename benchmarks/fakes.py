@@ -0,0 +1,388 @@
+"""
+ベンチマーク用のローカル代替実装（GCS・Gemini・Google TTS・Astroビルダー・取得元サイト）
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import PreconditionFailed
+
+
+# ----------------------------------------------------------------------
+# GCS（ファイルシステム上に保存）
+# ----------------------------------------------------------------------
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_encoding = None
+        self.cache_control = None
+        self.content_type = None
+
+    @property
+    def _path(self):
+        return os.path.join(self.bucket.root, self.name)
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    @property
+    def md5_hash(self):
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path, "rb") as f:
+            return base64.b64encode(hashlib.md5(f.read()).digest()).decode("ascii")
+
+    @property
+    def generation(self):
+        if not os.path.exists(self._path):
+            return None
+        return self.bucket.metadata.get(self.name, {}).get("generation", 1)
+
+    @property
+    def size(self):
+        return os.path.getsize(self._path) if os.path.exists(self._path) else None
+
+    def exists(self):
+        self.bucket.wait()
+        return os.path.exists(self._path)
+
+    def reload(self):
+        self.bucket.wait()
+        meta = self.bucket.metadata.get(self.name, {})
+        self.content_type = meta.get("content_type")
+        self.content_encoding = meta.get("content_encoding")
+        self.cache_control = meta.get("cache_control")
+
+    def download_as_bytes(self, raw_download=False, **kwargs):
+        self.bucket.wait()
+        with open(self._path, "rb") as f:
+            data = f.read()
+        meta = self.bucket.metadata.get(self.name, {})
+        # 実際のGCSと同様に gzip 保存されたオブジェクトは展開して返す
+        if meta.get("content_encoding") == "gzip" and not raw_download:
+            data = gzip.decompress(data)
+        return data
+
+    def upload_from_string(self, data, content_type=None, predefined_acl=None, if_generation_match=None):
+        self.bucket.wait()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.bucket.client._lock:
+            # 実際のGCSと同様に世代番号の前提条件を確認する（0 は「存在しないこと」）
+            current = self.generation or 0
+            if if_generation_match is not None and if_generation_match != current:
+                raise PreconditionFailed(f"{self.name}: generation {current} != {if_generation_match}")
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path, "wb") as f:
+                f.write(data)
+            self.content_type = content_type
+            self.bucket.metadata[self.name] = {
+                "content_type": content_type,
+                "content_encoding": self.content_encoding,
+                "cache_control": self.cache_control,
+                "generation": current + 1,
+            }
+
+    def upload_from_file(self, file_obj, content_type=None, **kwargs):
+        self.upload_from_string(file_obj.read(), content_type=content_type,
+                                if_generation_match=kwargs.get("if_generation_match"))
+
+    def upload_from_filename(self, filename, content_type=None, **kwargs):
+        self.bucket.wait()
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        shutil.copyfile(filename, self._path)
+        self.content_type = content_type
+        self.bucket.metadata[self.name] = {
+            "content_type": content_type,
+            "content_encoding": self.content_encoding,
+            "cache_control": self.cache_control,
+        }
+
+    def make_public(self):
+        self.bucket.wait()
+
+    def delete(self):
+        self.bucket.wait()
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self.bucket.metadata.pop(self.name, None)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.root = os.path.join(client.root, name)
+        self.metadata = client.metadata.setdefault(name, {})
+        os.makedirs(self.root, exist_ok=True)
+
+    def wait(self):
+        if self.client.latency:
+            time.sleep(self.client.latency)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def copy_blob(self, blob, destination_bucket, new_name=None):
+        self.wait()
+        copied = FakeBlob(destination_bucket, new_name or blob.name)
+        os.makedirs(os.path.dirname(copied._path), exist_ok=True)
+        with open(blob._path, "rb") as src, open(copied._path, "wb") as dst:
+            dst.write(src.read())
+        destination_bucket.metadata[copied.name] = dict(self.metadata.get(blob.name, {}))
+        return copied
+
+    def get_blob(self, name):
+        blob = FakeBlob(self, name)
+        return blob if blob.exists() else None
+
+    def list_blobs(self, prefix=""):
+        self.wait()
+        blobs = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    blobs.append(FakeBlob(self, name))
+        return blobs
+
+
+class FakeStorageClient:
+    """storage.Client() の代わり（root ディレクトリ配下にバケットごとに保存）"""
+
+    def __init__(self, root, latency=0.0):
+        self.root = root
+        self.latency = latency
+        self.metadata = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(self, name)
+            return self._buckets[name]
+
+    def list_blobs(self, bucket_or_name, prefix=""):
+        name = bucket_or_name if isinstance(bucket_or_name, str) else bucket_or_name.name
+        return self.bucket(name).list_blobs(prefix=prefix)
+
+
+class FakeStorageModule:
+    """google.cloud.storage モジュールの代わり（Client() が共有クライアントを返す）"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def Client(self, *args, **kwargs):
+        return self._client
+
+
+# ----------------------------------------------------------------------
+# Gemini
+# ----------------------------------------------------------------------
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """genai.GenerativeModel の代わり（固定応答 + 指定レイテンシ）"""
+
+    latency = 0.2
+    calls = 0
+    _lock = threading.Lock()
+
+    def __init__(self, model_name=None, **kwargs):
+        self.model_name = model_name
+
+    @classmethod
+    def respond(cls, prompt):
+        with cls._lock:
+            cls.calls += 1
+        if "JSON配列" in prompt:
+            count = len(re.findall(r"【文章\d+】", prompt))
+            return json.dumps([f"要約{i}" for i in range(1, count + 1)], ensure_ascii=False)
+        if "依頼しそうな修正" in prompt:
+            return "文字サイズを小さくする\n文字色を変える\n削除する"
+        if "追加された会話ログ" in prompt:
+            # 節の一覧があれば最後の節に追記し、なければ新しい節を作る
+            sections = re.findall(r"^\[(s\d+)\]", prompt, re.MULTILINE)
+            patch = {"section": sections[-1], "op": "append"} if sections else {"section": "new", "title": "追加の修正"}
+            patch["html"] = "<ul><li>見出しの文字サイズをさらに20%小さくする。</li></ul>"
+            return json.dumps([patch], ensure_ascii=False)
+        if "要約" in prompt and "JSON形式" not in prompt:
+            return "見出しの文字サイズを20%小さくする修正を続けて依頼している。"
+        if "JSON形式" in prompt:
+            return json.dumps({
+                "action": "immediate",
+                "response": "文字サイズを小さくしました",
+                "modification": {
+                    "selector": "__TEXT_CONTENT__サンプル__",
+                    "type": "fontSize",
+                    "newValue": "12.8px",
+                    "description": "20%小さく"
+                }
+            }, ensure_ascii=False)
+        return "<h1>修正指示書</h1><p>見出しの文字サイズを20%小さくする。</p><ul><li>トップページ</li></ul>"
+
+    def generate_content(self, prompt, stream=False, **kwargs):
+        text = self.respond(prompt if isinstance(prompt, str) else json.dumps(prompt, ensure_ascii=False))
+        if stream:
+            # ストリーミング時は最初のチャンクまでに半分、残りで半分の時間をかける
+            half = len(text) // 2
+
+            def chunks():
+                time.sleep(self.latency / 2)
+                yield FakeResponse(text[:half])
+                time.sleep(self.latency / 2)
+                yield FakeResponse(text[half:])
+            return chunks()
+        time.sleep(self.latency)
+        return FakeResponse(text)
+
+    def count_tokens(self, prompt):
+        class Count:
+            total_tokens = len(prompt) // 2
+        return Count()
+
+
+# ----------------------------------------------------------------------
+# Google Cloud TTS
+# ----------------------------------------------------------------------
+
+class FakeTTSClient:
+    def __init__(self, latency=0.1, bytes_per_char=600):
+        self.latency = latency
+        self.bytes_per_char = bytes_per_char
+
+    def synthesize_speech(self, input=None, voice=None, audio_config=None, **kwargs):
+        time.sleep(self.latency)
+
+        class Result:
+            pass
+        result = Result()
+        result.audio_content = b"\xff\xfb" * (len(input.text) * self.bytes_per_char // 2)
+        return result
+
+    def list_voices(self, language_code=None):
+        class Voices:
+            voices = []
+        return Voices()
+
+
+# ----------------------------------------------------------------------
+# Astroビルダー + 取得元サイト（ローカルHTTPサーバー）
+# ----------------------------------------------------------------------
+
+class UpstreamServer:
+    """
+    ビルダーAPI（POST /build, GET /build/<id>）と取得元サイト（/ と /assets/...）を提供する
+    """
+
+    def __init__(self, asset_count=20, builder_latency=0.05, build_seconds=1.0, origin_latency=0.02):
+        self.asset_count = asset_count
+        self.builder_latency = builder_latency
+        self.build_seconds = build_seconds
+        self.origin_latency = origin_latency
+        self.jobs = {}
+        self.build_requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def index_html(self):
+        links = "\n".join(
+            f'<link rel="stylesheet" href="/assets/style_{i}.css">' for i in range(self.asset_count)
+        )
+        paragraphs = "\n".join(f"<p>サンプル段落 {i}</p>" for i in range(200))
+        return (f"<!DOCTYPE html><html><head><meta charset=\"utf-8\">{links}</head>"
+                f"<body><h1 class=\"title\">サンプル</h1>{paragraphs}</body></html>")
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type):
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.path == "/build":
+                    time.sleep(upstream.builder_latency)
+                    job_id = uuid.uuid4().hex
+                    with upstream._lock:
+                        upstream.jobs[job_id] = time.monotonic()
+                        upstream.build_requests += 1
+                    response = {"success": True, "jobId": job_id, "status": "queued"}
+                    # ビルドごとの出力先の指定に応じたことを返す
+                    output_path = (json.loads(body or b"{}") or {}).get("outputPath")
+                    if output_path:
+                        response["outputPath"] = output_path
+                    self._send(200, json.dumps(response), "application/json")
+                else:
+                    self._send(404, "not found", "text/plain")
+
+            def do_GET(self):
+                if self.path.startswith("/build/"):
+                    time.sleep(upstream.builder_latency)
+                    started = upstream.jobs.get(self.path.rsplit("/", 1)[-1])
+                    if started is None:
+                        self._send(404, json.dumps({"success": False, "error": "unknown job"}),
+                                   "application/json")
+                        return
+                    done = time.monotonic() - started >= upstream.build_seconds
+                    self._send(200, json.dumps({
+                        "success": True,
+                        "status": "completed" if done else "building",
+                        "deployUrl": f"{upstream.url}/" if done else None,
+                    }), "application/json")
+                    return
+
+                time.sleep(upstream.origin_latency)
+                path = self.path.split("?")[0]
+                if path in ("/", "/index.html"):
+                    self._send(200, upstream.index_html(), "text/html; charset=utf-8")
+                elif path.startswith("/assets/") and path.endswith(".css"):
+                    self._send(200, "body{margin:0}\n" * 200, "text/css")
+                else:
+                    self._send(404, "not found", "text/plain")
+
+        return Handler
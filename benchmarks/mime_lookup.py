@@ -0,0 +1,115 @@
+"""
+アセットのMIME判定・転送判定のマイクロベンチマーク
+
+以前の endswith による if/elif 連鎖とリスト走査と、asset_types の表引きを
+同じパス集合（既定 10,000件）で比較する。
+
+    python benchmarks/mime_lookup.py
+    python benchmarks/mime_lookup.py --count 10000 --repeat 20
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from asset_types import is_preview_asset, mimetype_for  # noqa: E402
+
+SAMPLE_EXTENSIONS = ["css", "js", "png", "jpg", "svg", "woff2", "woff", "webp", "avif",
+                     "map", "mp4", "json", "ico", "gif", "ttf", "html", ""]
+SEGMENTS = ["_astro", "assets", "images", "fonts", "api", "static", "blog"]
+
+LEGACY_EXCLUDED = ['api', 'health', 'metrics', 'chat-message', 'favicon.ico', 'static']
+LEGACY_EXTENSIONS = ['.css', '.js', '.png', '.jpg', '.jpeg', '.svg', '.ico',
+                     '.woff', '.woff2', '.ttf', '.json', '.webp', '.gif']
+
+
+def legacy_content_type(filename):
+    """変更前の serve_preview の判定"""
+    content_type = 'text/html'
+    if filename.endswith('.css'):
+        content_type = 'text/css'
+    elif filename.endswith('.js'):
+        content_type = 'application/javascript'
+    elif filename.endswith('.json'):
+        content_type = 'application/json'
+    elif filename.endswith('.png'):
+        content_type = 'image/png'
+    elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
+        content_type = 'image/jpeg'
+    elif filename.endswith('.svg'):
+        content_type = 'image/svg+xml'
+    elif filename.endswith('.woff') or filename.endswith('.woff2'):
+        content_type = 'font/woff2'
+    elif filename.endswith('.ttf'):
+        content_type = 'font/ttf'
+    elif filename.endswith('.ico'):
+        content_type = 'image/x-icon'
+    elif filename.endswith('.webp'):
+        content_type = 'image/webp'
+    elif filename.endswith('.gif'):
+        content_type = 'image/gif'
+    return content_type
+
+
+def legacy_resolve(filename):
+    """変更前の catch_all_assets + serve_preview の判定"""
+    if filename.split('/')[0] in LEGACY_EXCLUDED:
+        return None
+    if any(filename.endswith(ext) for ext in LEGACY_EXTENSIONS):
+        return legacy_content_type(filename)
+    return None
+
+
+def table_resolve(filename):
+    """asset_types による判定"""
+    if filename.partition('/')[0] in LEGACY_EXCLUDED:
+        return None
+    if is_preview_asset(filename):
+        return mimetype_for(filename, default='text/html')
+    return None
+
+
+def make_paths(count, seed):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        ext = rng.choice(SAMPLE_EXTENSIONS)
+        name = f"{rng.choice(SEGMENTS)}/file_{i}" + (f".{ext}" if ext else "")
+        paths.append(name)
+    return paths
+
+
+def measure(func, paths, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=10000, help="判定するパス数")
+    parser.add_argument("--repeat", type=int, default=20, help="繰り返し回数（最速値を採用）")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    paths = make_paths(args.count, args.seed)
+    legacy = measure(legacy_resolve, paths, args.repeat)
+    table = measure(table_resolve, paths, args.repeat)
+
+    print(f"{'resolver':<10} {'total':>10} {'per call':>12}")
+    for name, seconds in (("legacy", legacy), ("table", table)):
+        print(f"{name:<10} {seconds * 1000:>8.2f}ms {seconds / args.count * 1e9:>10.0f}ns")
+    print(f"speedup: {legacy / table:.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+"""
+負荷試験・ベンチマーク
+
+Flaskアプリをローカルの代替実装（benchmarks/fakes.py）につないで起動し、
+プレビュー表示・/api/chat 連続修正・TTS再生・ビルド状態ポーリングを混ぜた負荷をかけて
+ルートごとのスループットとレイテンシ分位点を出力する。
+
+    python benchmarks/run.py                         # 既定の負荷で実行して baselines.json と比較
+    python benchmarks/run.py --save-baseline         # 結果を baselines.json に保存
+    python benchmarks/run.py --scenarios chat --duration 5 --concurrency 16
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import (FakeGenerativeModel, FakeStorageClient, FakeStorageModule,  # noqa: E402
+                   FakeTTSClient, UpstreamServer)
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baselines.json")
+SCENARIO_WEIGHTS = {"preview": 2, "chat": 4, "tts": 2, "build": 1, "fix": 1, "summarize": 2, "select_edit": 2}
+# ベースラインの計測対象（fix・summarize・select_edit は --scenarios chat,fix のように明示したときだけ実行する）
+DEFAULT_SCENARIOS = "preview,chat,tts,build"
+
+
+# ----------------------------------------------------------------------
+# 計測結果の集計
+# ----------------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}   # route -> [(秒, 成功したか, バイト数)]
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok, size):
+        with self._lock:
+            self.samples.setdefault(route, []).append((seconds, ok, size))
+
+    def timed(self, session, route, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=60, **kwargs)
+            ok = response.status_code < 400 or response.status_code == 304
+            self.record(route, time.perf_counter() - start, ok, len(response.content))
+            return response
+        except requests.RequestException:
+            self.record(route, time.perf_counter() - start, False, 0)
+            return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(recorder, elapsed):
+    report = {}
+    for route, samples in sorted(recorder.samples.items()):
+        latencies = sorted(s[0] for s in samples)
+        report[route] = {
+            "count": len(samples),
+            "errors": sum(1 for s in samples if not s[1]),
+            "rps": round(len(samples) / elapsed, 2),
+            "mean_ms": round(1000 * sum(latencies) / len(latencies), 2),
+            "p50_ms": round(1000 * percentile(latencies, 0.50), 2),
+            "p90_ms": round(1000 * percentile(latencies, 0.90), 2),
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+            "max_ms": round(1000 * latencies[-1], 2),
+            "avg_bytes": int(sum(s[2] for s in samples) / len(samples)),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance, slack_ms):
+    """ベースラインより悪化したルートの一覧を返す"""
+    regressions = []
+    for route, base in baseline.get("routes", {}).items():
+        current = report.get(route)
+        if current is None:
+            continue
+        for key in ("p50_ms", "p99_ms"):
+            limit = base[key] * (1 + tolerance) + slack_ms
+            if current[key] > limit:
+                regressions.append(f"{route} {key}: {current[key]}ms > {limit:.1f}ms (baseline {base[key]}ms)")
+        if current["errors"] > base.get("errors", 0):
+            regressions.append(f"{route} errors: {current['errors']} > {base.get('errors', 0)}")
+    return regressions
+
+
+# ----------------------------------------------------------------------
+# アプリの起動
+# ----------------------------------------------------------------------
+
+def install_fakes(app_module, args, storage_root):
+    """アプリの外部依存をローカル代替実装に差し替える"""
+    app_module.storage = FakeStorageModule(FakeStorageClient(storage_root, latency=args.gcs_latency))
+    FakeGenerativeModel.latency = args.llm_latency
+    app_module.genai.GenerativeModel = FakeGenerativeModel
+    app_module.state.gemini_model = None
+    app_module.tts_client = FakeTTSClient(latency=args.tts_latency)
+    app_module.app.services_initialized = True
+
+    upstream = UpstreamServer(asset_count=args.assets, builder_latency=args.builder_latency,
+                              build_seconds=args.build_seconds, origin_latency=args.origin_latency).start()
+    app_module.ASTRO_BUILD_SERVICE_URL = upstream.url
+    app_module.DEFAULT_PREVIEW_URL = upstream.url
+    app_module.build_scheduler.coalesce_seconds = args.build_coalesce
+    app_module.SELECTION_PREWARM = not args.no_prewarm
+    return upstream
+
+
+def start_app(app_module):
+    from werkzeug.serving import make_server
+
+    server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+# ----------------------------------------------------------------------
+# シナリオ
+# ----------------------------------------------------------------------
+
+def create_session(session, base_url):
+    """セッションを作成し、ブラウザと同様に読み込んだページを初期バージョンとして記録する"""
+    response = session.post(f"{base_url}/api/sessions", json={"caseType": "renewal"}, timeout=30)
+    session_id = response.json()["sessionId"]
+    page = session.get(f"{base_url}/preview/", timeout=30)
+    session.post(f"{base_url}/api/sessions/{session_id}/versions",
+                 json={"html": page.text, "description": "初期状態"}, timeout=30)
+    return session_id
+
+
+def scenario_preview(ctx):
+    """プレビューのHTMLと参照アセットを読み込む"""
+    ctx.rec.timed(ctx.http, "GET /preview/", "GET", f"{ctx.base_url}/preview/")
+    for i in range(ctx.args.assets):
+        ctx.rec.timed(ctx.http, "GET /<asset>", "GET", f"{ctx.base_url}/assets/style_{i}.css")
+
+
+def scenario_chat(ctx):
+    """選択箇所に対する修正指示を連続で送る"""
+    selection = {"tagName": "P", "className": "", "id": "", "textContent": "サンプル段落 3"}
+    for i in range(ctx.args.chat_burst):
+        ctx.rec.timed(ctx.http, "POST /api/chat", "POST", f"{ctx.base_url}/api/chat", json={
+            "message": "20%小さくして", "session_id": ctx.session_id, "selection": selection,
+        })
+
+
+def scenario_tts(ctx):
+    """応答メッセージを音声合成する"""
+    ctx.rec.timed(ctx.http, "POST /api/tts/synthesize", "POST", f"{ctx.base_url}/api/tts/synthesize",
+                  json={"text": "文字サイズを小さくしました。" * 5})
+
+
+def scenario_fix(ctx):
+    """修正依頼を1件送ってから修正指示書を更新する（2回目以降は追加分だけを生成）"""
+    ctx.rec.timed(ctx.http, "POST /api/chat", "POST", f"{ctx.base_url}/api/chat", json={
+        "message": "見出しをもう少し小さくして", "session_id": ctx.session_id,
+    })
+    ctx.rec.timed(ctx.http, "POST /api/generate-fix-instructions", "POST",
+                  f"{ctx.base_url}/api/generate-fix-instructions", json={"session_id": ctx.session_id})
+
+
+def scenario_summarize(ctx):
+    """段落の要約を要求する（共通の段落はキャッシュ、セッション固有の段落はまとめて生成される）"""
+    shared = f"サンプル段落 {ctx.random.randrange(5)} の本文です。" * 10
+    for text in (shared, f"{ctx.session_id} の段落です。" * 10):
+        ctx.rec.timed(ctx.http, "POST /api/summarize", "POST", f"{ctx.base_url}/api/summarize",
+                      json={"text": text, "session_id": ctx.session_id})
+
+
+def scenario_select_edit(ctx):
+    """修正を反映した新しい版を記録し、要素を選択してから入力時間をおいて修正を送る"""
+    if ctx.page_html is None:
+        ctx.page_html = ctx.http.get(f"{ctx.base_url}/preview/", timeout=30).text
+    ctx.edits += 1
+    ctx.http.post(f"{ctx.base_url}/api/sessions/{ctx.session_id}/versions", json={
+        "html": ctx.page_html.replace("</body>", f"<!-- edit {ctx.edits} --></body>"),
+        "description": f"修正 {ctx.edits}",
+    }, timeout=30)
+    selection = {"tagName": "P", "className": "", "id": "",
+                 "textContent": f"サンプル段落 {ctx.random.randrange(200)}"}
+    ctx.rec.timed(ctx.http, "POST /api/selection/prewarm", "POST", f"{ctx.base_url}/api/selection/prewarm",
+                  json={"session_id": ctx.session_id, "selection": selection})
+    time.sleep(ctx.args.think_time)
+    ctx.rec.timed(ctx.http, "POST /api/chat (after selection)", "POST", f"{ctx.base_url}/api/chat", json={
+        "message": "20%小さくして", "session_id": ctx.session_id, "selection": selection,
+    })
+
+
+def scenario_build(ctx):
+    """ビルドを開始して完了までポーリングする"""
+    response = ctx.rec.timed(ctx.http, "POST /api/trigger-build", "POST", f"{ctx.base_url}/api/trigger-build",
+                             json={"session_id": ctx.session_id, "diffData": {"changes": []}})
+    if response is None or not response.ok:
+        return
+    job_id = response.json().get("jobId")
+    deadline = time.monotonic() + ctx.args.build_seconds * 10 + 10
+    while time.monotonic() < deadline:
+        time.sleep(ctx.args.poll_interval)
+        status = ctx.rec.timed(ctx.http, "GET /api/build-status/<job_id>", "GET",
+                               f"{ctx.base_url}/api/build-status/{job_id}")
+        if status is None or not status.ok:
+            return
+        data = status.json()
+        if data.get("status") == "superseded" and data.get("supersededBy"):
+            job_id = data["supersededBy"]
+        elif data.get("status") in ("completed", "failed", "timeout"):
+            return
+
+
+SCENARIOS = {
+    "preview": scenario_preview,
+    "chat": scenario_chat,
+    "tts": scenario_tts,
+    "build": scenario_build,
+    "fix": scenario_fix,
+    "summarize": scenario_summarize,
+    "select_edit": scenario_select_edit,
+}
+
+
+class WorkerContext:
+    def __init__(self, args, base_url, recorder, seed):
+        self.args = args
+        self.base_url = base_url
+        self.rec = recorder
+        self.http = requests.Session()
+        self.random = random.Random(seed)
+        self.session_id = create_session(self.http, base_url)
+        self.page_html = None
+        self.edits = 0
+
+
+def run_worker(args, base_url, recorder, names, weights, seed, deadline):
+    ctx = WorkerContext(args, base_url, recorder, seed)
+    while time.monotonic() < deadline:
+        name = ctx.random.choices(names, weights=weights)[0]
+        SCENARIOS[name](ctx)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS,
+                        help="実行するシナリオ（カンマ区切り）")
+    parser.add_argument("--duration", type=float, default=10.0, help="計測時間（秒）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時実行ユーザー数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--assets", type=int, default=20, help="プレビューが参照するアセット数")
+    parser.add_argument("--chat-burst", type=int, default=3, help="1回のchatシナリオで送る修正数")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--gcs-latency", type=float, default=0.005)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--tts-latency", type=float, default=0.1)
+    parser.add_argument("--builder-latency", type=float, default=0.02)
+    parser.add_argument("--origin-latency", type=float, default=0.02)
+    parser.add_argument("--build-seconds", type=float, default=1.0)
+    parser.add_argument("--build-coalesce", type=float, default=0.2)
+    parser.add_argument("--think-time", type=float, default=0.3,
+                        help="select_edit で要素を選択してから修正を送るまでの秒数")
+    parser.add_argument("--no-prewarm", action="store_true",
+                        help="選択時のプロンプト部品の先行準備を無効にする（select_edit の比較用）")
+    parser.add_argument("--output", help="結果JSONの出力先")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="比較するベースラインJSON")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する悪化率")
+    parser.add_argument("--slack-ms", type=float, default=5.0, help="許容する悪化の絶対値（ミリ秒）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    import app_hp_support
+
+    # アプリ・werkzeugのアクセスログは計測の邪魔になるので抑制する
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    names = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        print(f"unknown scenarios: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+    weights = [SCENARIO_WEIGHTS[name] for name in names]
+
+    with tempfile.TemporaryDirectory(prefix="hp-bench-") as storage_root:
+        upstream = install_fakes(app_hp_support, args, storage_root)
+        server, base_url = start_app(app_hp_support)
+        recorder = Recorder()
+        try:
+            start = time.monotonic()
+            deadline = start + args.duration
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                futures = [
+                    pool.submit(run_worker, args, base_url, recorder, names, weights, args.seed + i, deadline)
+                    for i in range(args.concurrency)
+                ]
+                for future in futures:
+                    future.result()
+            elapsed = time.monotonic() - start
+        finally:
+            server.shutdown()
+            upstream.stop()
+
+    report = summarize(recorder, elapsed)
+    result = {
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("output", "baseline", "save_baseline", "tolerance", "slack_ms")},
+        "elapsed_seconds": round(elapsed, 2),
+        "upstream": {"llm_calls": FakeGenerativeModel.calls, "builder_builds": upstream.build_requests},
+        "routes": report,
+    }
+
+    print(f"{'route':36} {'count':>7} {'err':>5} {'rps':>8} {'p50':>9} {'p90':>9} {'p99':>9}")
+    for route, row in report.items():
+        print(f"{route:36} {row['count']:>7} {row['errors']:>5} {row['rps']:>8} "
+              f"{row['p50_ms']:>8}ms {row['p90_ms']:>8}ms {row['p99_ms']:>8}ms")
+    print(f"upstream: {result['upstream']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved: {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != result["config"]:
+            print("baseline config differs; comparison skipped")
+            return 0
+        regressions = compare(report, baseline, args.tolerance, args.slack_ms)
+        if regressions:
+            print("REGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("no regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+ビルドスケジューラ（セッション単位のデバウンス・合流・同時実行制御）
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# ビルダーへ送信済みで、まだ結果が確定していない状態（publishing は完了後の公開処理中。実行枠を保持する）
+ACTIVE_STATUSES = ("dispatching", "running", "publishing")
+# これ以上状態が変化しない状態
+TERMINAL_STATUSES = ("completed", "failed", "superseded", "timeout")
+
+
+class BuildScheduler:
+    """
+    ビルド要求をセッション単位でまとめてからビルダーへ送信する
+
+    - coalesce_seconds 以内の連続トリガーは同じチケットに合流（最後の diffData を採用）
+    - 待機中チケットに新しいトリガーが来た場合は古いチケットを superseded にする
+    - 同時実行数をセッション単位・全体でそれぞれ制限する
+    - poll を渡すと、クライアントが状態を取得しなくても実行中のビルドを poll_interval ごとに確認し、
+      終了していれば実行枠を解放する
+    """
+
+    def __init__(self, dispatch, coalesce_seconds=2.0, max_per_session=1,
+                 max_global=4, run_timeout=600, retention_seconds=3600, on_complete=None,
+                 poll=None, poll_interval=5.0):
+        # dispatch(session_id, diff_data, ticket_id) -> ビルダーのレスポンス(dict)
+        # on_complete(チケット) -> ビルド完了を最初に確認したときに呼ばれる
+        #   Future を返した場合は、それが終わるまで publishing として実行枠を保持する
+        #   （共有の出力先を次のビルドが上書きする前に公開を終えるため）
+        # poll(job_id) -> (状態, エラー) ビルダーから現在の状態を取得する
+        self._dispatch = dispatch
+        self._on_complete = on_complete
+        self._poll = poll
+        self.poll_interval = poll_interval
+        self.coalesce_seconds = coalesce_seconds
+        self.max_per_session = max_per_session
+        self.max_global = max_global
+        self.run_timeout = run_timeout
+        self.retention_seconds = retention_seconds
+
+        self._cond = threading.Condition()
+        self._tickets = {}        # ticket_id -> チケット
+        self._job_index = {}      # ビルダーのjobId -> ticket_id
+        self._queued = {}         # session_id -> 待機中のticket_id
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_global),
+                                            thread_name_prefix="build-dispatch")
+        self._poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="build-poll") if poll else None
+        self._worker = None
+
+    def trigger(self, session_id, diff_data):
+        """ビルド要求を受け付け、(チケット, 合流したかどうか) を返す"""
+        now = time.monotonic()
+        with self._cond:
+            self._ensure_worker()
+
+            queued_id = self._queued.get(session_id)
+            queued = self._tickets.get(queued_id) if queued_id else None
+
+            # 合流ウィンドウ内: 同じチケットにまとめて送信を後ろ倒しにする
+            if queued and now - queued["last_trigger"] < self.coalesce_seconds:
+                queued["diff_data"] = diff_data
+                queued["last_trigger"] = now
+                queued["due_at"] = now + self.coalesce_seconds
+                queued["trigger_count"] += 1
+                self._cond.notify_all()
+                return self._public(queued), True
+
+            ticket = {
+                "ticket_id": f"build-{uuid.uuid4().hex[:12]}",
+                "session_id": session_id,
+                "diff_data": diff_data,
+                "status": "queued",
+                "triggered_at": datetime.now().isoformat(),
+                "trigger_count": 1,
+                "last_trigger": now,
+                "due_at": now + self.coalesce_seconds,
+                "started_at": None,
+                "finished_at": None,
+                "job_id": None,
+                "build_data": None,
+                "superseded_by": None,
+                "error": None,
+                "checked_at": None,
+                "publishing_at": None,
+                "polling": False,
+            }
+
+            # 合流ウィンドウ外だがまだ送信されていない: 古い方を置き換える
+            if queued:
+                queued["status"] = "superseded"
+                queued["superseded_by"] = ticket["ticket_id"]
+                queued["finished_at"] = now
+                logger.info(f"Build {queued['ticket_id']} superseded by {ticket['ticket_id']}")
+
+            self._tickets[ticket["ticket_id"]] = ticket
+            self._queued[session_id] = ticket["ticket_id"]
+            self._cond.notify_all()
+            return self._public(ticket), False
+
+    def get(self, ticket_or_job_id):
+        """チケットIDまたはビルダーのjobIdからチケットを取得"""
+        with self._cond:
+            ticket = self._lookup(ticket_or_job_id)
+            return self._public(ticket) if ticket else None
+
+    def update_status(self, ticket_or_job_id, status, error=None):
+        """ビルダーから取得した状態を反映し、終了していれば実行枠を解放する"""
+        with self._cond:
+            ticket = self._lookup(ticket_or_job_id)
+            if not ticket or ticket["status"] not in ACTIVE_STATUSES:
+                return
+            ticket["checked_at"] = time.monotonic()
+            if ticket["status"] == "publishing" or status not in ("completed", "failed"):
+                return
+            ticket["error"] = error
+            completed = None
+            if status == "completed" and self._on_complete:
+                ticket["status"] = "publishing"
+                ticket["publishing_at"] = time.monotonic()
+                completed = self._public(ticket)
+            else:
+                ticket["status"] = status
+                ticket["finished_at"] = time.monotonic()
+            self._cond.notify_all()
+
+        if completed is None:
+            return
+        try:
+            result = self._on_complete(completed)
+        except Exception as e:
+            logger.error(f"Build completion hook failed for {completed['ticket_id']}: {e}")
+            result = None
+        if hasattr(result, "add_done_callback"):
+            result.add_done_callback(lambda _: self._finish_publishing(ticket))
+        else:
+            self._finish_publishing(ticket)
+
+    def _finish_publishing(self, ticket):
+        with self._cond:
+            if ticket["status"] == "publishing":
+                ticket["status"] = "completed"
+                ticket["finished_at"] = time.monotonic()
+                self._cond.notify_all()
+
+    def session_snapshot(self, session_id):
+        """セッションのチケット一覧と全体の実行状況を返す"""
+        with self._cond:
+            tickets = [self._public(t) for t in self._tickets.values()
+                       if t["session_id"] == session_id]
+            return {
+                "tickets": tickets,
+                "queued": self._queued.get(session_id),
+                "running": self._running_count(session_id),
+                "global_running": self._running_count(),
+                "limits": {
+                    "coalesce_seconds": self.coalesce_seconds,
+                    "max_per_session": self.max_per_session,
+                    "max_global": self.max_global,
+                },
+            }
+
+    # ------------------------------------------------------------------
+    # 内部処理
+    # ------------------------------------------------------------------
+
+    def _lookup(self, ticket_or_job_id):
+        ticket = self._tickets.get(ticket_or_job_id)
+        if ticket is None and ticket_or_job_id in self._job_index:
+            ticket = self._tickets.get(self._job_index[ticket_or_job_id])
+        return ticket
+
+    def _running_count(self, session_id=None):
+        return sum(
+            1 for t in self._tickets.values()
+            if t["status"] in ACTIVE_STATUSES
+            and (session_id is None or t["session_id"] == session_id)
+        )
+
+    def _public(self, ticket):
+        return {
+            "ticket_id": ticket["ticket_id"],
+            "session_id": ticket["session_id"],
+            "status": ticket["status"],
+            "triggered_at": ticket["triggered_at"],
+            "trigger_count": ticket["trigger_count"],
+            "job_id": ticket["job_id"],
+            "build_data": ticket["build_data"],
+            "superseded_by": ticket["superseded_by"],
+            "error": ticket["error"],
+        }
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="build-scheduler", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                self._expire(now)
+                polls, poll_wait = self._due_polls(now)
+                ready, wait = self._next_ready(now)
+                if ready is None and not polls:
+                    self._cond.wait(timeout=wait if poll_wait is None else min(wait, poll_wait))
+                    continue
+
+                if ready is not None:
+                    ready["status"] = "dispatching"
+                    ready["started_at"] = now
+                    if self._queued.get(ready["session_id"]) == ready["ticket_id"]:
+                        del self._queued[ready["session_id"]]
+
+            for ticket in polls:
+                self._poll_executor.submit(self._poll_ticket, ticket)
+            if ready is not None:
+                self._executor.submit(self._dispatch_ticket, ready)
+
+    def _due_polls(self, now):
+        """状態を確認する時期が来た実行中のチケットと、次の確認までの待機秒数を返す"""
+        if not self._poll:
+            return [], None
+        due, next_wait = [], None
+        for ticket in self._tickets.values():
+            if ticket["status"] != "running" or ticket["polling"]:
+                continue
+            remaining = ticket["checked_at"] + self.poll_interval - now
+            if remaining > 0:
+                next_wait = remaining if next_wait is None else min(next_wait, remaining)
+                continue
+            ticket["polling"] = True
+            due.append(ticket)
+        return due, next_wait
+
+    def _poll_ticket(self, ticket):
+        status = error = None
+        try:
+            status, error = self._poll(ticket["job_id"])
+        except Exception as e:
+            logger.warning(f"Build status poll failed for {ticket['ticket_id']}: {e}")
+        finally:
+            with self._cond:
+                ticket["polling"] = False
+                ticket["checked_at"] = time.monotonic()
+                self._cond.notify_all()
+        if status:
+            self.update_status(ticket["job_id"], status, error)
+
+    def _next_ready(self, now):
+        """送信可能なチケットと、次に確認するまでの待機秒数を返す"""
+        running_global = self._running_count()
+        next_wait = None
+        for ticket_id in sorted(self._queued.values(), key=lambda t: self._tickets[t]["due_at"]):
+            ticket = self._tickets[ticket_id]
+            if ticket["due_at"] > now:
+                remaining = ticket["due_at"] - now
+                next_wait = remaining if next_wait is None else min(next_wait, remaining)
+                continue
+            if running_global >= self.max_global:
+                break
+            if self._running_count(ticket["session_id"]) >= self.max_per_session:
+                continue
+            return ticket, None
+        # 実行枠の空きは update_status の notify で起こされる（poll があれば終了の確認も行う）
+        return None, next_wait if next_wait is not None else 5.0
+
+    def _expire(self, now):
+        """実行タイムアウトと古い終了済みチケットを処理する"""
+        for ticket_id, ticket in list(self._tickets.items()):
+            if ticket["status"] == "publishing" and now - ticket["publishing_at"] > self.run_timeout:
+                # ビルド自体は完了しているので、公開が終わらなくても実行枠は解放する
+                ticket["status"] = "completed"
+                ticket["finished_at"] = now
+                logger.warning(f"Publishing build {ticket_id} did not finish within {self.run_timeout}s")
+            elif ticket["status"] in ACTIVE_STATUSES and now - ticket["started_at"] > self.run_timeout:
+                ticket["status"] = "timeout"
+                ticket["finished_at"] = now
+                logger.warning(f"Build {ticket_id} timed out after {self.run_timeout}s")
+            elif (ticket["status"] in TERMINAL_STATUSES
+                  and now - ticket["finished_at"] > self.retention_seconds):
+                del self._tickets[ticket_id]
+                if ticket["job_id"]:
+                    self._job_index.pop(ticket["job_id"], None)
+
+    def _dispatch_ticket(self, ticket):
+        try:
+            build_data = self._dispatch(ticket["session_id"], ticket["diff_data"], ticket["ticket_id"])
+            error = None
+        except Exception as e:
+            build_data = None
+            error = str(e)
+
+        with self._cond:
+            if build_data and build_data.get("success") and "jobId" in build_data:
+                ticket["status"] = "running"
+                ticket["job_id"] = build_data["jobId"]
+                ticket["build_data"] = build_data
+                ticket["checked_at"] = time.monotonic()
+                self._job_index[build_data["jobId"]] = ticket["ticket_id"]
+                logger.info(f"Build {ticket['ticket_id']} dispatched as job {build_data['jobId']} "
+                            f"({ticket['trigger_count']} triggers coalesced)")
+            else:
+                ticket["status"] = "failed"
+                ticket["error"] = error or (build_data or {}).get("error", "ビルドの開始に失敗しました")
+                ticket["finished_at"] = time.monotonic()
+                logger.error(f"Build {ticket['ticket_id']} dispatch failed: {ticket['error']}")
+            self._cond.notify_all()
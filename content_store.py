@@ -0,0 +1,176 @@
+"""
+コンテンツアドレス型ストレージ（HTML・修正ログの重複排除保存）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import gzip
+import hashlib
+import json
+import logging
+import threading
+
+from google.api_core.exceptions import PreconditionFailed
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ContentStore:
+    """
+    内容のSHA-256をキーにgzip圧縮して保存する
+
+    - 同じ内容は一度しか書き込まない（既知ハッシュはメモリにも保持）
+    - セッションごとの manifest.json が各バージョンのオブジェクトを指す
+      （世代番号を前提条件にして書き込み、古い manifest で新しいものを上書きしない）
+    """
+
+    def __init__(self, bucket_factory, max_workers=4, max_known=10000, max_manifests=1000, save_retries=5):
+        # bucket_factory() -> google.cloud.storage.Bucket（初回利用時に生成）
+        self._bucket_factory = bucket_factory
+        self._bucket = None
+        self._lock = threading.Lock()
+        self._known = set()          # 保存済みと確認できたオブジェクトパス
+        self._max_known = max_known
+        self._manifests = OrderedDict()  # session_id -> (manifest, 世代番号)（最近使ったものから max_manifests 件）
+        self._max_manifests = max_manifests
+        self._save_retries = save_retries
+        # セッション単位の保存の直列化（セッション数に比例して増えないよう固定数のロックに割り当てる）
+        self._session_locks = [threading.Lock() for _ in range(64)]
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="content-store")
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._bucket_factory()
+        return self._bucket
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def save_version(self, session_id, html, modifications):
+        """HTMLと修正ログを保存し、manifestのエントリと変化有無を返す"""
+        if not session_id:
+            raise ValueError("session_id is required")
+        html_bytes = html.encode("utf-8")
+        log_bytes = json.dumps(modifications, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        html_hash = self.digest(html_bytes)
+        log_hash = self.digest(log_bytes)
+        html_path = f"modified_html/objects/{html_hash}.html.gz"
+        log_path = f"modification_logs/objects/{log_hash}.json.gz"
+
+        # 同じセッションの保存は1つずつ行い、他のプロセスとの競合は manifest の世代番号で検出する
+        with self._session_lock(session_id):
+            for _ in range(self._save_retries):
+                manifest, generation = self._load_manifest(session_id)
+                latest = manifest["versions"][-1] if manifest["versions"] else None
+                if latest and latest["html_hash"] == html_hash and latest["log_hash"] == log_hash:
+                    logger.info(f"Content unchanged for session {session_id}, skipping save")
+                    return latest, False
+
+                # 2つのアップロードを並列に実行（保存済みのオブジェクトは書き込まない）
+                futures = [
+                    self._executor.submit(self._put, html_path, html_bytes, "text/html; charset=utf-8"),
+                    self._executor.submit(self._put, log_path, log_bytes, "application/json; charset=utf-8"),
+                ]
+                for future in futures:
+                    future.result()
+
+                entry = {
+                    "version": len(manifest["versions"]) + 1,
+                    "saved_at": datetime.now().isoformat(),
+                    "html_hash": html_hash,
+                    "html_path": html_path,
+                    "html_size": len(html_bytes),
+                    "log_hash": log_hash,
+                    "log_path": log_path,
+                    "modification_count": len(modifications),
+                }
+                updated = dict(manifest, versions=manifest["versions"] + [entry], updated_at=entry["saved_at"])
+                try:
+                    generation = self._write_manifest(session_id, updated, generation)
+                except PreconditionFailed:
+                    logger.info(f"Manifest for {session_id} was updated elsewhere, reloading")
+                    with self._lock:
+                        self._manifests.pop(session_id, None)
+                    continue
+                self._remember(session_id, updated, generation)
+                return entry, True
+        raise RuntimeError(f"Manifest for {session_id} kept changing during save")
+
+    def get_manifest(self, session_id):
+        """セッションのmanifestを取得（初回のみGCSから読み込む）"""
+        return self._load_manifest(session_id)[0]
+
+    def _load_manifest(self, session_id):
+        """(manifest, GCS上の世代番号) を返す（まだ保存されていなければ世代番号は 0）"""
+        with self._lock:
+            cached = self._manifests.get(session_id)
+            if cached is not None:
+                self._manifests.move_to_end(session_id)
+                return cached
+
+        manifest = {"session_id": session_id, "versions": [], "updated_at": None}
+        generation = 0
+        try:
+            with metrics.span("gcs", "exists"):
+                blob = self.bucket.get_blob(self.manifest_path(session_id))
+            if blob is not None:
+                with metrics.span("gcs", "download"):
+                    manifest = json.loads(blob.download_as_bytes())
+                generation = blob.generation
+        except Exception as e:
+            # 世代番号 0 のまま書き込むと既存の manifest がある場合は前提条件で失敗し、読み直しになる
+            logger.warning(f"Failed to load manifest for {session_id}: {e}")
+        return self._remember(session_id, manifest, generation)
+
+    def _write_manifest(self, session_id, manifest, generation):
+        manifest_bytes = json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8")
+        manifest_blob = self.bucket.blob(self.manifest_path(session_id))
+        manifest_blob.cache_control = "no-cache"
+        with metrics.span("gcs", "upload"):
+            manifest_blob.upload_from_string(manifest_bytes, content_type="application/json",
+                                             if_generation_match=generation)
+        return manifest_blob.generation
+
+    def _remember(self, session_id, manifest, generation):
+        with self._lock:
+            self._manifests[session_id] = (manifest, generation)
+            self._manifests.move_to_end(session_id)
+            while len(self._manifests) > self._max_manifests:
+                self._manifests.popitem(last=False)
+            return self._manifests[session_id]
+
+    def _session_lock(self, session_id):
+        return self._session_locks[hash(session_id) % len(self._session_locks)]
+
+    def load(self, path):
+        """保存済みオブジェクトを展開して返す"""
+        with metrics.span("gcs", "download"):
+            data = self.bucket.blob(path).download_as_bytes(raw_download=True)
+        return gzip.decompress(data)
+
+    @staticmethod
+    def manifest_path(session_id):
+        return f"modified_html/sessions/{session_id}/manifest.json"
+
+    def _put(self, path, data, content_type):
+        if path in self._known:
+            return
+        blob = self.bucket.blob(path)
+        with metrics.span("gcs", "exists"):
+            exists = blob.exists()
+        if not exists:
+            # GCS側で展開配信できるように Content-Encoding: gzip で保存
+            blob.content_encoding = "gzip"
+            blob.cache_control = "public, max-age=31536000, immutable"
+            with metrics.span("gcs", "upload"):
+                blob.upload_from_string(gzip.compress(data, mtime=0), content_type=content_type)
+            logger.info(f"Stored {path} ({len(data)} bytes)")
+        with self._lock:
+            if len(self._known) >= self._max_known:
+                self._known.clear()
+            self._known.add(path)
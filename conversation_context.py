@@ -0,0 +1,184 @@
+"""
+セッションごとの会話コンテキスト（トークン予算内で直近の発言と古い発言の要約を組み立てる）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+ROLE_LABELS = {"user": "ユーザー", "assistant": "AI"}
+
+
+def estimate_tokens(text):
+    """トークン数の概算（ASCIIは4文字で1、それ以外は1文字で1）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+class Turn:
+    __slots__ = ("role", "text", "tokens")
+
+    def __init__(self, role, text):
+        self.role = role
+        self.text = text
+        self.tokens = estimate_tokens(text) + 2
+
+    def render(self):
+        return f"{ROLE_LABELS.get(self.role, self.role)}: {self.text}"
+
+
+class ConversationContext:
+    """
+    1セッション分の会話
+
+    - turns: まだ要約に含まれていない発言
+    - summary: それより古い発言の要約（要約済みの位置以降だけを追加で要約する）
+    - total_tokens: これまでに追加された発言のトークン数の累計
+    """
+
+    def __init__(self):
+        self.turns = []
+        self.summary = ""
+        self.summary_tokens = 0
+        self.summarized_turns = 0
+        self.total_tokens = 0
+        self.summarizing = False
+
+    def add(self, role, text):
+        turn = Turn(role, text)
+        self.turns.append(turn)
+        self.total_tokens += turn.tokens
+        return turn
+
+    @property
+    def pending_tokens(self):
+        return sum(turn.tokens for turn in self.turns)
+
+    def render(self, budget):
+        """要約 + 予算に収まる直近の発言を、古い順に並べたテキストで返す"""
+        parts = []
+        used = 0
+        if self.summary:
+            parts.append(f"（これまでの要約）{self.summary}")
+            used += self.summary_tokens
+        recent = []
+        for turn in reversed(self.turns):
+            if used + turn.tokens > budget:
+                break
+            recent.append(turn.render())
+            used += turn.tokens
+        parts.extend(reversed(recent))
+        return "\n".join(parts), used
+
+    def stats(self):
+        return {
+            "turns": self.summarized_turns + len(self.turns),
+            "summarized_turns": self.summarized_turns,
+            "total_tokens": self.total_tokens,
+            "pending_tokens": self.pending_tokens,
+            "summary_tokens": self.summary_tokens,
+        }
+
+
+class ConversationStore:
+    """
+    セッションごとの ConversationContext を保持する（セッション数はLRUで制限）
+
+    未要約の発言が summarize_threshold を超えたら、古い方の半分を既存の要約に畳み込む。
+    要約はバックグラウンドで行い、終わるまでは予算に収まる直近の発言だけを使う。
+    """
+
+    def __init__(self, summarize, token_budget=2000, summarize_ratio=0.75, max_sessions=500):
+        # summarize(session_id, 既存の要約, 要約する発言テキスト) -> 新しい要約
+        self._summarize = summarize
+        self.token_budget = token_budget
+        self.summarize_threshold = int(token_budget * summarize_ratio)
+        self.max_sessions = max_sessions
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-summary")
+
+    def prompt_context(self, session_id):
+        """プロンプトに含める会話テキスト（なければ空文字）"""
+        with self._lock:
+            context = self._context(session_id)
+            if context is None:
+                return ""
+            text, _ = context.render(self.token_budget)
+            return text
+
+    def seed(self, session_id, history):
+        """サーバー側に会話がない場合だけクライアントから渡された履歴で初期化する（形式の合わない項目は無視する）"""
+        with self._lock:
+            context = self._context(session_id, create=True)
+            if context.turns or context.summary:
+                return
+            for item in history[-20:]:
+                if not isinstance(item, dict):
+                    continue
+                role = item.get("role")
+                text = item.get("content") or item.get("text") or ""
+                if role in ROLE_LABELS and isinstance(text, str) and text:
+                    context.add(role, text)
+
+    def add_exchange(self, session_id, user_text, assistant_text):
+        """1往復を追加し、必要なら要約を予約する"""
+        with self._lock:
+            context = self._context(session_id, create=True)
+            context.add("user", user_text)
+            if assistant_text:
+                context.add("assistant", assistant_text)
+            schedule = not context.summarizing and context.pending_tokens > self.summarize_threshold
+            if schedule:
+                context.summarizing = True
+        if schedule:
+            self._executor.submit(self._fold, session_id, context)
+
+    def stats(self, session_id):
+        with self._lock:
+            context = self._context(session_id)
+            return context.stats() if context else None
+
+    def _fold(self, session_id, context):
+        """未要約の発言のうち古い半分（トークン数基準）を要約に畳み込む"""
+        with self._lock:
+            target = context.pending_tokens // 2
+            folded, tokens = [], 0
+            for turn in context.turns:
+                if tokens >= target:
+                    break
+                folded.append(turn)
+                tokens += turn.tokens
+            previous = context.summary
+        try:
+            summary = self._summarize(session_id, previous, "\n".join(turn.render() for turn in folded))
+        except Exception as e:
+            logger.warning(f"Conversation summary failed for session {session_id}: {e}")
+            summary = None
+
+        with self._lock:
+            context.summarizing = False
+            if not summary:
+                return
+            context.summary = summary.strip()
+            context.summary_tokens = estimate_tokens(context.summary)
+            context.summarized_turns += len(folded)
+            # 要約中に追加された発言はそのまま残す
+            context.turns = context.turns[len(folded):]
+        logger.info(f"Folded {len(folded)} turns into summary for session {session_id}")
+
+    def _context(self, session_id, create=False):
+        context = self._contexts.get(session_id)
+        if context is None:
+            if not create:
+                return None
+            context = ConversationContext()
+            self._contexts[session_id] = context
+            while len(self._contexts) > self.max_sessions:
+                self._contexts.popitem(last=False)
+        self._contexts.move_to_end(session_id)
+        return context
@@ -0,0 +1,282 @@
+"""
+ページ要素のインデックス（選択箇所をサーバー側で一意なセレクタ・ノードパスに解決する）
+"""
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+
+from bs4 import BeautifulSoup, Comment, Doctype, NavigableString, Tag
+
+# DOMのnodeType
+ELEMENT_NODE = 1
+TEXT_NODE = 3
+COMMENT_NODE = 8
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_CSS_IDENT_RE = re.compile(r"^-?[_a-zA-Z][_a-zA-Z0-9-]*$")
+
+
+def normalize_text(text):
+    return _WHITESPACE_RE.sub(" ", text or "").strip()
+
+
+def node_type(node):
+    if isinstance(node, Tag):
+        return ELEMENT_NODE
+    if isinstance(node, Comment):
+        return COMMENT_NODE
+    if isinstance(node, Doctype):
+        return None
+    if isinstance(node, NavigableString):
+        return TEXT_NODE
+    return None
+
+
+def _label(entry):
+    """要素を tag#id.class 形式で表す"""
+    label = entry["tag"]
+    if entry["id"]:
+        label += f"#{entry['id']}"
+    return label + "".join(f".{c}" for c in entry["classes"][:2])
+
+
+def _clip(text, limit=40):
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _path_key(path):
+    return tuple((step.get("nodeType"), str(step.get("nodeName", "")).upper(), step.get("index")) for step in path)
+
+
+def _is_ancestor(entry, other):
+    """entry が other の祖先か"""
+    parent = other["parent"]
+    while parent is not None:
+        if parent is entry:
+            return True
+        parent = parent["parent"]
+    return False
+
+
+def parse_html(html):
+    """lxmlがあれば使い、なければ標準のhtml.parserで解析する"""
+    try:
+        return BeautifulSoup(html, "lxml")
+    except Exception:
+        return BeautifulSoup(html, "html.parser")
+
+
+class ElementIndex:
+    """
+    1つのページ版に対する要素インデックス
+
+    - テキスト（直下テキスト・全体テキスト）、id、class から要素を引ける
+    - 各要素のノードパスは iframe 側の getNodePath と同じ形式
+      （body からの各段について nodeType / nodeName / 同じnodeTypeの兄弟内での位置）
+    """
+
+    def __init__(self, html):
+        self.entries = []
+        self.by_id = {}
+        self.by_class = {}
+        self.by_direct_text = {}
+        self.by_text = {}
+        self.by_path = {}
+        self.roots = []
+
+        soup = parse_html(html)
+        body = soup.body or soup
+        self._walk(body, [], ["body"], None)
+
+    def _walk(self, parent, path, css_path, parent_entry):
+        counters = {}
+        element_position = 0
+        for child in parent.children:
+            child_type = node_type(child)
+            if child_type is None:
+                continue
+            index = counters.get(child_type, 0)
+            counters[child_type] = index + 1
+            if child_type != ELEMENT_NODE:
+                continue
+
+            element_position += 1
+            node_name = child.name.upper()
+            child_path = path + [{"nodeType": ELEMENT_NODE, "nodeName": node_name, "index": index}]
+            child_css = css_path + [f"{child.name}:nth-child({element_position})"]
+            entry = self._add(child, child_path, child_css, parent_entry)
+            self._walk(child, child_path, child_css, entry)
+
+    def _add(self, element, path, css_path, parent_entry):
+        direct_text = normalize_text(" ".join(
+            str(node) for node in element.children if node_type(node) == TEXT_NODE
+        ))
+        entry = {
+            "tag": element.name,
+            "id": element.get("id"),
+            "classes": element.get("class") or [],
+            "direct_text": direct_text,
+            "text": normalize_text(element.get_text(" ")),
+            "child_count": sum(1 for c in element.children if isinstance(c, Tag)),
+            "node_path": path,
+            "path_selector": " > ".join(css_path),
+            "parent": parent_entry,
+            "children": [],
+        }
+        self.entries.append(entry)
+        siblings = parent_entry["children"] if parent_entry else self.roots
+        entry["sibling_index"] = len(siblings)
+        siblings.append(entry)
+
+        self.by_path[_path_key(path)] = entry
+        if entry["id"]:
+            self.by_id.setdefault(entry["id"], []).append(entry)
+        for class_name in entry["classes"]:
+            self.by_class.setdefault(class_name, []).append(entry)
+        if direct_text:
+            self.by_direct_text.setdefault(direct_text, []).append(entry)
+        if entry["text"]:
+            self.by_text.setdefault(entry["text"], []).append(entry)
+        return entry
+
+    def selector_for(self, entry):
+        """要素を一意に特定できる最も短いCSSセレクタを返す"""
+        element_id = entry["id"]
+        if element_id and len(self.by_id.get(element_id, [])) == 1:
+            if _CSS_IDENT_RE.match(element_id):
+                return f"#{element_id}"
+            return '[id="{}"]'.format(element_id.replace('"', '\\"'))
+
+        classes = [c for c in entry["classes"] if _CSS_IDENT_RE.match(c)]
+        if classes:
+            candidates = set(id(e) for e in self.by_class.get(classes[0], []))
+            for class_name in classes[1:]:
+                candidates &= set(id(e) for e in self.by_class.get(class_name, []))
+            matches = [e for e in self.by_class.get(classes[0], [])
+                       if id(e) in candidates and e["tag"] == entry["tag"]]
+            if len(matches) == 1:
+                return entry["tag"] + "".join(f".{c}" for c in classes)
+
+        return entry["path_selector"]
+
+    def context_summary(self, entry, depth=3):
+        """要素の祖先と前後の兄弟要素の短い要約（プロンプトに含める周辺情報）"""
+        ancestors = []
+        parent = entry["parent"]
+        while parent is not None and len(ancestors) < depth:
+            ancestors.append(_label(parent))
+            parent = parent["parent"]
+        parts = [" > ".join(list(reversed(ancestors)) + [_label(entry)])]
+
+        siblings = entry["parent"]["children"] if entry["parent"] else self.roots
+        position = entry["sibling_index"]
+        for label, index in (("直前", position - 1), ("直後", position + 1)):
+            if 0 <= index < len(siblings):
+                sibling = siblings[index]
+                parts.append(f"{label}: {_label(sibling)}「{_clip(sibling['text'])}」")
+        return " / ".join(parts)
+
+    def find_by_text(self, text, tag=None, classes=None):
+        """
+        選択テキストに合う要素を1つに絞れれば返す（絞れなければNone）
+
+        直下テキストの完全一致を優先し、タグ名・クラスが分かればそれで候補を絞る。
+        全体テキストでの一致は、候補が入れ子（祖先と子孫）の関係だけなら最も内側の要素とする。
+        """
+        text = normalize_text(text)
+        if not text:
+            return None
+        for candidates in (self.by_direct_text.get(text), self.by_text.get(text)):
+            if not candidates:
+                continue
+            if tag:
+                candidates = [e for e in candidates if e["tag"] == tag] or candidates
+            if classes:
+                candidates = [e for e in candidates if e["classes"] == classes] or candidates
+            innermost = min(candidates, key=lambda e: e["child_count"])
+            if all(e is innermost or _is_ancestor(e, innermost) for e in candidates):
+                return innermost
+            return None
+        return None
+
+    def find_by_path(self, node_path, tag=None, text=None):
+        """iframe の getNodePath と同じ形式のノードパスで要素を引く（タグ・テキストが食い違えばNone）"""
+        try:
+            entry = self.by_path.get(_path_key(node_path))
+        except (AttributeError, TypeError):
+            return None
+        if entry is None or (tag and entry["tag"] != tag):
+            return None
+        if text and normalize_text(text) not in entry["text"]:
+            return None
+        return entry
+
+    def resolve(self, selection):
+        """
+        クライアントの選択情報を {selector, nodePath, matchedBy} に解決する
+
+        ノードパス・一意なid・テキスト・クラスの順に試し、要素を1つに特定できない場合はNoneを返す。
+        """
+        if not selection:
+            return None
+
+        text = selection.get("textContent") or selection.get("text")
+        tag = (selection.get("tagName") or "").lower()
+        class_name = selection.get("className")
+        classes = class_name.split() if isinstance(class_name, str) else []
+
+        node_path = selection.get("nodePath")
+        if isinstance(node_path, list) and node_path:
+            entry = self.find_by_path(node_path, tag, text)
+            if entry:
+                return self._result(entry, "path")
+
+        element_id = selection.get("id")
+        if element_id and len(self.by_id.get(element_id, [])) == 1:
+            return self._result(self.by_id[element_id][0], "id")
+
+        entry = self.find_by_text(text, tag, classes)
+        if entry:
+            return self._result(entry, "text")
+
+        if classes:
+            matches = [e for e in self.by_class.get(classes[0], []) if e["classes"] == classes
+                       and (not tag or e["tag"] == tag)]
+            if len(matches) == 1:
+                return self._result(matches[0], "class")
+        return None
+
+    def _result(self, entry, matched_by):
+        return {
+            "selector": self.selector_for(entry),
+            "nodePath": entry["node_path"],
+            "matchedBy": matched_by,
+            "tagName": entry["tag"].upper(),
+            "text": entry["text"][:200],
+            "domSummary": self.context_summary(entry),
+        }
+
+
+class ElementIndexCache:
+    """HTMLの内容ハッシュごとにElementIndexを保持する（ページ版ごとに1回だけ構築）"""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, html):
+        key = hashlib.sha256(html.encode("utf-8")).hexdigest()
+        with self._lock:
+            index = self._cache.get(key)
+            if index is not None:
+                self._cache.move_to_end(key)
+                return index
+
+        index = ElementIndex(html)
+        with self._lock:
+            self._cache[key] = index
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return index
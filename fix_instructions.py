@@ -0,0 +1,254 @@
+"""
+修正指示書の生成（前回の指示書と会話ログの処理済み位置を保持し、新しいエントリの分だけ節単位で更新する）
+"""
+from collections import defaultdict
+from datetime import datetime
+import json
+import logging
+import re
+import threading
+
+import session_feed
+
+logger = logging.getLogger(__name__)
+
+
+def _clip(text, limit=80):
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _describe_selection(selection):
+    if not isinstance(selection, dict):
+        return ""
+    tag = selection.get("tagName") or selection.get("type") or "要素"
+    text = selection.get("textContent") or selection.get("content") or ""
+    return f"<{str(tag).lower()}>「{_clip(text)}」"
+
+
+def format_entry(entry):
+    """会話ログの1エントリを指示書生成用の1行にする（対象外の種類はNone）"""
+    kind = entry.get("type")
+    prefix = f"[{entry.get('timestamp', '')}] "
+    if kind == "chat":
+        return f"{prefix}ユーザー: {entry.get('user', '')} / AI: {entry.get('ai', '')}"
+    if kind == "modification_chat":
+        line = f"{prefix}修正依頼: {entry.get('user', '')} / AI: {entry.get('assistant', '')}（{entry.get('action', '')}）"
+        modification = entry.get("modification")
+        if isinstance(modification, dict):
+            line += (f" 修正内容: {modification.get('type', '')} {modification.get('selector', '')}"
+                     f" → {_clip(modification.get('newValue', ''))}（{modification.get('description', '')}）")
+        target = _describe_selection(entry.get("selection"))
+        if target:
+            line += f" 対象: {target}"
+        return line
+    if kind == "selection":
+        line = f"{prefix}選択: {_describe_selection(entry.get('data'))}"
+        if entry.get("user_comment"):
+            line += f" コメント: {entry['user_comment']}"
+        return line
+    if kind == "file_upload":
+        data = entry.get("data") or {}
+        return f"{prefix}ファイル: {data.get('filename', '')}（用途: {data.get('purpose') or '未指定'}）{data.get('url', '')}"
+    return None
+
+
+def format_entries(entries):
+    return "\n".join(line for line in map(format_entry, entries) if line)
+
+
+# 差分更新のプロンプトに載せる節の数と、各節の内容の冒頭の文字数
+SECTION_INDEX_LIMIT = 40
+SECTION_PREVIEW_CHARS = 60
+
+_H2 = re.compile(r"<h2[\s>].*?</h2>", re.IGNORECASE | re.DOTALL)
+_TAG = re.compile(r"<[^>]+>")
+
+
+def _plain(html):
+    return " ".join(_TAG.sub(" ", html or "").split())
+
+
+def split_sections(html):
+    """指示書を <h2> ごとの節 {id, heading, body} に分ける（最初の <h2> より前は見出しなしの節）"""
+    sections = []
+    matches = list(_H2.finditer(html or ""))
+    head_end = matches[0].start() if matches else len(html or "")
+    if (html or "")[:head_end].strip():
+        sections.append({"id": "s0", "heading": "", "body": html[:head_end].strip()})
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(html)
+        sections.append({"id": f"s{i + 1}", "heading": match.group(0), "body": html[match.end():end].strip()})
+    return sections
+
+
+def render_section(section):
+    return "\n".join(part for part in (section["heading"], section["body"]) if part)
+
+
+def render_sections(sections):
+    return "\n".join(render_section(section) for section in sections)
+
+
+def section_index(sections, limit=SECTION_INDEX_LIMIT):
+    """差分更新のプロンプト用の節の一覧（新しい節から limit 件。指示書全体の長さに依存しない）"""
+    lines = [f"[{section['id']}] {_clip(_plain(section['heading']) or '（冒頭）', 40)}: "
+             f"{_clip(_plain(section['body']), SECTION_PREVIEW_CHARS)}" for section in sections[-limit:]]
+    if len(sections) > limit:
+        lines.insert(0, f"（古い {len(sections) - limit} 節は省略）")
+    return "\n".join(lines) or "（なし）"
+
+
+def parse_patches(text):
+    """モデルの応答から節単位の変更のリストを取り出す（解釈できなければNone）"""
+    text = strip_code_fence(text)
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return None
+    try:
+        patches = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(patches, list) or not all(isinstance(p, dict) and isinstance(p.get("html"), str)
+                                                for p in patches):
+        return None
+    return patches
+
+
+def apply_patches(sections, patches, next_id, timestamp):
+    """
+    節単位の変更を適用し、(新しい節のリスト, 次の節番号, 変更した節) を返す
+
+    存在しない節IDへの変更は新しい節として追加する。
+    """
+    sections = [dict(section) for section in sections]
+    by_id = {section["id"]: section for section in sections}
+    changed = []
+    for patch in patches:
+        section = by_id.get(patch.get("section"))
+        html = patch["html"].strip()
+        if section is not None and patch.get("op") == "replace":
+            section["body"] = html
+        elif section is not None:
+            section["body"] = f"{section['body']}\n{html}" if section["body"] else html
+        else:
+            title = patch.get("title") or f"追加の修正（{timestamp}）"
+            section = {"id": f"s{next_id}", "heading": f"<h2>{title}</h2>", "body": html}
+            next_id += 1
+            sections.append(section)
+            by_id[section["id"]] = section
+        if section not in changed:
+            changed.append(section)
+    return sections, next_id, changed
+
+
+def strip_code_fence(text):
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+    return text.strip()
+
+
+class FixInstructionGenerator:
+    """
+    セッションの修正指示書を生成・更新する
+
+    - 初回と full=True のときは会話ログ全体から生成する
+    - 2回目以降は前回の位置（high_water）より後のエントリと、指示書全体ではなく節の一覧だけを送り、
+      返ってきた節単位の変更（追記・置き換え・新しい節）を適用する
+    - 新しいエントリがなければモデルを呼ばずに前回の指示書を返す
+    状態は session["fix_instructions_state"] に保持する。
+    """
+
+    def __init__(self, generate, prompt_manager):
+        # generate(prompt, session_id) -> 生成テキスト
+        self._generate = generate
+        self._prompts = prompt_manager
+        self._locks = defaultdict(threading.Lock)
+        self._guard = threading.Lock()
+
+    def _session_lock(self, session_id):
+        with self._guard:
+            return self._locks[session_id]
+
+    def generate(self, session_id, session, full=False):
+        """(指示書全体, 生成情報) を返す"""
+        with self._session_lock(session_id):
+            log = session["conversation_log"]
+            high_water = len(log)
+            state = session.get("fix_instructions_state")
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+            if state and not full:
+                new_text = format_entries(log[state["high_water"]:high_water])
+                if not new_text:
+                    state["high_water"] = high_water
+                    return state["instructions"], self._meta("unchanged", state, 0)
+
+                sections = state.get("sections") or split_sections(state["instructions"])
+                prompt = self._prompts.get(
+                    "fix_instructions_update",
+                    timestamp=timestamp,
+                    session_id=session_id,
+                    section_index=section_index(sections),
+                    new_entries_text=new_text
+                )
+                new_entries = high_water - state["high_water"]
+                logger.info(f"Updating fix instructions with {new_entries} new log entries")
+                response = self._generate(prompt, session_id)
+                patches = parse_patches(response)
+                if patches is None:
+                    # 節単位の変更として解釈できない応答は新しい節として追記する
+                    logger.warning("Fix instruction update was not a section patch list, appending as a new section")
+                    patches = [{"section": "new", "html": strip_code_fence(response)}]
+                sections, next_id, changed = apply_patches(
+                    sections, patches, state.get("next_id", len(sections) + 1), timestamp)
+                if not changed:
+                    state["high_water"] = high_water
+                    return state["instructions"], self._meta("unchanged", state, new_entries)
+                instructions = render_sections(sections)
+                mode, delta = "incremental", "\n".join(map(render_section, changed))
+            else:
+                conversation_text = format_entries(log[:high_water])
+                prompt = self._prompts.get(
+                    "fix_instructions",
+                    timestamp=timestamp,
+                    session_id=session_id,
+                    conversation_text=conversation_text
+                )
+                new_entries = high_water
+                logger.info(f"Generating fix instructions with {len(conversation_text)} chars of conversation")
+                instructions = strip_code_fence(self._generate(prompt, session_id))
+                sections = split_sections(instructions)
+                next_id = len(sections) + 1
+                mode, delta = "full", instructions
+
+            state = {
+                "instructions": instructions,
+                "sections": sections,
+                "next_id": next_id,
+                "high_water": high_water,
+                "generated_at": datetime.now().isoformat(),
+                "revision": (state or {}).get("revision", 0) + 1,
+            }
+            session["fix_instructions_state"] = state
+            session_feed.append(session, "fix_instructions", {
+                "instructions": instructions,
+                "added": delta,
+                "generated_at": state["generated_at"],
+                "mode": mode,
+                "high_water": high_water
+            })
+            return instructions, self._meta(mode, state, new_entries)
+
+    @staticmethod
+    def _meta(mode, state, new_entries):
+        return {
+            "mode": mode,
+            "revision": state["revision"],
+            "high_water": state["high_water"],
+            "new_entries": new_entries,
+            "generated_at": state["generated_at"],
+        }
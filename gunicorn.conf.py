@@ -0,0 +1,31 @@
+"""
+gunicorn設定
+
+SERVING_MODE=threads（既定）: 1ワーカー + スレッド（GUNICORN_THREADS）
+SERVING_MODE=async          : geventワーカー。requests / GCS / gRPC(Gemini・TTS) の待ち時間中に
+                              他のリクエストを処理するため、1プロセスで WORKER_CONNECTIONS 件まで同時に待てる
+"""
+import os
+
+SERVING_MODE = os.getenv("SERVING_MODE", "threads")
+
+bind = f":{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+timeout = 0
+
+if SERVING_MODE == "async":
+    worker_class = "gevent"
+    worker_connections = int(os.getenv("WORKER_CONNECTIONS", "1000"))
+else:
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+
+def post_worker_init(worker):
+    """
+    起動モードをログに出す
+
+    gRPCのgevent対応（init_gevent）はここでは遅い（アプリの読み込み時にTTSクライアントが生成済み）ため、
+    app_hp_support の先頭で SERVING_MODE=async のときに実行している。
+    """
+    if SERVING_MODE == "async":
+        worker.log.info("Async serving mode: gevent worker, %s connections", worker_connections)
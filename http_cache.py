@@ -0,0 +1,161 @@
+"""
+レスポンス圧縮（gzip / brotli）とHTTPキャッシュヘッダー（ETag・304・Cache-Control）
+"""
+from collections import OrderedDict
+import gzip
+import hashlib
+import threading
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # brotli未導入の環境ではgzipのみ
+    brotli = None
+
+NO_CACHE = "no-cache"
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_TYPES = (
+    "text/", "application/javascript", "application/json", "application/xml",
+    "image/svg+xml", "application/manifest+json",
+)
+
+
+def make_etag(data):
+    """内容ハッシュからETag（引用符なし）を作る"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def is_compressible(mimetype):
+    return mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def negotiate_encoding(accept_encoding, available=None):
+    """Accept-Encoding から使用する圧縮方式を決める（br > gzip > なし、available で候補を限定）"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token] = quality
+    for encoding in ("br", "gzip"):
+        if available is not None and encoding not in available:
+            continue
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, fast=False):
+    """fast=True は使い捨ての動的レスポンス用（圧縮率より速度を優先する）"""
+    if encoding == "br":
+        return brotli.compress(data, quality=4 if fast else 9)
+    return gzip.compress(data, compresslevel=4 if fast else 6, mtime=0)
+
+
+class CompressionCache:
+    """
+    圧縮済みバリアントを (ETag, 圧縮方式) ごとに保持するLRU
+
+    同じ内容の2回目以降のリクエストでは圧縮処理を行わない。
+    ETagが頻繁に変わる動的な内容は再利用されず他のエントリを追い出すだけなので入れない（cached_response の reuse）。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, etag, encoding, data):
+        key = (etag, encoding)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                return cached
+        compressed = compress(data, encoding)
+        with self._lock:
+            if key not in self._entries and len(compressed) <= self.max_bytes:
+                self._entries[key] = compressed
+                self._size += len(compressed)
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return compressed
+
+
+compression_cache = CompressionCache()
+
+
+def not_modified(etag):
+    """If-None-Match が現在のETagと一致するか"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in header.split(",")]
+    return etag in tags
+
+
+def cached_response(data, mimetype, etag=None, cache_control=NO_CACHE, variants=None, reuse=None):
+    """
+    ETag・Cache-Control 付きでレスポンスを返す
+
+    - If-None-Match が一致すれば 304
+    - 圧縮対象の種類・サイズであれば Accept-Encoding に応じて圧縮済みバリアントを返す
+    - variants（{圧縮方式: bytes}）を渡した場合はその場で圧縮せずそれを使う
+    - reuse=True（静的・公開済みの内容。immutable なら既定で True）は圧縮結果を共有LRUに保持する。
+      それ以外の動的な内容は低い圧縮レベルでその場で圧縮し、保持しない
+    - data に読み込み関数を渡した場合は 304 にならなかったときだけ呼ぶ（etag 必須）
+    """
+    if reuse is None:
+        reuse = cache_control == IMMUTABLE
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    etag = etag or make_etag(data)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": cache_control}
+
+    if callable(data):
+        if not_modified(etag):
+            if is_compressible(mimetype):
+                headers["Vary"] = "Accept-Encoding"
+            return Response(status=304, headers=headers)
+        data = data()
+
+    if variants is not None:
+        compressible = bool(variants)
+    else:
+        compressible = is_compressible(mimetype) and len(data) >= MIN_COMPRESS_BYTES
+    if compressible:
+        headers["Vary"] = "Accept-Encoding"
+
+    if not_modified(etag):
+        return Response(status=304, headers=headers)
+
+    body = data
+    if compressible:
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding"), variants)
+        if encoding:
+            if variants is not None:
+                body = variants[encoding]
+            elif reuse:
+                body = compression_cache.get(etag, encoding, data)
+            else:
+                body = compress(data, encoding, fast=True)
+            headers["Content-Encoding"] = encoding
+
+    return Response(body, mimetype=mimetype, headers=headers)
@@ -0,0 +1,185 @@
+"""
+LLM呼び出しのスケジューラ（優先度クラスごとの同時実行数・キュー上限とセッション間の公平性）
+"""
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import math
+import threading
+import time
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+BACKGROUND = "background"
+
+
+class LLMBusy(Exception):
+    """キューが一杯、または待ち時間の上限を超えた"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("session_id", "granted")
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.granted = False
+
+
+class _PriorityClass:
+    def __init__(self, name, concurrency, queue_limit):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_limit = queue_limit
+        self.running = 0
+        self.queued = 0
+        self.waiters = OrderedDict()      # session_id -> deque(_Waiter)
+        self.per_session = {}             # session_id -> 実行中 + 待機中の件数
+        self.avg_seconds = 1.0            # 1呼び出しあたりの平均所要時間（指数移動平均）
+        self.rejected = 0
+
+
+class _SlotStream:
+    def __init__(self, slot, produce):
+        slot.__enter__()
+        self._slot = slot
+        self._produce = produce
+        self._closed = False
+
+    def __iter__(self):
+        try:
+            yield from self._produce()
+        finally:
+            self.close()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._slot.__exit__(None, None, None)
+
+
+class LLMScheduler:
+    """
+    優先度クラス（interactive / batch / background）ごとに独立した実行枠とキューを持つ
+
+    - あるクラスが混雑しても他のクラスの枠は使われない（/api/chat が指示書生成に待たされない）
+    - キュー内はセッション単位のラウンドロビンで割り当てる
+    - キューが一杯のときは待たずに LLMBusy（Retry-After 付き）を送出する
+    """
+
+    def __init__(self, classes, session_limit=2, queue_timeout=30.0):
+        # classes: {クラス名: (同時実行数, キュー上限)}
+        self._classes = {name: _PriorityClass(name, c, q) for name, (c, q) in classes.items()}
+        self.session_limit = session_limit
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, priority, session_id=None):
+        """
+        実行枠を確保してから処理を行う
+
+        session_id は公平性とセッション単位の上限の単位（クライアントの識別子でもよい）。
+        None の場合はセッション単位の上限を適用せず、呼び出しごとに別の枠として扱う。
+        """
+        cls = self._classes[priority]
+        key = session_id if session_id else object()
+        self._acquire(cls, key)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(cls, key, time.monotonic() - start)
+
+    def stream(self, priority, session_id, produce):
+        """
+        実行枠を確保した状態で produce() のチャンクを返すイテラブルを作る
+
+        枠はこの時点で確保する（混雑時はレスポンスを返す前に LLMBusy になる）。
+        最後まで読み終えるか close() されたときに解放する。
+        """
+        return _SlotStream(self.slot(priority, session_id), produce)
+
+    def retry_after(self, cls):
+        """現在のキュー長と平均所要時間から再試行までの秒数を見積もる"""
+        rounds = (cls.queued + 1) / max(1, cls.concurrency)
+        return max(1, math.ceil(rounds * cls.avg_seconds))
+
+    def stats(self):
+        with self._cond:
+            return {
+                name: {
+                    "running": cls.running,
+                    "queued": cls.queued,
+                    "concurrency": cls.concurrency,
+                    "queue_limit": cls.queue_limit,
+                    "avg_seconds": round(cls.avg_seconds, 3),
+                    "rejected": cls.rejected,
+                }
+                for name, cls in self._classes.items()
+            }
+
+    def _reject(self, cls, message):
+        cls.rejected += 1
+        raise LLMBusy(message, self.retry_after(cls))
+
+    def _acquire(self, cls, session_id):
+        with self._cond:
+            if cls.per_session.get(session_id, 0) >= self.session_limit:
+                self._reject(cls, "同じセッションからの処理が実行中です")
+            if cls.running < cls.concurrency and cls.queued == 0:
+                cls.running += 1
+                cls.per_session[session_id] = cls.per_session.get(session_id, 0) + 1
+                return
+            if cls.queued >= cls.queue_limit:
+                self._reject(cls, "混雑しています")
+
+            waiter = _Waiter(session_id)
+            cls.waiters.setdefault(session_id, deque()).append(waiter)
+            cls.queued += 1
+            cls.per_session[session_id] = cls.per_session.get(session_id, 0) + 1
+
+            deadline = time.monotonic() + self.queue_timeout
+            while not waiter.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._remove_waiter(cls, waiter)
+                    self._reject(cls, "待ち時間が上限を超えました")
+                self._cond.wait(timeout=remaining)
+
+    def _remove_waiter(self, cls, waiter):
+        queue = cls.waiters.get(waiter.session_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del cls.waiters[waiter.session_id]
+            cls.queued -= 1
+            self._decrement_session(cls, waiter.session_id)
+
+    def _decrement_session(self, cls, session_id):
+        count = cls.per_session.get(session_id, 0) - 1
+        if count > 0:
+            cls.per_session[session_id] = count
+        else:
+            cls.per_session.pop(session_id, None)
+
+    def _release(self, cls, session_id, elapsed):
+        with self._cond:
+            cls.avg_seconds = 0.8 * cls.avg_seconds + 0.2 * elapsed
+            cls.running -= 1
+            self._decrement_session(cls, session_id)
+
+            # 先頭のセッションから1件割り当て、そのセッションは末尾に回す（ラウンドロビン）
+            if cls.waiters and cls.running < cls.concurrency:
+                next_session, queue = next(iter(cls.waiters.items()))
+                waiter = queue.popleft()
+                if queue:
+                    cls.waiters.move_to_end(next_session)
+                else:
+                    del cls.waiters[next_session]
+                cls.queued -= 1
+                cls.running += 1
+                waiter.granted = True
+                self._cond.notify_all()
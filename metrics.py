@@ -0,0 +1,154 @@
+"""
+リクエスト・外部呼び出しのレイテンシ計測（Prometheusテキスト形式で出力）
+"""
+from contextlib import contextmanager
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class Histogram:
+    """ラベルごとの累積ヒストグラム"""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}   # labels -> [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+            items = [(key, list(series)) for key, series in items]
+        for key, series in items:
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_format_labels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """ラベルごとの現在値"""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, amount, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    HTTPリクエストと外部呼び出し（GCS・Gemini・TTS・ビルダー・取得元サイト）の計測値を保持する
+
+    外部呼び出しは、実行中のリクエストのルートをラベルに付けて子スパンとして記録する。
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "HTTP request latency by route", LATENCY_BUCKETS)
+        self.response_size = Histogram(
+            "http_response_size_bytes", "HTTP response body size by route", SIZE_BUCKETS)
+        self.in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+        self.upstream_duration = Histogram(
+            "upstream_call_duration_seconds", "Upstream call latency by route and upstream", LATENCY_BUCKETS)
+
+    @property
+    def current_route(self):
+        return getattr(self._local, "route", "background")
+
+    @contextmanager
+    def span(self, upstream, operation):
+        """外部呼び出しを計測する（例外は outcome="error" として記録して再送出）"""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.upstream_duration.observe(
+                time.perf_counter() - start,
+                route=self.current_route, upstream=upstream, operation=operation, outcome=outcome)
+
+    def render(self):
+        lines = []
+        for metric in (self.request_duration, self.response_size, self.in_flight, self.upstream_duration):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def init_app(self, app):
+        """Flaskアプリにリクエスト計測のフックを登録する"""
+        from flask import g, request
+
+        @app.before_request
+        def _metrics_start():
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            g.metrics_route = route
+            g.metrics_start = time.perf_counter()
+            self._local.route = route
+            self.in_flight.add(1, route=route)
+
+        @app.after_request
+        def _metrics_record(response):
+            route = g.get("metrics_route", "unmatched")
+            if "metrics_start" in g:
+                self.request_duration.observe(
+                    time.perf_counter() - g.metrics_start,
+                    route=route, method=request.method, status=response.status_code)
+            if not response.is_streamed:
+                self.response_size.observe(response.calculate_content_length() or 0, route=route)
+            return response
+
+        @app.teardown_request
+        def _metrics_finish(exc):
+            if "metrics_route" in g:
+                self.in_flight.add(-1, route=g.metrics_route)
+            self._local.route = "background"
+
+
+# アプリ全体で共有するレジストリ
+metrics = MetricsRegistry()
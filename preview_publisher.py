@@ -0,0 +1,480 @@
+"""
+プレビューの公開処理（ビルド完了時に注入済み index.html とアセットのハッシュ一覧をGCSへ書き出す）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import base64
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+from google.api_core.exceptions import PreconditionFailed
+
+from asset_types import mimetype_for
+from http_cache import make_etag
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PUBLISHED_DIR = "_published"
+# namespaces.json の更新が他のインスタンスと競合したときに読み直す回数
+REGISTRY_RETRIES = 5
+# 名前空間ID（BuildSchedulerのチケットID）
+NAMESPACE_PATTERN = re.compile(r"^build-[0-9a-f]{12}$")
+
+
+def blob_etag(blob):
+    """GCSのMD5（base64）を16進に変換してETagにする"""
+    if blob.md5_hash:
+        return base64.b64decode(blob.md5_hash).hex()
+    return getattr(blob, "etag", None)
+
+
+def is_namespace(value):
+    return bool(NAMESPACE_PATTERN.match(value or ""))
+
+
+class PublishedPreview:
+    """公開済みプレビュー1件分（注入済みindex.htmlとアセット一覧）"""
+
+    __slots__ = ("build_id", "published_at", "index_html", "index_etag", "assets", "prefix", "isolated")
+
+    def __init__(self, build_id, published_at, index_html, index_etag, assets, prefix, isolated=False):
+        self.build_id = build_id
+        self.published_at = published_at
+        self.index_html = index_html
+        self.index_etag = index_etag
+        self.assets = assets        # 相対パス -> {"etag", "size", "content_type"}
+        self.prefix = prefix        # アセットを読み出すGCS上のプレフィックス
+        self.isolated = isolated    # ビルド専用の出力先からコピーした（内容がそのビルドのものと確定している）
+
+    def entry(self, filename):
+        """配信するファイルのETagとContent-Type（含まれていなければNone）"""
+        if filename == "index.html":
+            return {"etag": self.index_etag, "content_type": "text/html", "preview": self, "index": True,
+                    "immutable": self.isolated}
+        asset = self.assets.get(filename)
+        if asset is None:
+            return None
+        return {"etag": asset["etag"], "content_type": asset["content_type"], "preview": self, "index": False,
+                "immutable": self.isolated}
+
+
+class PreviewPublisher:
+    """
+    ビルド完了時にプレビューを公開し、配信時は変換なしでバイト列を返す
+
+    - publish(): {prefix}/index.html に <base> と選択検知スクリプトを注入して
+      {prefix}/_published/index.html に保存し、アセットのハッシュ一覧を manifest.json に書き出す
+    - namespace を指定した場合は、ビルド出力を {namespace_prefix}/{namespace}/ にコピーして
+      /preview/{namespace}/ で配信できるようにする
+      （source_prefix にビルド専用の出力先を渡した場合だけ、内容がそのビルドのものと確定するため immutable で配信する。
+      共有の出力先 {prefix} からコピーした名前空間は、他のビルドに上書きされた内容の可能性があるため再検証させる）
+    - 名前空間はセッションごとに keep_per_session 件、かつ namespace_ttl 秒以内のものだけ残す（最新の1件も期限で削除）
+    - 公開内容はメモリに保持し、アセットも ETag をキーにしたLRUへ事前に読み込む
+    - 他のインスタンスが公開した場合に備え、manifest_ttl 秒ごとに manifest.json を確認する
+    - 存在しない名前空間は miss_ttl 秒のあいだ記憶し、その間はGCSを確認しない
+    - namespaces.json は世代番号を前提条件にして更新する（他のインスタンスの更新を上書きしない）
+    """
+
+    def __init__(self, bucket_factory, prefix, inject, manifest_ttl=5.0,
+                 cache_bytes=64 * 1024 * 1024, warm_max_bytes=2 * 1024 * 1024, max_workers=4,
+                 namespace_prefix="previews", keep_per_session=2, namespace_ttl=7 * 24 * 3600,
+                 max_loaded_namespaces=64, miss_ttl=2.0, max_misses=1024):
+        # bucket_factory() -> google.cloud.storage.Bucket
+        # inject(bytes, base_href) -> 注入済みbytes
+        self._bucket_factory = bucket_factory
+        self.prefix = prefix
+        self._inject = inject
+        self.manifest_ttl = manifest_ttl
+        self.cache_bytes = cache_bytes
+        self.warm_max_bytes = warm_max_bytes
+        self.namespace_prefix = namespace_prefix
+        self.keep_per_session = keep_per_session
+        self.namespace_ttl = namespace_ttl
+        self.max_loaded_namespaces = max_loaded_namespaces
+        self.miss_ttl = miss_ttl
+        self.max_misses = max_misses
+        self._bucket = None
+        self._current = None
+        self._checked_at = None
+        self._namespaces = OrderedDict()   # namespace -> PublishedPreview（読み込み済み）
+        self._pending = {}                 # namespace -> Future
+        self._misses = OrderedDict()       # namespace -> 存在しないと確認した時刻
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._cache = OrderedDict()        # etag -> bytes
+        self._cache_size = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="preview-publish")
+        self._copy_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="preview-copy")
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._bucket_factory()
+        return self._bucket
+
+    @property
+    def manifest_path(self):
+        return f"{self.prefix}/{PUBLISHED_DIR}/manifest.json"
+
+    @property
+    def index_path(self):
+        return f"{self.prefix}/{PUBLISHED_DIR}/index.html"
+
+    @property
+    def registry_path(self):
+        return f"{self.namespace_prefix}/namespaces.json"
+
+    def namespace_root(self, namespace):
+        return f"{self.namespace_prefix}/{namespace}"
+
+    # ------------------------------------------------------------------
+    # 公開
+    # ------------------------------------------------------------------
+
+    def publish(self, build_id, namespace=None, session_id=None, source_prefix=None):
+        """
+        ビルド出力から公開用の index.html と manifest.json を作る
+
+        source_prefix はこのビルドだけが書き込んだ出力先（ビルダーが出力先の指定に応じた場合）。
+        名前空間はそこからコピーし、指定がなければ共有の出力先 {prefix} からコピーする。
+        """
+        with self._publish_lock:
+            manifest = None
+            published = None
+            shared = self._list_output(self.prefix)
+            if shared is None:
+                logger.warning(f"Publish skipped for build {build_id}: {self.prefix}/index.html not found")
+            else:
+                raw_index, asset_blobs, assets = shared
+                index_html = self._inject(raw_index, "/preview/")
+                published_at = datetime.now().isoformat()
+                manifest = self._write_published(self.prefix, build_id, published_at, index_html, assets,
+                                                 "no-cache")
+                published = PublishedPreview(build_id, published_at, index_html, manifest["index_etag"],
+                                             assets, self.prefix)
+                with self._lock:
+                    self._current = published
+                    self._checked_at = time.monotonic()
+                logger.info(f"Published preview for build {build_id}: {len(assets)} assets")
+
+            if namespace:
+                source = self._list_output(source_prefix) if source_prefix else shared
+                if source is None:
+                    logger.warning(f"Namespace {namespace} skipped for build {build_id}: "
+                                   f"{source_prefix or self.prefix}/index.html not found")
+                else:
+                    self._publish_namespace(namespace, session_id, build_id, *source,
+                                            isolated=bool(source_prefix))
+
+        if published is not None:
+            self._warm(published)
+        if namespace:
+            self._executor.submit(self._collect_logged)
+        return manifest
+
+    def _list_output(self, prefix):
+        """ビルド出力の (index.html の内容, アセットのblob, アセット一覧) を返す（index.html がなければNone）"""
+        bucket = self.bucket
+        with metrics.span("gcs", "list"):
+            blobs = list(bucket.list_blobs(prefix=f"{prefix}/"))
+
+        index_blob = None
+        asset_blobs = {}
+        assets = {}
+        for blob in blobs:
+            name = blob.name[len(prefix) + 1:]
+            if not name or name.startswith(f"{PUBLISHED_DIR}/"):
+                continue
+            if name == "index.html":
+                index_blob = blob
+                continue
+            etag = blob_etag(blob)
+            if etag:
+                asset_blobs[name] = blob
+                assets[name] = {
+                    "etag": etag,
+                    "size": blob.size,
+                    "content_type": blob.content_type or mimetype_for(name),
+                }
+
+        if index_blob is None:
+            return None
+        with metrics.span("gcs", "download"):
+            raw_index = index_blob.download_as_bytes()
+        return raw_index, asset_blobs, assets
+
+    def _write_published(self, root, build_id, published_at, index_html, assets, cache_control, isolated=False):
+        """index.html を先に書き、manifest.json の更新で公開を確定させる"""
+        bucket = self.bucket
+        manifest = {
+            "build_id": build_id,
+            "published_at": published_at,
+            "index_etag": make_etag(index_html),
+            "assets": assets,
+            "isolated": isolated,
+        }
+        with metrics.span("gcs", "upload"):
+            index_out = bucket.blob(f"{root}/{PUBLISHED_DIR}/index.html")
+            index_out.cache_control = cache_control
+            index_out.upload_from_string(index_html, content_type="text/html; charset=utf-8")
+        with metrics.span("gcs", "upload"):
+            manifest_out = bucket.blob(f"{root}/{PUBLISHED_DIR}/manifest.json")
+            manifest_out.cache_control = cache_control
+            manifest_out.upload_from_string(json.dumps(manifest, ensure_ascii=False),
+                                            content_type="application/json")
+        return manifest
+
+    def _publish_namespace(self, namespace, session_id, build_id, raw_index, asset_blobs, assets, isolated=False):
+        """ビルド出力を名前空間にコピーし、名前空間用の <base> を注入した index.html を書き出す"""
+        published_at = datetime.now().isoformat()
+        bucket = self.bucket
+        root = self.namespace_root(namespace)
+
+        def copy(name):
+            with metrics.span("gcs", "copy"):
+                bucket.copy_blob(asset_blobs[name], bucket, f"{root}/{name}")
+
+        for future in [self._copy_executor.submit(copy, name) for name in asset_blobs]:
+            future.result()
+
+        index_html = self._inject(raw_index, f"/preview/{namespace}/")
+        cache_control = "public, max-age=31536000, immutable" if isolated else "no-cache"
+        manifest = self._write_published(root, build_id, published_at, index_html, assets, cache_control,
+                                         isolated=isolated)
+        published = PublishedPreview(build_id, published_at, index_html, manifest["index_etag"], assets, root,
+                                     isolated=isolated)
+        self._remember_namespace(namespace, published)
+
+        entry = {
+            "session_id": session_id,
+            "build_id": build_id,
+            "published_at": time.time(),
+        }
+        self._update_registry(lambda registry: registry.__setitem__(namespace, entry))
+        logger.info(f"Published preview namespace {namespace} for session {session_id}")
+
+    def publish_async(self, build_id, namespace=None, session_id=None, source_prefix=None):
+        future = self._executor.submit(self._publish_logged, build_id, namespace, session_id, source_prefix)
+        if namespace:
+            with self._lock:
+                self._pending[namespace] = future
+            future.add_done_callback(lambda _: self._pending.pop(namespace, None))
+        return future
+
+    def _publish_logged(self, build_id, namespace=None, session_id=None, source_prefix=None):
+        try:
+            return self.publish(build_id, namespace, session_id, source_prefix)
+        except Exception as e:
+            logger.error(f"Preview publish failed for build {build_id}: {e}")
+            return None
+
+    def namespace_status(self, namespace):
+        """名前空間の状態（"published" / "publishing" / 公開されていなければNone）"""
+        with self._lock:
+            if namespace in self._namespaces:
+                return "published"
+            future = self._pending.get(namespace)
+        if future is not None and not future.done():
+            return "publishing"
+        return "published" if self.namespace(namespace) is not None else None
+
+    def _warm(self, published):
+        """小さいアセットを事前にキャッシュへ読み込む"""
+        for name, asset in published.assets.items():
+            if asset["size"] is not None and asset["size"] <= self.warm_max_bytes:
+                self._executor.submit(self._warm_one, published.prefix, name, asset["etag"])
+
+    def _warm_one(self, prefix, name, etag):
+        try:
+            self.read_asset(prefix, name, etag)
+        except Exception as e:
+            logger.warning(f"Failed to warm preview asset {name}: {e}")
+
+    # ------------------------------------------------------------------
+    # 名前空間の管理
+    # ------------------------------------------------------------------
+
+    def _load_registry(self):
+        """(namespaces.json の内容, 世代番号) を返す（まだなければ世代番号は 0）"""
+        with metrics.span("gcs", "download"):
+            blob = self.bucket.get_blob(self.registry_path)
+            if blob is None:
+                return {}, 0
+            return json.loads(blob.download_as_bytes()), blob.generation
+
+    def _save_registry(self, registry, generation):
+        with metrics.span("gcs", "upload"):
+            blob = self.bucket.blob(self.registry_path)
+            blob.cache_control = "no-cache"
+            blob.upload_from_string(json.dumps(registry, ensure_ascii=False), content_type="application/json",
+                                    if_generation_match=generation)
+
+    def _update_registry(self, mutate):
+        """namespaces.json を読み、mutate(registry) を適用して書き戻す（他で更新されていれば読み直す）"""
+        for attempt in range(REGISTRY_RETRIES):
+            registry, generation = self._load_registry()
+            mutate(registry)
+            try:
+                self._save_registry(registry, generation)
+                return registry
+            except PreconditionFailed:
+                logger.info("Preview namespace registry was updated elsewhere, retrying")
+                # 同時に読み直したインスタンス同士が再び衝突しないよう、ずらして待つ
+                time.sleep(random.uniform(0, 0.1 * (attempt + 1)))
+        raise RuntimeError("Preview namespace registry kept changing during update")
+
+    def _remember_namespace(self, namespace, published):
+        with self._lock:
+            self._misses.pop(namespace, None)
+            self._namespaces[namespace] = published
+            self._namespaces.move_to_end(namespace)
+            while len(self._namespaces) > self.max_loaded_namespaces:
+                self._namespaces.popitem(last=False)
+
+    def collect_garbage(self):
+        """
+        古い名前空間を削除して削除件数を返す
+
+        セッションごとに新しい順で keep_per_session 件を残し、それ以外と namespace_ttl を過ぎたものを削除する。
+        セッションはメモリ上にしかないため、最新の1件も期限を過ぎれば削除する（GCSに残り続けないように）。
+        """
+        with self._publish_lock:
+            registry, _ = self._load_registry()
+            now = time.time()
+            by_session = {}
+            for namespace, info in registry.items():
+                by_session.setdefault(info.get("session_id"), []).append((info.get("published_at", 0), namespace))
+
+            expired = []
+            for entries in by_session.values():
+                entries.sort(reverse=True)
+                for rank, (published_at, namespace) in enumerate(entries):
+                    if rank >= self.keep_per_session or now - published_at > self.namespace_ttl:
+                        expired.append(namespace)
+
+            if not expired:
+                return 0
+
+            for namespace in expired:
+                with metrics.span("gcs", "list"):
+                    blobs = list(self.bucket.list_blobs(prefix=f"{self.namespace_root(namespace)}/"))
+                for future in [self._copy_executor.submit(self._delete_blob, blob) for blob in blobs]:
+                    future.result()
+                with self._lock:
+                    self._namespaces.pop(namespace, None)
+
+            # 削除している間に他のインスタンスが追加した名前空間は残す
+            self._update_registry(lambda latest: [latest.pop(namespace, None) for namespace in expired])
+            logger.info(f"Removed {len(expired)} preview namespaces")
+            return len(expired)
+
+    def _delete_blob(self, blob):
+        with metrics.span("gcs", "delete"):
+            blob.delete()
+
+    def _collect_logged(self):
+        try:
+            self.collect_garbage()
+        except Exception as e:
+            logger.warning(f"Preview namespace cleanup failed: {e}")
+
+    # ------------------------------------------------------------------
+    # 配信
+    # ------------------------------------------------------------------
+
+    def current(self):
+        """公開済みプレビュー（なければNone）。manifest_ttl ごとにGCSの manifest を確認する"""
+        now = time.monotonic()
+        with self._lock:
+            published = self._current
+            if self._checked_at is not None and now - self._checked_at <= self.manifest_ttl:
+                return published
+            # 確認中も他のリクエストには現在の内容を返す
+            self._checked_at = now
+        try:
+            refreshed = self._load(self.prefix, published)
+        except Exception as e:
+            logger.warning(f"Failed to refresh published preview: {e}")
+            return published
+        if refreshed is not published:
+            with self._lock:
+                self._current = refreshed
+            logger.info(f"Loaded published preview for build {refreshed.build_id}")
+        return refreshed
+
+    def namespace(self, namespace):
+        """名前空間の公開済みプレビュー（内容は変わらないので一度読めば保持し続ける）"""
+        now = time.monotonic()
+        with self._lock:
+            published = self._namespaces.get(namespace)
+            if published is not None:
+                self._namespaces.move_to_end(namespace)
+                return published
+            missed_at = self._misses.get(namespace)
+            if missed_at is not None and now - missed_at <= self.miss_ttl:
+                return None
+        published = self._load(self.namespace_root(namespace), None)
+        if published is not None:
+            self._remember_namespace(namespace, published)
+            return published
+        with self._lock:
+            self._misses[namespace] = now
+            self._misses.move_to_end(namespace)
+            while len(self._misses) > self.max_misses:
+                self._misses.popitem(last=False)
+        return None
+
+    def _load(self, root, published):
+        """GCSの manifest.json を読み、変化があれば index.html と合わせて読み込む"""
+        bucket = self.bucket
+        with metrics.span("gcs", "download"):
+            manifest_blob = bucket.get_blob(f"{root}/{PUBLISHED_DIR}/manifest.json")
+            if manifest_blob is None:
+                return published
+            manifest = json.loads(manifest_blob.download_as_bytes())
+        if published is not None and manifest.get("index_etag") == published.index_etag \
+                and manifest.get("build_id") == published.build_id:
+            return published
+
+        with metrics.span("gcs", "download"):
+            index_html = bucket.blob(f"{root}/{PUBLISHED_DIR}/index.html").download_as_bytes()
+        return PublishedPreview(manifest.get("build_id"), manifest.get("published_at"),
+                                index_html, make_etag(index_html), manifest.get("assets", {}), root,
+                                isolated=manifest.get("isolated", False))
+
+    def lookup(self, filename, namespace=None):
+        """配信するファイルのETagとContent-Typeを返す（公開済みでなければNone）"""
+        published = self.namespace(namespace) if namespace else self.current()
+        if published is None:
+            return None
+        return published.entry(filename)
+
+    def read(self, filename, entry):
+        published = entry["preview"]
+        if entry["index"]:
+            return published.index_html
+        return self.read_asset(published.prefix, filename, entry["etag"])
+
+    def read_asset(self, prefix, name, etag):
+        """ETagをキーにしたLRUから返し、なければGCSから取得して保持する"""
+        with self._lock:
+            data = self._cache.get(etag)
+            if data is not None:
+                self._cache.move_to_end(etag)
+                return data
+        with metrics.span("gcs", "download"):
+            data = self.bucket.blob(f"{prefix}/{name}").download_as_bytes()
+        with self._lock:
+            if etag not in self._cache and len(data) <= self.cache_bytes:
+                self._cache[etag] = data
+                self._cache_size += len(data)
+                while self._cache_size > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_size -= len(evicted)
+        return data
@@ -2,8 +2,18 @@
 プロンプト管理クラス
 """
 from datetime import datetime
+import logging
 import os
 
+logger = logging.getLogger(__name__)
+
+
+class _KeepMissing(dict):
+    """テンプレートにない変数はそのまま残す"""
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
 
 class PromptManager:
     def __init__(self, cache_minutes=60):
@@ -17,7 +27,35 @@ class PromptManager:
         self.prompts = {
             "fix_instructions": """
 あなたはHTML修正アシスタントです。
-ユーザーの指示に従って、適切な修正指示を生成してください。
+以下の会話ログ（チャット・修正依頼・選択箇所・アップロードファイル）から、制作担当者向けの修正指示書をHTML形式で作成してください。
+見出し・箇条書きを使い、対象箇所と修正内容が分かるようにしてください。
+
+作成日時: {timestamp}
+セッションID: {session_id}
+
+会話ログ:
+{conversation_text}
+""",
+            "fix_instructions_update": """
+あなたはHTML修正アシスタントです。
+以下は作成済みの修正指示書の節の一覧（[節ID] 見出し: 内容の冒頭）と、その後に追加された会話ログです。
+追加された会話ログから指示書に反映すべき修正だけを、節ごとの変更として次の形式のJSONで返してください。
+[
+  {{"section": "節ID", "op": "append", "html": "既存の節の末尾に追記するHTML断片"}},
+  {{"section": "節ID", "op": "replace", "html": "既存の節の本文（見出しを除く）を置き換えるHTML断片"}},
+  {{"section": "new", "title": "新しい節の見出し", "html": "新しい節の本文のHTML断片"}}
+]
+既にある項目と重複する内容は含めず、既存の項目を変更する場合はその節を append または replace してください。
+反映すべき修正がなければ [] を返してください。
+
+更新日時: {timestamp}
+セッションID: {session_id}
+
+作成済みの修正指示書の節:
+{section_index}
+
+追加された会話ログ:
+{new_entries_text}
 """,
             "chat_system": """
 あなたは親切なアシスタントです。
@@ -32,9 +70,18 @@ class PromptManager:
         }
         self.last_loaded = datetime.now()
 
-    def get(self, name, default=None):
-        """プロンプトを取得"""
-        return self.prompts.get(name, default or "")
+    def get(self, name, default=None, **variables):
+        """プロンプトを取得（変数を渡した場合は {name} 形式のプレースホルダーを置き換える）"""
+        template = self.prompts.get(name, default or "")
+        if not variables:
+            return template
+        try:
+            return template.format_map(_KeepMissing(variables))
+        except (ValueError, IndexError) as e:
+            # 置き換えずに返すと変数が欠けたプロンプトがモデルに送られるため、呼び出し元に知らせる
+            # （テンプレートに波括弧をそのまま書く場合は {{ }} とする）
+            logger.error(f"Failed to format prompt '{name}': {e}")
+            raise ValueError(f"プロンプト '{name}' の変数を置き換えられません: {e}") from e
 
     def reload(self):
         """プロンプトを再読み込み"""
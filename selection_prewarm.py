@@ -0,0 +1,120 @@
+"""
+選択箇所のチャット用コンテキストの先行準備（要素を選択した時点で組み立て、続く /api/chat で再利用する）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("future", "intents", "created")
+
+    def __init__(self, future):
+        self.future = future
+        self.intents = None
+        self.created = time.monotonic()
+
+
+class SelectionPrewarmer:
+    """
+    (セッション, 選択内容) ごとに prepare の結果を保持する
+
+    - schedule: 選択を受け取った時点でバックグラウンドで prepare を実行する
+    - take: 同じ選択・同じページ版の結果があれば返す（実行中なら完了を待ち、未着手なら取り消して None。別の版なら None）
+    - warm を渡すと、準備の後に想定される修正意図を求める軽いモデル呼び出しも先に行う
+    prepare(session_id, selection) の結果には "version"（準備に使ったページ版）を含める。
+    """
+
+    def __init__(self, prepare, warm=None, ttl=300.0, max_entries=1000, max_workers=2, wait_timeout=2.0):
+        # warm(session_id, selection, 準備結果) -> 想定される修正意図のリスト
+        self._prepare = prepare
+        self._warm = warm
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.wait_timeout = wait_timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="selection-prewarm")
+        # モデル呼び出しで準備処理の枠が埋まらないように分ける
+        self._warm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="selection-warm") if warm else None
+        self._stats = {"scheduled": 0, "hits": 0, "misses": 0, "stale": 0, "cancelled": 0}
+
+    @staticmethod
+    def key(session_id, selection):
+        payload = json.dumps(selection, sort_keys=True, ensure_ascii=False, default=str)
+        return f"{session_id}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    def schedule(self, session_id, selection, version=None):
+        """準備を予約する（同じ選択の準備が実行中、または同じ版で準備済みなら何もしない）"""
+        key = self.key(session_id, selection)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry) and not entry.future.cancelled():
+                if not entry.future.done():
+                    return False
+                if not entry.future.exception() and entry.future.result().get("version") == version:
+                    return False
+            entry = _Entry(None)
+            entry.future = self._executor.submit(self._run, session_id, selection, entry)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._stats["scheduled"] += 1
+        return True
+
+    def take(self, session_id, selection, version=None):
+        """準備済みのコンテキスト（なければ None）"""
+        key = self.key(session_id, selection)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                self._stats["misses"] += 1
+                return None
+            # まだ実行が始まっていなければ待たずに取り消し、呼び出し元でその場で組み立てる
+            if entry.future.cancel():
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                self._stats["misses"] += 1
+                self._stats["cancelled"] += 1
+                return None
+        try:
+            context = entry.future.result(timeout=self.wait_timeout)
+        except TimeoutError:
+            logger.info(f"Selection prewarm for {session_id} still running, preparing inline")
+            context = None
+        except Exception as e:
+            logger.warning(f"Selection prewarm failed for {session_id}: {e}")
+            context = None
+
+        with self._lock:
+            if context is None:
+                self._stats["misses"] += 1
+                return None
+            if context.get("version") != version:
+                self._stats["stale"] += 1
+                return None
+            self._stats["hits"] += 1
+        context = dict(context)
+        intents = entry.intents
+        context["intents"] = intents.result() if intents and intents.done() and not intents.exception() else None
+        return context
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
+
+    def _run(self, session_id, selection, entry):
+        context = self._prepare(session_id, selection)
+        if self._warm:
+            entry.intents = self._warm_executor.submit(self._warm, session_id, selection, context)
+        return context
+
+    def _expired(self, entry):
+        return time.monotonic() - entry.created > self.ttl
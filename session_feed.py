@@ -0,0 +1,111 @@
+"""
+セッションの変更番号（seq）と、会話ログのページング・差分取得
+"""
+import bisect
+import threading
+
+# 追記のみのリスト（各要素に追加時の seq を付ける）
+FEED_KEYS = ("conversation_log", "build_jobs", "fix_instructions")
+# 一覧・差分のレスポンスに含めない内部状態
+PRIVATE_KEYS = ("fix_instructions_state",)
+
+_lock = threading.Lock()
+
+
+def _seq(item):
+    return item.get("seq", 0)
+
+
+def _next_seq(session):
+    session["seq"] = session.get("seq", 0) + 1
+    return session["seq"]
+
+
+def append(session, key, item):
+    """セッションのリストに追加し、変更番号を付ける"""
+    with _lock:
+        item["seq"] = _next_seq(session)
+        session.setdefault(key, []).append(item)
+    return item
+
+
+def touch(session):
+    """リスト以外の項目（preview_url など）を変更したことを記録する"""
+    with _lock:
+        session["meta_seq"] = _next_seq(session)
+
+
+def metadata(session):
+    return {key: value for key, value in session.items()
+            if key not in FEED_KEYS and key not in PRIVATE_KEYS}
+
+
+def latest_instructions(session):
+    versions = session.get("fix_instructions") or []
+    return versions[-1] if versions else None
+
+
+def snapshot(session):
+    """セッション全体（内部状態を除く）の一貫した写し（ページングを指定しない取得用）"""
+    with _lock:
+        return {key: list(value) if key in FEED_KEYS else value
+                for key, value in session.items() if key not in PRIVATE_KEYS}
+
+
+def page(session, cursor=None, limit=50):
+    """
+    会話ログを新しい順にページングする
+
+    cursor より前（seq が小さい）のエントリを最大 limit 件、古い順に並べて返す。
+    next_cursor を次の cursor に渡すとさらに古いページを取得できる（最後のページでは None）。
+    """
+    # append と同じロックの中で読み、返す seq と含めるエントリを一致させる
+    with _lock:
+        log = session.get("conversation_log", [])
+        end = len(log) if cursor is None else bisect.bisect_left(log, cursor, key=_seq)
+        start = max(0, end - limit)
+        entries = log[start:end]
+        return {
+            "seq": session.get("seq", 0),
+            "session": metadata(session),
+            "conversation_log": entries,
+            "conversation_log_total": len(log),
+            "next_cursor": _seq(entries[0]) if start > 0 else None,
+            "build_jobs": session.get("build_jobs", [])[-limit:],
+            "fix_instructions": latest_instructions(session),
+            "fix_instructions_count": len(session.get("fix_instructions") or []),
+        }
+
+
+def delta(session, since, limit=200):
+    """
+    since より後の変更だけを返す
+
+    会話ログが limit 件を超える場合は limit 件目までで区切り、has_more=True と
+    そこまでの seq を返す（続きは返された seq を since にして取得する）。
+    """
+    # append は seq を進めてからリストに追加するため、ロックの外で読むと
+    # 返す seq が含めていないエントリまで指してしまい、クライアントが取りこぼす
+    with _lock:
+        log = session.get("conversation_log", [])
+        entries = log[bisect.bisect_right(log, since, key=_seq):]
+        has_more = len(entries) > limit
+        if has_more:
+            entries = entries[:limit]
+            upto = _seq(entries[-1])
+        else:
+            upto = session.get("seq", 0)
+
+        def changed(item):
+            return since < _seq(item) <= upto
+
+        instructions = latest_instructions(session)
+        return {
+            "seq": upto,
+            "since": since,
+            "has_more": has_more,
+            "session": metadata(session) if since < session.get("meta_seq", 0) <= upto else None,
+            "conversation_log": entries,
+            "build_jobs": [job for job in session.get("build_jobs", []) if changed(job)],
+            "fix_instructions": instructions if instructions and changed(instructions) else None,
+        }
@@ -0,0 +1,272 @@
+"""
+サイトインポート処理（HTMLのストリーミング取得・アセット並列取得・URL書き換え）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from urllib.parse import urljoin, urlparse
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import threading
+import uuid
+
+from bs4 import BeautifulSoup
+import requests
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+
+# (タグ, 属性) ごとの取得対象アセット
+ASSET_ATTRIBUTES = [
+    ("link", "href"),
+    ("script", "src"),
+    ("img", "src"),
+    ("source", "src"),
+    ("video", "poster"),
+]
+SRCSET_TAGS = ("img", "source")
+# linkタグのうち取り込むrel
+ASSET_LINK_RELS = {"stylesheet", "icon", "shortcut", "apple-touch-icon", "preload", "modulepreload"}
+
+CSS_URL_RE = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+class ResponseTooLarge(Exception):
+    """取得サイズが上限を超えた"""
+
+
+def fetch_limited(url, max_bytes, timeout=10):
+    """上限バイト数までストリーミングで取得し、(本文, Content-Type, 文字コード) を返す"""
+    with metrics.span("origin", "fetch"):
+        return _fetch_limited(url, max_bytes, timeout)
+
+
+def _fetch_limited(url, max_bytes, timeout):
+    with requests.get(url, timeout=timeout, stream=True, allow_redirects=True,
+                      headers={'User-Agent': USER_AGENT}) as response:
+        response.raise_for_status()
+
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ResponseTooLarge(f"{url}: {length} bytes > {max_bytes}")
+
+        chunks = []
+        received = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            received += len(chunk)
+            if received > max_bytes:
+                raise ResponseTooLarge(f"{url}: exceeds {max_bytes} bytes")
+            chunks.append(chunk)
+
+        # charset未指定時は本文から判定させる（requestsの既定ISO-8859-1は使わない）
+        header = response.headers.get("Content-Type", "")
+        content_type = header.split(";")[0].strip()
+        charset = requests.utils.get_encoding_from_headers({"content-type": header}) if "charset" in header else None
+        return b"".join(chunks), content_type, charset
+
+
+class SiteImporter:
+    """
+    外部サイトをGCSに取り込むジョブを管理する
+
+    HTMLは上限付きでストリーミング取得し、参照しているCSS/JS/画像を
+    並列に取得して同じプレフィックス配下に保存、HTML内のURLを書き換える。
+    """
+
+    def __init__(self, bucket_factory, selection_script, max_html_bytes=5 * 1024 * 1024,
+                 max_asset_bytes=10 * 1024 * 1024, max_assets=200, asset_workers=8,
+                 max_jobs=100):
+        self._bucket_factory = bucket_factory
+        self.selection_script = selection_script
+        self.max_html_bytes = max_html_bytes
+        self.max_asset_bytes = max_asset_bytes
+        self.max_assets = max_assets
+
+        self._jobs = OrderedDict()
+        self._max_jobs = max_jobs
+        self._lock = threading.Lock()
+        self._job_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="site-import")
+        self._asset_executor = ThreadPoolExecutor(max_workers=asset_workers,
+                                                  thread_name_prefix="site-import-asset")
+
+    def start(self, url):
+        """インポートジョブを開始してジョブ情報を返す"""
+        job = {
+            "job_id": uuid.uuid4().hex[:12],
+            "original_url": url,
+            "status": "queued",
+            "started_at": datetime.now().isoformat(),
+            "finished_at": None,
+            "assets_total": 0,
+            "assets_done": 0,
+            "assets_failed": 0,
+            "html_bytes": 0,
+            "saved_path": None,
+            "preview_url": None,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+            while len(self._jobs) > self._max_jobs:
+                self._jobs.popitem(last=False)
+        job["future"] = self._job_executor.submit(self._run, job)
+        return self.get(job["job_id"])
+
+    def wait(self, job_id, timeout=None):
+        job = self._jobs.get(job_id)
+        if job:
+            job["future"].result(timeout=timeout)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return {k: v for k, v in job.items() if k != "future"} if job else None
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def _run(self, job):
+        url = job["original_url"]
+        prefix = f"imported_sites/{job['job_id']}"
+        try:
+            self._update(job, status="fetching")
+            body, _, encoding = fetch_limited(url, self.max_html_bytes)
+            self._update(job, html_bytes=len(body))
+
+            soup = BeautifulSoup(body, "lxml", from_encoding=encoding)
+            base_url, assets = self._collect_assets(soup, url)
+            self._update(job, status="fetching_assets", assets_total=len(assets))
+
+            stored = self._store_assets(job, prefix, assets)
+            self._rewrite(soup, base_url, stored)
+
+            html_content = str(soup)
+            # 選択検知スクリプトを埋め込む
+            if '</body>' in html_content:
+                html_content = html_content.replace('</body>', self.selection_script + '</body>', 1)
+            else:
+                html_content += self.selection_script
+
+            self._update(job, status="uploading")
+            blob_name = f"{prefix}/index.html"
+            blob = self._bucket_factory().blob(blob_name)
+            blob.cache_control = "no-cache"
+            with metrics.span("gcs", "upload"):
+                blob.upload_from_string(html_content, content_type="text/html; charset=utf-8",
+                                        predefined_acl="publicRead")
+
+            self._update(job, status="completed", saved_path=blob_name,
+                         preview_url=blob.public_url, finished_at=datetime.now().isoformat())
+            logger.info(f"Site imported and saved: {blob_name} "
+                        f"({job['assets_done']}/{job['assets_total']} assets)")
+        except Exception as e:
+            logger.error(f"サイトインポートエラー: {e}")
+            self._update(job, status="failed", error=str(e), finished_at=datetime.now().isoformat())
+
+    def _collect_assets(self, soup, base_url):
+        """(基準URL, 取り込み対象アセットの絶対URL一覧) を返す"""
+        base_tag = soup.find("base", href=True)
+        if base_tag:
+            base_url = urljoin(base_url, base_tag["href"])
+            base_tag.decompose()
+
+        urls = []
+        seen = set()
+
+        def add(raw):
+            absolute = urljoin(base_url, raw.strip())
+            if urlparse(absolute).scheme in ("http", "https") and absolute not in seen:
+                seen.add(absolute)
+                urls.append(absolute)
+
+        for tag_name, attr in ASSET_ATTRIBUTES:
+            for tag in soup.find_all(tag_name, attrs={attr: True}):
+                if tag_name == "link" and not ASSET_LINK_RELS.intersection(tag.get("rel") or []):
+                    continue
+                add(tag[attr])
+        for tag in soup.find_all(SRCSET_TAGS, srcset=True):
+            for candidate in tag["srcset"].split(","):
+                if candidate.strip():
+                    add(candidate.strip().split()[0])
+        return base_url, urls[:self.max_assets]
+
+    def _store_assets(self, job, prefix, urls):
+        """アセットを並列取得して保存し、元URL -> 相対パスの対応表を返す"""
+        stored = {}
+        futures = {self._asset_executor.submit(self._store_asset, prefix, url): url for url in urls}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                stored[url] = future.result()
+                with self._lock:
+                    job["assets_done"] += 1
+            except Exception as e:
+                logger.warning(f"Asset capture failed for {url}: {e}")
+                with self._lock:
+                    job["assets_failed"] += 1
+        return stored
+
+    def _store_asset(self, prefix, url):
+        body, content_type, encoding = fetch_limited(url, self.max_asset_bytes)
+
+        path = urlparse(url).path
+        ext = os.path.splitext(path)[1].lower()[:8]
+        if not ext and content_type:
+            ext = mimetypes.guess_extension(content_type) or ""
+        if not content_type:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        # CSS内の相対url()は元サイト基準の絶対URLにしてリンク切れを防ぐ
+        if content_type == "text/css" or ext == ".css":
+            css = body.decode(encoding or "utf-8", errors="replace")
+            css = CSS_URL_RE.sub(
+                lambda m: m.group(0) if m.group(2).startswith("data:")
+                else f"url({m.group(1)}{urljoin(url, m.group(2))}{m.group(1)})",
+                css
+            )
+            body = css.encode("utf-8")
+            content_type = "text/css"
+
+        relative = f"assets/{hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]}{ext}"
+        blob = self._bucket_factory().blob(f"{prefix}/{relative}")
+        blob.cache_control = "public, max-age=31536000, immutable"
+        with metrics.span("gcs", "upload"):
+            blob.upload_from_string(body, content_type=content_type, predefined_acl="publicRead")
+        return relative
+
+    def _rewrite(self, soup, base_url, stored):
+        """HTML内のアセットURLを保存先の相対パスに書き換える"""
+        def resolve(raw):
+            return stored.get(urljoin(base_url, raw.strip()))
+
+        for tag_name, attr in ASSET_ATTRIBUTES:
+            for tag in soup.find_all(tag_name, attrs={attr: True}):
+                local = resolve(tag[attr])
+                if local:
+                    tag[attr] = local
+                    # 内容が変わるので整合性チェックは外す
+                    tag.attrs.pop("integrity", None)
+        for tag in soup.find_all(SRCSET_TAGS, srcset=True):
+            candidates = []
+            for candidate in tag["srcset"].split(","):
+                parts = candidate.strip().split()
+                if not parts:
+                    continue
+                local = resolve(parts[0])
+                candidates.append(" ".join([local or urljoin(base_url, parts[0])] + parts[1:]))
+            tag["srcset"] = ", ".join(candidates)
+
+        # 取り込まなかったリンク・画像なども元サイトの絶対URLにしておく
+        for tag in soup.find_all(["a", "img", "script", "link", "source", "video"]):
+            for attr in ("href", "src", "poster"):
+                value = tag.get(attr)
+                if value and not value.startswith(("assets/", "#", "data:", "mailto:", "tel:", "javascript:")):
+                    tag[attr] = urljoin(base_url, value)
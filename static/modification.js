@@ -8,12 +8,22 @@ class ModificationManager {
         this.selectedText = null;
         this.sessionId = null;
         this.iframeElement = null;
+        this.baseVersionSaved = false;
+        this.versionQueue = Promise.resolve();
         console.log('[ModificationManager] 初期化完了');
     }
 
-    setSessionId(sessionId) {
+    setSessionId(sessionId, resumed = false) {
         this.sessionId = sessionId;
+        // 再開したセッションは restoreLatestVersion で履歴を確認するまで初期状態を記録しない
+        this.baseVersionSaved = resumed;
         console.log('[ModificationManager] SessionID設定:', sessionId);
+
+        // 新規セッションは読み込み済みのページを初期状態として記録（要素インデックス用）
+        const iframeDoc = this.getPreviewDocument();
+        if (!resumed && iframeDoc && iframeDoc.readyState === 'complete') {
+            this.ensureBaseVersion(iframeDoc);
+        }
     }
 
     classifyModification(userInput) {
@@ -50,9 +60,23 @@ class ModificationManager {
             return { success: false, message: 'プレビューにアクセスできません' };
         }
 
-        // セレクタが特殊形式（テキスト内容検索）の場合
+        // 修正前の状態をサーバーのバージョン履歴に記録
+        this.ensureBaseVersion(iframeDoc);
+
+        // サーバーで解決済みのノードパスがあれば直接たどる
         let element;
-        if (modificationObj.selector.startsWith('__TEXT_CONTENT__')) {
+        if (modificationObj.nodePath) {
+            const node = this.getNodeFromPath(iframeDoc, modificationObj.nodePath);
+            if (node && node.nodeType === Node.ELEMENT_NODE) {
+                element = node;
+                console.log('[ModificationManager] ノードパスで要素を特定:', element.tagName);
+            }
+        }
+
+        // セレクタが特殊形式（テキスト内容検索）の場合
+        if (element) {
+            // 解決済み
+        } else if (modificationObj.selector.startsWith('__TEXT_CONTENT__')) {
             const textContent = modificationObj.selector.replace(/^__TEXT_CONTENT__/, '').replace(/__$/, '');
             console.log('[ModificationManager] テキスト内容で検索:', textContent);
 
@@ -251,6 +275,7 @@ class ModificationManager {
         try {
             const element = this.iframeElement;
             const originalHtml = element.outerHTML;
+            this.ensureBaseVersion(element.ownerDocument);
             let modifiedHtml = originalHtml;
             let modificationType = '';
             let message = '';
@@ -461,6 +486,11 @@ class ModificationManager {
 
         this.modifications.push(modification);
 
+        // 適用済みの修正はサーバーのバージョン履歴にも記録（削除アニメーション完了後）
+        if (modification.status === 'applied') {
+            setTimeout(() => this.saveVersion(modification.userInput || modification.modificationType), 400);
+        }
+
         console.log('[ModificationManager] 修正を記録:', {
             id: modification.id,
             type: modification.type,
@@ -581,6 +611,7 @@ class ModificationManager {
     }
 
     // パスからノードを復元するヘルパー関数
+    // （getNodePathと同じく、同じnodeTypeの兄弟の中での位置で数える）
     getNodeFromPath(doc, path) {
         let node = doc.body;
         for (const step of path) {
@@ -589,8 +620,9 @@ class ModificationManager {
             let index = 0;
             let child = node.firstChild;
             while (child) {
-                if (child.nodeType === step.nodeType && child.nodeName === step.nodeName) {
+                if (child.nodeType === step.nodeType) {
                     if (index === step.index) {
+                        if (child.nodeName !== step.nodeName) return null;
                         node = child;
                         break;
                     }
@@ -716,6 +748,135 @@ class ModificationManager {
         }
     }
 
+    // ★★★ サーバー側バージョン履歴 ★★★
+    getPreviewDocument() {
+        const iframe = document.getElementById('hp-preview');
+        if (!iframe) return null;
+        return iframe.contentDocument || iframe.contentWindow.document;
+    }
+
+    postVersion(html, description) {
+        if (!this.sessionId || !html) return this.versionQueue;
+
+        // 送信順序を保つため直列に送る
+        this.versionQueue = this.versionQueue.then(() => fetch(`/api/sessions/${this.sessionId}/versions`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ html, description })
+        })).catch(error => {
+            console.error('[ModificationManager] バージョン保存エラー:', error);
+        });
+        return this.versionQueue;
+    }
+
+    ensureBaseVersion(iframeDoc) {
+        if (this.baseVersionSaved || !this.sessionId || !iframeDoc || !iframeDoc.documentElement) return;
+        this.baseVersionSaved = true;
+        this.postVersion(iframeDoc.documentElement.outerHTML, '初期状態');
+    }
+
+    saveVersion(description) {
+        const iframeDoc = this.getPreviewDocument();
+        if (!iframeDoc || !iframeDoc.documentElement) return;
+        this.postVersion(iframeDoc.documentElement.outerHTML, description);
+    }
+
+    writePreviewHtml(html) {
+        const iframeDoc = this.getPreviewDocument();
+        if (!iframeDoc) return false;
+        iframeDoc.open();
+        iframeDoc.write('<!DOCTYPE html>\n' + html);
+        iframeDoc.close();
+        return true;
+    }
+
+    async requestServerHistory(action) {
+        await this.versionQueue;
+        const response = await fetch(`/api/sessions/${this.sessionId}/${action}`, { method: 'POST' });
+        return response.json();
+    }
+
+    // ローカル履歴があればDOM上で戻し、なければサーバー履歴から復元する
+    async undo() {
+        if (this.modifications.length > 0) {
+            const result = this.undoLastModification();
+            if (result.success && this.sessionId) {
+                this.requestServerHistory('undo').catch(error => {
+                    console.error('[ModificationManager] サーバーUndo同期エラー:', error);
+                });
+            }
+            return result;
+        }
+
+        if (!this.sessionId) {
+            return { success: false, message: '元に戻す操作がありません' };
+        }
+
+        try {
+            const data = await this.requestServerHistory('undo');
+            if (!data.success) {
+                return { success: false, message: data.error || '元に戻す操作がありません' };
+            }
+            this.writePreviewHtml(data.html);
+            return { success: true, message: '前の修正を元に戻しました' };
+        } catch (error) {
+            console.error('[ModificationManager] サーバーUndoエラー:', error);
+            return { success: false, message: `元に戻せませんでした: ${error.message}` };
+        }
+    }
+
+    async redo() {
+        if (!this.sessionId) {
+            return { success: false, message: 'やり直す操作がありません' };
+        }
+
+        try {
+            const data = await this.requestServerHistory('redo');
+            if (!data.success) {
+                return { success: false, message: data.error || 'やり直す操作がありません' };
+            }
+            this.writePreviewHtml(data.html);
+            return { success: true, message: '修正をやり直しました' };
+        } catch (error) {
+            console.error('[ModificationManager] Redoエラー:', error);
+            return { success: false, message: `やり直せませんでした: ${error.message}` };
+        }
+    }
+
+    // リロード後にサーバー履歴の最新版をプレビューへ復元する
+    async restoreLatestVersion() {
+        if (!this.sessionId) return false;
+
+        try {
+            const response = await fetch(`/api/sessions/${this.sessionId}/versions/current`);
+
+            if (!response.ok) {
+                // 履歴がなければ現在のページを初期状態として記録
+                this.baseVersionSaved = false;
+                const iframeDoc = this.getPreviewDocument();
+                if (iframeDoc && iframeDoc.readyState === 'complete') {
+                    this.ensureBaseVersion(iframeDoc);
+                }
+                return false;
+            }
+
+            const data = await response.json();
+            if (!data.success || data.version.version <= 1) return false;
+
+            const iframe = document.getElementById('hp-preview');
+            const iframeDoc = this.getPreviewDocument();
+            if (iframe && iframeDoc && iframeDoc.readyState !== 'complete') {
+                await new Promise(resolve => iframe.addEventListener('load', resolve, { once: true }));
+            }
+
+            console.log('[ModificationManager] 最新バージョンを復元:', data.version.version);
+            return this.writePreviewHtml(data.html);
+        } catch (error) {
+            console.error('[ModificationManager] バージョン復元エラー:', error);
+            return false;
+        }
+    }
+
     clearHistory() {
         this.modifications = [];
         console.log('[ModificationManager] 履歴クリア');
@@ -0,0 +1,129 @@
+"""
+staticディレクトリの事前読み込み（起動時にメモリへ載せ、リクエスト時にファイルI/Oを行わない）
+"""
+import logging
+import mmap
+import os
+import threading
+import time
+from types import MappingProxyType
+
+from asset_types import mimetype_for as default_mimetype_for
+from http_cache import MIN_COMPRESS_BYTES, brotli, compress, is_compressible, make_etag
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 256 * 1024
+
+
+class StaticAsset:
+    """1ファイル分の内容・MIMEタイプ・ETag・圧縮済みバリアント"""
+
+    __slots__ = ("name", "data", "size", "mtime", "mimetype", "etag", "variants")
+
+    def __init__(self, name, data, size, mtime, mimetype, etag, variants):
+        self.name = name
+        self.data = data            # bytes、または大きいファイルは mmap
+        self.size = size
+        self.mtime = mtime
+        self.mimetype = mimetype
+        self.etag = etag
+        self.variants = variants    # {"br": bytes, "gzip": bytes}
+
+    @property
+    def mapped(self):
+        return isinstance(self.data, mmap.mmap)
+
+    def body(self):
+        """レスポンス本文（mmapはチャンクに分けて返す）"""
+        if not self.mapped:
+            return self.data
+        return (self.data[offset:offset + CHUNK_BYTES] for offset in range(0, self.size, CHUNK_BYTES))
+
+
+class StaticIndex:
+    """
+    起動時に staticディレクトリを走査して StaticAsset の読み取り専用マップを作る
+
+    - mmap_threshold 以上の圧縮対象外ファイル（画像・動画など）は mmap で保持する
+    - 圧縮対象のファイルは br / gzip を事前に作っておく
+    - watch=True のときはバックグラウンドで更新時刻を監視し、変更があればマップを差し替える（開発用）
+    """
+
+    def __init__(self, root, mmap_threshold=256 * 1024, mimetype_for=default_mimetype_for,
+                 watch=False, watch_interval=1.0):
+        self.root = root
+        self.mmap_threshold = mmap_threshold
+        self.mimetype_for = mimetype_for
+        self.watch_interval = watch_interval
+        self._assets = MappingProxyType({})
+        self._lock = threading.Lock()
+        self.reload()
+        if watch:
+            threading.Thread(target=self._watch, daemon=True, name="static-watch").start()
+
+    def get(self, name):
+        return self._assets.get(name)
+
+    def __len__(self):
+        return len(self._assets)
+
+    def reload(self):
+        """変更のあったファイルだけ読み直してマップを差し替える。変更件数を返す"""
+        with self._lock:
+            current = self._assets
+            assets = {}
+            changed = 0
+            for name, path, stat in self._scan():
+                existing = current.get(name)
+                if existing and existing.mtime == stat.st_mtime_ns and existing.size == stat.st_size:
+                    assets[name] = existing
+                    continue
+                try:
+                    assets[name] = self._load(name, path, stat)
+                    changed += 1
+                except OSError as e:
+                    logger.warning(f"Failed to load static file {path}: {e}")
+            changed += len(set(current) - set(assets))
+            if changed or not current:
+                self._assets = MappingProxyType(assets)
+                logger.info(f"Static index: {len(assets)} files ({changed} changed)")
+            return changed
+
+    def _scan(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                yield name, path, stat
+
+    def _load(self, name, path, stat):
+        mimetype = self.mimetype_for(name)
+        compressible = is_compressible(mimetype)
+        with open(path, "rb") as f:
+            if stat.st_size >= self.mmap_threshold and not compressible:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                data = f.read()
+        etag = make_etag(data)
+
+        variants = {}
+        if compressible and len(data) >= MIN_COMPRESS_BYTES:
+            encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+            for encoding in encodings:
+                compressed = compress(data, encoding)
+                if len(compressed) < len(data):
+                    variants[encoding] = compressed
+        return StaticAsset(name, data, stat.st_size, stat.st_mtime_ns, mimetype, etag, variants)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.watch_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logger.warning(f"Static index reload failed: {e}")
@@ -0,0 +1,194 @@
+"""
+テキスト要約（本文ハッシュと目標文字数でキャッシュし、短時間に集まった同じセッションの要求を1回のモデル呼び出しにまとめる）
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EmptySummaryError(Exception):
+    """モデルが空の要約を返した（キャッシュせず、その要求はエラーにする）"""
+
+
+def default_max_chars(text):
+    """目標文字数の既定値（元の約1/3を10文字単位に丸める。キャッシュが効くように揃える）"""
+    return max(20, int(round(len(text) / 3, -1)))
+
+
+def single_prompt(text, max_chars):
+    return f"""次の文章を{max_chars}文字以内で要約してください。元の文章と同じ言語で、要約文のみを返してください。
+
+{text}
+"""
+
+
+def batch_prompt(items):
+    sections = "\n\n".join(
+        f"【文章{i}】（{max_chars}文字以内）\n{text}" for i, (text, max_chars) in enumerate(items, 1)
+    )
+    return f"""次の{len(items)}件の文章をそれぞれ指定の文字数以内で要約してください。元の文章と同じ言語で書いてください。
+結果は要約文を入力と同じ順に並べたJSON配列（{len(items)}要素の文字列配列）のみで返してください。
+
+{sections}
+"""
+
+
+def parse_batch(text, count):
+    text = (text or "").strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("["):] if "[" in text else text
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return None
+    try:
+        result = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(result, list) or len(result) != count or not all(isinstance(s, str) for s in result):
+        return None
+    return [s.strip() for s in result]
+
+
+class Summarizer:
+    """
+    - 同じ本文・目標文字数の要約はLRUキャッシュから返す（生成中の同じ要求は結果を共有する）
+    - 同じセッションから window 秒以内に届いた要求は最大 max_batch 件まで1回のモデル呼び出しにまとめる
+      （呼び出しは各要求のセッションの実行枠で行うため、セッションをまたいではまとめない）
+    - まとめる処理は専用のスレッドが行い、要求元のスレッドは自分の結果が出た時点で戻る
+    - まとめた応答が解釈できない場合は1件ずつ要約し直す
+    - 空の要約はキャッシュせず、その要求には EmptySummaryError を返す
+    """
+
+    def __init__(self, generate, window=0.05, max_batch=8, cache_size=2000, timeout=60.0, max_concurrency=4):
+        # generate(prompt, session_id) -> 生成テキスト
+        self._generate = generate
+        self.window = window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._cache = OrderedDict()    # key -> 要約
+        self._inflight = {}            # key -> Future
+        self._pending = []             # (key, text, max_chars, session_id, future, 受付時刻)
+        self._cond = threading.Condition()
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="summarize-batch")
+        self._stats = {"requests": 0, "cache_hits": 0, "model_calls": 0, "batched_items": 0, "empty": 0}
+
+    @staticmethod
+    def cache_key(text, max_chars):
+        return f"{hashlib.sha256(text.encode('utf-8')).hexdigest()}:{max_chars}"
+
+    def cached(self, text, max_chars):
+        key = self.cache_key(text, max_chars)
+        with self._cond:
+            summary = self._cache.get(key)
+            if summary is not None:
+                self._cache.move_to_end(key)
+            return summary
+
+    def store(self, text, max_chars, summary):
+        if not (summary or "").strip():
+            return
+        with self._cond:
+            self._store(self.cache_key(text, max_chars), summary)
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, cached=len(self._cache), pending=len(self._pending))
+
+    def summarize(self, text, max_chars, session_id=None):
+        """(要約, キャッシュから返したかどうか) を返す"""
+        key = self.cache_key(text, max_chars)
+        with self._cond:
+            self._stats["requests"] += 1
+            summary = self._cache.get(key)
+            if summary is not None:
+                self._cache.move_to_end(key)
+                self._stats["cache_hits"] += 1
+                return summary, True
+            future = self._inflight.get(key)
+            if future is None:
+                future = Future()
+                self._inflight[key] = future
+                self._pending.append((key, text, max_chars, session_id, future, time.monotonic()))
+                self._ensure_worker()
+                self._cond.notify_all()
+        return future.result(timeout=self.timeout), False
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._collect, name="summarizer", daemon=True)
+            self._worker.start()
+
+    def _collect(self):
+        """先頭の要求の待ち時間が過ぎたら、同じセッションの要求をまとめて実行に回す"""
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                remaining = self._pending[0][5] + self.window - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(timeout=remaining)
+                    continue
+                session_id = self._pending[0][3]
+                batch, rest = [], []
+                for item in self._pending:
+                    if item[3] == session_id and len(batch) < self.max_batch:
+                        batch.append(item)
+                    else:
+                        rest.append(item)
+                self._pending = rest
+            self._executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        session_id = batch[0][3]
+        try:
+            if len(batch) == 1:
+                _, text, max_chars, _, _, _ = batch[0]
+                summaries = [self._call(single_prompt(text, max_chars), session_id).strip()]
+            else:
+                items = [(item[1], item[2]) for item in batch]
+                summaries = parse_batch(self._call(batch_prompt(items), session_id), len(batch))
+                if summaries is None:
+                    logger.warning(f"Batched summary could not be parsed, retrying {len(batch)} items one by one")
+                    summaries = [self._call(single_prompt(text, max_chars), session_id).strip()
+                                 for text, max_chars in items]
+        except Exception as e:
+            with self._cond:
+                for item in batch:
+                    self._inflight.pop(item[0], None)
+            for item in batch:
+                item[4].set_exception(e)
+            return
+
+        with self._cond:
+            self._stats["batched_items"] += len(batch)
+            for item, summary in zip(batch, summaries):
+                if summary.strip():
+                    self._store(item[0], summary)
+                else:
+                    self._stats["empty"] += 1
+                self._inflight.pop(item[0], None)
+        for item, summary in zip(batch, summaries):
+            if summary.strip():
+                item[4].set_result(summary)
+            else:
+                item[4].set_exception(EmptySummaryError("要約を生成できませんでした"))
+
+    def _call(self, prompt, session_id):
+        with self._cond:
+            self._stats["model_calls"] += 1
+        return self._generate(prompt, session_id)
+
+    def _store(self, key, summary):
+        self._cache[key] = summary
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
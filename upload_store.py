@@ -0,0 +1,364 @@
+"""
+アップロードファイルの保存（再開可能な分割受信・SHA-256による重複排除・GCS転送と後処理はバックグラウンド）
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+from metrics import metrics
+
+try:
+    from PIL import Image
+except ImportError:  # サムネイル生成は Pillow がある場合のみ
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# リクエスト本文・一時ファイルを読み書きする単位（1アップロードあたりのメモリ使用量はこの程度で一定）
+READ_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+PDF_PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class UploadError(Exception):
+    """アップロード要求が不正（status はHTTPステータス）"""
+
+    def __init__(self, message, status=400, upload=None):
+        super().__init__(message)
+        self.status = status
+        self.upload = upload
+
+
+def _extension(filename):
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,10}", ext) else ""
+
+
+def _pdf_page_count(path):
+    """PDFのページ数（ページオブジェクトを数える。チャンク境界をまたぐ分は重ねて読む）"""
+    count, tail = 0, b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            data = tail + chunk
+            matches = list(PDF_PAGE_PATTERN.finditer(data))
+            # 末尾付近の一致は次のチャンクと合わせて数える
+            keep = len(data) - 32
+            count += sum(1 for m in matches if m.start() < keep)
+            tail = data[keep:] if keep > 0 else data
+    return count + len(PDF_PAGE_PATTERN.findall(tail))
+
+
+class UploadStore:
+    """
+    アップロードを一時ディレクトリに分割で受け取り、完了後に内容のSHA-256をキーにGCSへ保存する
+
+    - create → append（Content-Range の開始位置から追記）を繰り返す。中断しても get で受信済みの位置から再開できる
+    - 受信中にハッシュを計算し、同じ内容のオブジェクトがあれば転送しない
+      （create 時にクライアントが sha256 を渡した場合は、サーバー自身が計算して保存した内容と
+      一致するときだけ本文の送信を省略する。記録は digests/<sha256>.json に残す）
+    - GCSへの転送（chunk_size 単位の再開可能アップロード）とメタデータ・サムネイル生成はバックグラウンドで行う
+    アップロードの状態: uploading → storing → stored / failed
+    """
+
+    def __init__(self, bucket_factory, staging_dir, prefix="uploads", max_size=100 * 1024 * 1024,
+                 gcs_chunk_size=8 * 1024 * 1024, max_workers=2, retention_seconds=24 * 3600, max_known=10000):
+        # bucket_factory() -> google.cloud.storage.Bucket（初回利用時に生成）
+        self._bucket_factory = bucket_factory
+        self._bucket = None
+        self.staging_dir = staging_dir
+        self.prefix = prefix.strip("/")
+        self.max_size = max_size
+        self.gcs_chunk_size = gcs_chunk_size
+        self.retention_seconds = retention_seconds
+        self._max_known = max_known
+        self._uploads = {}           # upload_id -> アップロード
+        self._hashers = {}           # upload_id -> 受信中のハッシュ計算
+        self._objects = {}           # sha256 -> 保存済みオブジェクトの情報
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload-store")
+        os.makedirs(staging_dir, exist_ok=True)
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self._bucket_factory()
+        return self._bucket
+
+    def object_path(self, digest, filename):
+        return f"{self.prefix}/objects/{digest}{_extension(filename)}"
+
+    def digest_record_path(self, digest):
+        return f"{self.prefix}/digests/{digest}.json"
+
+    def create(self, session_id, filename, size=None, content_type=None, purpose="", sha256=None):
+        """アップロードを開始する（sha256 の内容が保存済みなら本文なしで完了にする）"""
+        if not filename:
+            raise UploadError("ファイル名がありません")
+        if size is not None and (size < 0 or size > self.max_size):
+            raise UploadError(f"ファイルサイズの上限は{self.max_size}バイトです", 413)
+        if sha256 is not None and not (isinstance(sha256, str) and DIGEST_PATTERN.fullmatch(sha256)):
+            raise UploadError("sha256 は64桁の小文字16進数で指定してください")
+        self._expire()
+
+        now = time.time()
+        upload = {
+            "upload_id": uuid.uuid4().hex,
+            "session_id": session_id,
+            "filename": filename,
+            "content_type": content_type or "application/octet-stream",
+            "purpose": purpose or "",
+            "size": size,
+            "offset": 0,
+            "status": "uploading",
+            "sha256": None,
+            "url": None,
+            "deduplicated": False,
+            "metadata": None,
+            "thumbnail_url": None,
+            "error": None,
+            "created_at": datetime.now().isoformat(),
+            "updated": now,
+        }
+
+        stored = self._stored_object(sha256) if sha256 else None
+        with self._lock:
+            self._uploads[upload["upload_id"]] = upload
+            if stored:
+                self._apply_stored(upload, sha256, stored, size=stored["size"])
+                logger.info(f"Upload {upload['upload_id']} deduplicated by client hash {sha256[:12]}")
+                return dict(upload)
+            self._hashers[upload["upload_id"]] = hashlib.sha256()
+        open(self._staging_path(upload["upload_id"]), "wb").close()
+        return dict(upload)
+
+    def append(self, upload_id, offset, stream, total=None):
+        """offset の位置から本文を追記し、全体を受け取ったら保存を開始する"""
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            if upload is None:
+                raise UploadError("アップロードが見つかりません", 404)
+            if upload["status"] == "receiving":
+                raise UploadError("このアップロードは受信中です", 409, dict(upload))
+            if upload["status"] != "uploading":
+                return dict(upload)
+            if offset != upload["offset"]:
+                raise UploadError("受信済みの位置と一致しません", 409, dict(upload))
+            if total is not None:
+                if upload["size"] is not None and upload["size"] != total:
+                    raise UploadError("ファイルサイズが作成時と異なります", 400, dict(upload))
+                if total > self.max_size:
+                    raise UploadError(f"ファイルサイズの上限は{self.max_size}バイトです", 413)
+                upload["size"] = total
+            hasher = self._hashers[upload_id]
+            limit = upload["size"] if upload["size"] is not None else self.max_size
+            # 同じアップロードへの並行した追記を防ぐ
+            upload["status"] = "receiving"
+
+        written = 0
+        try:
+            with open(self._staging_path(upload_id), "ab") as f:
+                while True:
+                    chunk = stream.read(READ_SIZE)
+                    if not chunk:
+                        break
+                    if offset + written + len(chunk) > limit:
+                        raise UploadError("宣言されたサイズを超えています", 413)
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    written += len(chunk)
+        except Exception:
+            # 途中までの書き込みは捨て、受信済みの位置から再送してもらう
+            with open(self._staging_path(upload_id), "ab") as f:
+                f.truncate(offset)
+            with self._lock:
+                self._hashers[upload_id] = self._rehash(upload_id, offset)
+                upload["status"] = "uploading"
+            raise
+
+        with self._lock:
+            upload["offset"] = offset + written
+            upload["updated"] = time.time()
+            upload["status"] = "uploading"
+            complete = upload["size"] is not None and upload["offset"] >= upload["size"]
+        if complete:
+            self._finalize(upload)
+        return self.get(upload_id)
+
+    def put_stream(self, session_id, filename, stream, content_type=None, purpose=""):
+        """1リクエストで受け取るアップロード（サイズ不明のまま最後まで読み、そのまま保存を開始する）"""
+        upload = self.create(session_id, filename, content_type=content_type, purpose=purpose)
+        self.append(upload["upload_id"], 0, stream)
+        with self._lock:
+            current = self._uploads[upload["upload_id"]]
+            if current["status"] == "uploading":
+                current["size"] = current["offset"]
+        if current["status"] == "uploading":
+            self._finalize(current)
+        return self.get(upload["upload_id"])
+
+    def get(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+            return dict(upload) if upload else None
+
+    # ------------------------------------------------------------------
+    # 内部処理
+    # ------------------------------------------------------------------
+
+    def _staging_path(self, upload_id):
+        return os.path.join(self.staging_dir, f"{upload_id}.part")
+
+    def _rehash(self, upload_id, length):
+        hasher = hashlib.sha256()
+        remaining = length
+        with open(self._staging_path(upload_id), "rb") as f:
+            while remaining > 0:
+                chunk = f.read(min(READ_SIZE, remaining))
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        return hasher
+
+    def _finalize(self, upload):
+        """受信完了: 保存済みの内容なら転送を省き、そうでなければバックグラウンドで保存する"""
+        with self._lock:
+            digest = self._hashers.pop(upload["upload_id"]).hexdigest()
+            upload["sha256"] = digest
+            stored = self._objects.get(digest)
+            if stored:
+                self._apply_stored(upload, digest, stored)
+            else:
+                upload["status"] = "storing"
+                upload["url"] = self.bucket.blob(self.object_path(digest, upload["filename"])).public_url
+        if stored:
+            self._discard_staging(upload["upload_id"])
+            logger.info(f"Upload {upload['upload_id']} deduplicated ({digest[:12]})")
+        else:
+            self._executor.submit(self._store, upload, digest)
+
+    def _store(self, upload, digest):
+        staging = self._staging_path(upload["upload_id"])
+        path = self.object_path(digest, upload["filename"])
+        try:
+            blob = self.bucket.blob(path)
+            with metrics.span("gcs", "exists"):
+                exists = blob.exists()
+            if not exists:
+                # chunk_size を指定すると再開可能アップロードで分割送信される（全体をメモリに載せない）
+                blob.chunk_size = self.gcs_chunk_size
+                blob.cache_control = "public, max-age=31536000, immutable"
+                with metrics.span("gcs", "upload"):
+                    blob.upload_from_filename(staging, content_type=upload["content_type"])
+                logger.info(f"Stored upload {path} ({upload['offset']} bytes)")
+            metadata, thumbnail_url = self._postprocess(staging, digest, upload)
+            stored = {
+                "path": path,
+                "url": blob.public_url,
+                "size": upload["offset"],
+                "metadata": metadata,
+                "thumbnail_url": thumbnail_url,
+            }
+            # サーバーが計算したハッシュと保存先の記録（クライアントのハッシュ指定はこれとだけ照合する）
+            record = self.bucket.blob(self.digest_record_path(digest))
+            with metrics.span("gcs", "upload"):
+                record.upload_from_string(json.dumps(stored, ensure_ascii=False), content_type="application/json")
+        except Exception as e:
+            logger.error(f"Upload {upload['upload_id']} failed to store: {e}")
+            with self._lock:
+                upload["status"] = "failed"
+                upload["error"] = str(e)
+                upload["updated"] = time.time()
+            self._discard_staging(upload["upload_id"])
+            return
+
+        with self._lock:
+            if len(self._objects) >= self._max_known:
+                self._objects.clear()
+            self._objects[digest] = stored
+            self._apply_stored(upload, digest, stored, deduplicated=exists)
+        self._discard_staging(upload["upload_id"])
+
+    def _postprocess(self, staging, digest, upload):
+        """メタデータの抽出とサムネイル生成（失敗してもアップロード自体は成功とする）"""
+        metadata = {"size": upload["offset"], "content_type": upload["content_type"]}
+        thumbnail_url = None
+        try:
+            if upload["content_type"] == "application/pdf" or _extension(upload["filename"]) == ".pdf":
+                metadata["pages"] = _pdf_page_count(staging)
+            elif Image is not None and upload["content_type"].startswith("image/"):
+                with Image.open(staging) as image:
+                    metadata["width"], metadata["height"] = image.size
+                    image.thumbnail(THUMBNAIL_SIZE)
+                    thumbnail_path = f"{staging}.thumb.png"
+                    image.save(thumbnail_path, "PNG")
+                try:
+                    blob = self.bucket.blob(f"{self.prefix}/thumbnails/{digest}.png")
+                    blob.cache_control = "public, max-age=31536000, immutable"
+                    with metrics.span("gcs", "upload"):
+                        blob.upload_from_filename(thumbnail_path, content_type="image/png")
+                    thumbnail_url = blob.public_url
+                finally:
+                    os.remove(thumbnail_path)
+        except Exception as e:
+            logger.warning(f"Upload postprocessing failed for {digest[:12]}: {e}")
+        return metadata, thumbnail_url
+
+    def _stored_object(self, digest):
+        """サーバーが内容を確認して保存したオブジェクトの情報（メモリになければ digests の記録を読む）"""
+        with self._lock:
+            stored = self._objects.get(digest)
+        if stored:
+            return stored
+        with metrics.span("gcs", "download"):
+            record = self.bucket.get_blob(self.digest_record_path(digest))
+            if record is None:
+                return None
+            stored = json.loads(record.download_as_bytes())
+        with self._lock:
+            if len(self._objects) >= self._max_known:
+                self._objects.clear()
+            self._objects[digest] = stored
+        return stored
+
+    def _apply_stored(self, upload, digest, stored, size=None, deduplicated=True):
+        upload.update({
+            "status": "stored",
+            "sha256": digest,
+            "url": stored["url"],
+            "deduplicated": deduplicated,
+            "metadata": stored["metadata"],
+            "thumbnail_url": stored["thumbnail_url"],
+            "updated": time.time(),
+        })
+        if size is not None:
+            upload["size"] = upload["offset"] = size
+
+    def _discard_staging(self, upload_id):
+        try:
+            os.remove(self._staging_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def _expire(self):
+        """放置されたアップロードと一時ファイルを削除する"""
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            expired = [upload_id for upload_id, upload in self._uploads.items()
+                       if upload["updated"] < cutoff and upload["status"] != "storing"]
+            for upload_id in expired:
+                del self._uploads[upload_id]
+                self._hashers.pop(upload_id, None)
+        for upload_id in expired:
+            self._discard_staging(upload_id)
@@ -0,0 +1,242 @@
+"""
+ページのバージョン履歴管理（最新スナップショット + 逆パッチによるUndo/Redo）
+"""
+from collections import OrderedDict, deque
+from datetime import datetime
+import difflib
+import re
+import threading
+import zlib
+
+# タグ境界で分割する（改行のない圧縮HTMLでも差分を細かく取れるように）
+_TOKEN_RE = re.compile(r"[^>]*>|[^>]+$")
+
+
+def tokenize(html):
+    return _TOKEN_RE.findall(html)
+
+
+def make_patch(src, dst):
+    """トークン列 src を dst に変換するパッチ [(i1, i2, 置換トークン), ...] を返す"""
+    # 共通の先頭・末尾を先に除いて差分計算の対象を小さくする
+    prefix = 0
+    limit = min(len(src), len(dst))
+    while prefix < limit and src[prefix] == dst[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and src[len(src) - 1 - suffix] == dst[len(dst) - 1 - suffix]):
+        suffix += 1
+
+    a = src[prefix:len(src) - suffix]
+    b = dst[prefix:len(dst) - suffix]
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    return [
+        (prefix + i1, prefix + i2, b[j1:j2])
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+        if tag != "equal"
+    ]
+
+
+def apply_patch(tokens, patch):
+    """パッチを適用した新しいトークン列を返す"""
+    result = list(tokens)
+    # 後ろから適用すればインデックスがずれない
+    for i1, i2, replacement in reversed(patch):
+        result[i1:i2] = replacement
+    return result
+
+
+def invert_patch(patch, src):
+    """src に patch を適用した結果を src に戻すパッチを返す（差分の再計算なし）"""
+    inverse = []
+    offset = 0
+    for i1, i2, replacement in patch:
+        start = i1 + offset
+        inverse.append((start, start + len(replacement), src[i1:i2]))
+        offset += len(replacement) - (i2 - i1)
+    return inverse
+
+
+def patch_size(patch):
+    return sum(len(token) for _, _, replacement in patch for token in replacement) + 16 * len(patch)
+
+
+class VersionHistory:
+    """
+    1セッション分のバージョン履歴
+
+    最新版のみ全文を保持し、過去版へは逆パッチで戻る。
+    snapshot_interval ごとに圧縮スナップショットを取り、任意の版の復元を速くする。
+    """
+
+    def __init__(self, max_versions=50, max_patch_bytes=5 * 1024 * 1024, snapshot_interval=10):
+        self.max_versions = max_versions
+        self.max_patch_bytes = max_patch_bytes
+        self.snapshot_interval = snapshot_interval
+
+        self.current = None          # 最新版のトークン列
+        self.current_meta = None
+        self.next_version = 1
+        self.undo_stack = deque()    # (逆パッチ, 戻り先のmeta)
+        self.redo_stack = []         # (順パッチ, 進み先のmeta)
+        self.snapshots = {}          # version -> zlib圧縮した全文
+        self.patch_bytes = 0
+
+    def commit(self, html, description=""):
+        """新しい版を追加する（内容が同じ場合は何もしない）"""
+        tokens = tokenize(html)
+        if self.current is not None and tokens == self.current:
+            return self.current_meta, False
+
+        meta = {
+            "version": self.next_version,
+            "description": description,
+            "created_at": datetime.now().isoformat(),
+            "size": len(html),
+        }
+        self.next_version += 1
+
+        if self.current is not None:
+            reverse = make_patch(tokens, self.current)
+            self._push_undo(reverse, self.current_meta)
+        # 新しい修正でRedo履歴は無効になる
+        for _, redo_meta in self.redo_stack:
+            self.snapshots.pop(redo_meta["version"], None)
+        self.redo_stack = []
+
+        self.current = tokens
+        self.current_meta = meta
+        if meta["version"] % self.snapshot_interval == 0:
+            self.snapshots[meta["version"]] = zlib.compress(html.encode("utf-8"))
+        return meta, True
+
+    def undo(self):
+        if not self.undo_stack:
+            return None
+        reverse, prev_meta = self.undo_stack.pop()
+        self.patch_bytes -= patch_size(reverse)
+        previous = apply_patch(self.current, reverse)
+        self.redo_stack.append((invert_patch(reverse, self.current), self.current_meta))
+        self.current = previous
+        self.current_meta = prev_meta
+        return self.html
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        forward, next_meta = self.redo_stack.pop()
+        following = apply_patch(self.current, forward)
+        self._push_undo(invert_patch(forward, self.current), self.current_meta)
+        self.current = following
+        self.current_meta = next_meta
+        return self.html
+
+    def get_version(self, version):
+        """指定した版の (全文, meta) を返す（Redoで戻れる版も含む。保持範囲外なら (None, None)）"""
+        if self.current_meta is None:
+            return None, None
+        if version == self.current_meta["version"]:
+            return self.html, self.current_meta
+
+        # 過去の版は逆パッチ、Undo後の先の版は順パッチを現在の版から順に適用する
+        for stack in (self.undo_stack, self.redo_stack):
+            metas = {meta["version"]: meta for _, meta in stack}
+            if version not in metas:
+                continue
+            if version in self.snapshots:
+                return zlib.decompress(self.snapshots[version]).decode("utf-8"), metas[version]
+            tokens = self.current
+            for patch, meta in reversed(stack):
+                tokens = apply_patch(tokens, patch)
+                if meta["version"] == version:
+                    return "".join(tokens), meta
+        return None, None
+
+    @property
+    def html(self):
+        return "".join(self.current) if self.current is not None else None
+
+    def summary(self):
+        return {
+            "current": self.current_meta,
+            "undo": [meta for _, meta in reversed(self.undo_stack)],
+            "redo": [meta for _, meta in reversed(self.redo_stack)],
+            "can_undo": bool(self.undo_stack),
+            "can_redo": bool(self.redo_stack),
+            "patch_bytes": self.patch_bytes,
+        }
+
+    def _push_undo(self, reverse, meta):
+        self.undo_stack.append((reverse, meta))
+        self.patch_bytes += patch_size(reverse)
+        # 件数・サイズの上限を超えたら古い版から捨てる
+        while self.undo_stack and (len(self.undo_stack) > self.max_versions
+                                   or self.patch_bytes > self.max_patch_bytes):
+            dropped, dropped_meta = self.undo_stack.popleft()
+            self.patch_bytes -= patch_size(dropped)
+            self.snapshots.pop(dropped_meta["version"], None)
+
+
+class VersionStore:
+    """セッションごとのVersionHistoryを保持する（セッション数はLRUで制限）"""
+
+    def __init__(self, max_sessions=200, **history_options):
+        self.max_sessions = max_sessions
+        self.history_options = history_options
+        self._histories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def commit(self, session_id, html, description=""):
+        with self._lock:
+            meta, changed = self._history(session_id, create=True).commit(html, description)
+            return meta, changed
+
+    def undo(self, session_id):
+        with self._lock:
+            history = self._history(session_id)
+            if history is None:
+                return None, None
+            html = history.undo()
+            return html, history.current_meta
+
+    def redo(self, session_id):
+        with self._lock:
+            history = self._history(session_id)
+            if history is None:
+                return None, None
+            html = history.redo()
+            return html, history.current_meta
+
+    def get(self, session_id, version=None):
+        with self._lock:
+            history = self._history(session_id)
+            if history is None or history.current_meta is None:
+                return None, None
+            if version is None:
+                return history.html, history.current_meta
+            return history.get_version(version)
+
+    def current_version(self, session_id):
+        """現在の版番号（履歴がなければNone）"""
+        with self._lock:
+            history = self._histories.get(session_id)
+            meta = history.current_meta if history else None
+            return meta["version"] if meta else None
+
+    def summary(self, session_id):
+        with self._lock:
+            history = self._history(session_id)
+            return history.summary() if history else None
+
+    def _history(self, session_id, create=False):
+        history = self._histories.get(session_id)
+        if history is None:
+            if not create:
+                return None
+            history = VersionHistory(**self.history_options)
+            self._histories[session_id] = history
+            while len(self._histories) > self.max_sessions:
+                self._histories.popitem(last=False)
+        self._histories.move_to_end(session_id)
+        return history
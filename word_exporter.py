@@ -0,0 +1,176 @@
+"""
+修正指示書のWord出力（テンプレート再利用・結果キャッシュ・並列数制限）
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import logging
+import threading
+
+from bs4 import BeautifulSoup, NavigableString, Tag
+from docx import Document
+
+logger = logging.getLogger(__name__)
+
+HEADING_TAGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+LIST_TAGS = {"ul": "List Bullet", "ol": "List Number"}
+# python-docxの既定テンプレートにあるリストスタイルの最大階層
+MAX_LIST_LEVEL = 3
+# リストスタイルのないテンプレートで段落の先頭に付ける記号
+LIST_MARKERS = {"ul": "・", "ol": ""}
+
+
+def parse_fragment(html):
+    """lxmlがあれば使い、なければ標準のhtml.parserで解析する"""
+    try:
+        return BeautifulSoup(html, "lxml")
+    except Exception:
+        return BeautifulSoup(html, "html.parser")
+
+
+class WordExporter:
+    """
+    修正指示書(HTML)を .docx に変換する
+
+    - テンプレート文書はメモリに読み込んでおき、毎回そのバイト列から複製する
+    - 指示書の内容ハッシュごとに生成結果をキャッシュする
+    - 変換処理は上限付きのスレッドプールで実行する
+    - テンプレートにない見出し・リスト・表のスタイルは使わない（独自テンプレートでも変換できるように）
+    """
+
+    def __init__(self, template_path=None, max_workers=2, cache_size=64, title="修正指示書"):
+        self.title = title
+        self.cache_size = cache_size
+        self._template_bytes = self._load_template(template_path)
+        self._styles = {style.name for style in Document(io.BytesIO(self._template_bytes)).styles}
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="word-export")
+
+    @staticmethod
+    def _load_template(template_path):
+        doc = Document(template_path) if template_path else Document()
+        stream = io.BytesIO()
+        doc.save(stream)
+        return stream.getvalue()
+
+    @staticmethod
+    def cache_key(instructions):
+        return hashlib.sha256(instructions.encode("utf-8")).hexdigest()
+
+    def export(self, instructions, timeout=60):
+        """(docxのバイト列, キャッシュキー) を返す"""
+        key = self.cache_key(instructions)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                return cached, key
+            # 同じ内容の変換が実行中ならその結果を待つ
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._render, instructions)
+                self._inflight[key] = future
+
+        try:
+            data = future.result(timeout=timeout)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return data, key
+
+    def _style(self, *names):
+        """テンプレートにある最初のスタイル名（どれもなければNone）"""
+        return next((name for name in names if name in self._styles), None)
+
+    def _add_heading(self, doc, text, level):
+        if self._style("Title" if level == 0 else f"Heading {level}"):
+            doc.add_heading(text, level)
+        else:
+            doc.add_paragraph().add_run(text).bold = True
+
+    def _render(self, instructions):
+        doc = Document(io.BytesIO(self._template_bytes))
+        self._add_heading(doc, self.title, 0)
+
+        soup = parse_fragment(instructions)
+        root = soup.body or soup
+        if root.find(True) is None:
+            # HTMLでない（プレーンテキスト・Markdown）場合は行ごとに段落にする
+            for line in instructions.splitlines():
+                if line.strip():
+                    doc.add_paragraph(line.strip())
+        else:
+            self._add_blocks(doc, root)
+
+        stream = io.BytesIO()
+        doc.save(stream)
+        logger.info(f"Word document rendered: {len(instructions)} chars -> {stream.tell()} bytes")
+        return stream.getvalue()
+
+    def _add_blocks(self, doc, parent):
+        for node in parent.children:
+            if isinstance(node, NavigableString):
+                text = node.strip()
+                if text and type(node) is NavigableString:
+                    doc.add_paragraph(text)
+                continue
+            if not isinstance(node, Tag):
+                continue
+
+            if node.name in HEADING_TAGS:
+                self._add_heading(doc, node.get_text(" ", strip=True), HEADING_TAGS[node.name])
+            elif node.name in ("p", "pre", "blockquote"):
+                text = node.get_text(strip=node.name != "pre")
+                if text:
+                    doc.add_paragraph(text)
+            elif node.name in LIST_TAGS:
+                self._add_list(doc, node, level=1)
+            elif node.name == "table":
+                self._add_table(doc, node)
+            else:
+                # div / section などのコンテナは中身を展開する
+                self._add_blocks(doc, node)
+
+    def _add_list(self, doc, list_tag, level):
+        base = LIST_TAGS[list_tag.name]
+        # 深い階層のスタイルがなければ浅い階層のスタイルで代用する
+        style = self._style(*[f"{base} {n}" for n in range(min(level, MAX_LIST_LEVEL), 1, -1)], base)
+        for number, item in enumerate(list_tag.find_all("li", recursive=False), 1):
+            text = " ".join(
+                child.get_text(" ", strip=True) if isinstance(child, Tag) else child.strip()
+                for child in item.children
+                if not (isinstance(child, Tag) and child.name in LIST_TAGS)
+            ).strip()
+            if text and style:
+                doc.add_paragraph(text, style=style)
+            elif text:
+                marker = LIST_MARKERS[list_tag.name] or f"{number}. "
+                doc.add_paragraph(f"{'　' * (level - 1)}{marker}{text}")
+            for nested in item.find_all(list(LIST_TAGS), recursive=False):
+                self._add_list(doc, nested, level + 1)
+
+    def _add_table(self, doc, table_tag):
+        rows = [
+            [cell.get_text(" ", strip=True) for cell in row.find_all(["th", "td"], recursive=False)]
+            for row in table_tag.find_all("tr")
+        ]
+        rows = [row for row in rows if row]
+        if not rows:
+            return
+        columns = max(len(row) for row in rows)
+        table = doc.add_table(rows=len(rows), cols=columns)
+        style = self._style("Table Grid")
+        if style:
+            table.style = style
+        for r, row in enumerate(rows):
+            cells = table.rows[r].cells
+            for c, text in enumerate(row):
+                cells[c].text = text